@@ -0,0 +1,122 @@
+import random
+
+# Small Italian construction vocabulary; combinations give realistic-looking
+# Prezziario titles with enough lexical overlap to make retrieval non-trivial.
+WORKS = [
+    "Demolizione", "Rimozione", "Fornitura e posa", "Realizzazione", "Rifacimento", "Scavo",
+    "Getto", "Posa in opera", "Smontaggio", "Tinteggiatura", "Impermeabilizzazione", "Isolamento",
+    "Intonaco", "Massetto", "Pavimentazione", "Rivestimento", "Consolidamento", "Trasporto",
+]
+OBJECTS = [
+    "manto di copertura", "muratura in mattoni", "solaio in laterocemento", "pavimento in ceramica",
+    "intonaco civile", "calcestruzzo armato", "serramento in legno", "guaina bituminosa",
+    "lastre di cartongesso", "tubazione in PVC", "cordolo in pietra", "ponteggio metallico",
+    "massetto sabbia e cemento", "pannelli isolanti", "canale di gronda", "recinzione di cantiere",
+]
+DETAILS = [
+    "spessore 4 cm", "spessore 8 cm", "spessore 12 cm", "compreso il trasporto a discarica",
+    "eseguito a mano", "eseguito con mezzi meccanici", "classe C25/30", "in coppi", "in lamiera",
+    "su superfici orizzontali", "su superfici verticali", "fino a 3 m di altezza", "oltre 3 m di altezza",
+    "per interni", "per esterni", "a regola d'arte",
+]
+UNITS = ["m²", "m2", "mq", "m³", "mc", "m", "kg", "h", "cad", "t", "l"]
+RESOURCES = [
+    ("Operaio comune", "h"), ("Operaio specializzato", "h"), ("Autocarro con gru", "h"),
+    ("Escavatore idraulico", "h"), ("Calcestruzzo C25/30", "m³"), ("Malta cementizia", "m³"),
+    ("Acciaio B450C", "kg"), ("Laterizio forato", "cad"), ("Guaina bituminosa", "m²"), ("Sabbia", "t"),
+]
+MAIN_CATEGORIES = [
+    "Opere edili", "Opere stradali", "Impianti tecnologici", "Restauro e risanamento",
+    "Materiali e lavorazioni", "Sicurezza", "Opere a verde", "Bonifiche",
+]
+CATEGORIES = [
+    "Demolizioni e rimozioni", "Scavi e rinterri", "Murature", "Solai", "Coperture",
+    "Intonaci", "Pavimenti e rivestimenti", "Serramenti", "Impermeabilizzazioni", "Opere in cemento armato",
+]
+
+
+def _title(rng):
+    return f"{rng.choice(WORKS)} {rng.choice(OBJECTS)} {rng.choice(DETAILS)}"
+
+
+def _price(rng, low=1.0, high=900.0):
+    return round(rng.uniform(low, high), 2)
+
+
+def pat_chunks(n, seed=0):
+    """
+    PAT analyses, one per line: main code, title, unit and quantity, the
+    resources as `code desc | Formula | UM | Qty | Price | Total` and a
+    Summary dict, as read by parse_activity_chunks.
+    """
+    rng = random.Random(seed)
+    chunks = []
+    for i in range(n):
+        chapter, sub, item, variant = 1 + i // 200000 % 99, 1 + i // 2000 % 99, 10 * (1 + i // 20 % 999), 10 * (1 + i % 20)
+        code = f"B.{chapter:02d}.{sub:02d}.{item:04d}.{variant:03d}"
+        unit = rng.choice(UNITS)
+        parts = [f"{code} {_title(rng)} Unit: {unit}, Quantity: 1.0"]
+        total = 0.0
+        for r in range(rng.randint(1, 4)):
+            name, r_unit = rng.choice(RESOURCES)
+            qty = round(rng.uniform(0.05, 3.0), 3)
+            price = _price(rng, 1.0, 120.0)
+            line_total = round(qty * price, 2)
+            total += line_total
+            r_code = f"{rng.choice('AMN')}.{rng.randint(1, 30):02d}.{rng.randint(1, 50):02d}.{rng.randint(1, 999):04d}.{rng.randint(1, 99):03d}"
+            parts.append(f"{r_code} {name} | Formula: {qty} | UM: {r_unit} | Qty: {qty} | Price: {price} | Total: {line_total}")
+        summary = {
+            "importo_totale_analisi": round(total, 2),
+            "prezzo_applicazione": round(total * 1.245, 2),
+            "riepilogo_categoria": {"Costo manodopera alla produzione": round(total * 0.4, 2), "Costo macchine": round(total * 0.3, 2)},
+        }
+        parts.append(f"Summary: {summary}")
+        chunks.append(" ".join(parts))
+    return chunks
+
+
+def piemonte_chunks(n, seed=0):
+    """
+    Piemonte activities, one per line, in the flattened form written by
+    load_and_chunk_rag_txt: Main Category / Description / Category prefix,
+    then `Activity:` and one or more `Work: ... Codice: ..., U.M.: ..., Euro: ...`.
+    """
+    rng = random.Random(seed)
+    chunks = []
+    for i in range(n):
+        main_category = MAIN_CATEGORIES[i // 5000 % len(MAIN_CATEGORIES)]
+        category = CATEGORIES[i // 500 % len(CATEGORIES)]
+        prefix = f"Main Category: {main_category} Description: Lavori di {main_category.lower()} Category: {category}"
+        works = []
+        for w in range(rng.randint(1, 4)):
+            code = f"{1 + i // 50000 % 30:02d}.A{1 + i // 500 % 99:02d}.A{10 * (1 + i // 5 % 99):02d}.{5 * (w + 1) + 100 * (i % 5):03d}"
+            works.append(f"Work: {_title(rng)} Codice: {code}, U.M.: {rng.choice(UNITS)}, Euro: {_price(rng)}, Manodopera: {rng.randint(5, 90)}%")
+        chunks.append(f"{prefix} Activity: {_title(rng)} " + " ".join(works))
+    return chunks
+
+
+def dei_chunks(n, seed=0):
+    """
+    DEI items, one per line: `Code: <code> Description: <desc> Unit: <unit> Price: <price>`.
+    """
+    rng = random.Random(seed)
+    chunks = []
+    for i in range(n):
+        code = f"{'ABCDEFGH'[i // 100000 % 8]}{10000 + i // 26 % 90000:05d}{'abcdefghijklmnopqrstuvwxyz'[i % 26]}"
+        chunks.append(f"Code: {code} Description: {_title(rng)} Unit: {rng.choice(UNITS)} Price: {_price(rng):.2f}")
+    return chunks
+
+
+GENERATORS = {
+    "pat": pat_chunks,
+    "piemonte": piemonte_chunks,
+    "dei": dei_chunks,
+}
+
+
+def queries(n, seed=0):
+    """
+    Free-text estimator queries built from the same vocabulary.
+    """
+    rng = random.Random(seed + 1)
+    return [f"{rng.choice(WORKS).lower()} {rng.choice(OBJECTS)}" for _ in range(n)]
@@ -0,0 +1,42 @@
+import re
+import zlib
+import numpy as np
+
+
+class HashingEmbedder:
+    """
+    Deterministic stand-in for the SentenceTransformer model: a signed
+    feature-hashing bag of words. It has the encode() signature the servers
+    use, needs no model download and costs microseconds per text, so the
+    benchmarks measure the pipeline rather than the encoder.
+    """
+
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+        self.buckets = {}
+
+    def _bucket(self, token):
+        bucket = self.buckets.get(token)
+        if bucket is None:
+            h = zlib.crc32(token.encode("utf-8"))
+            bucket = (h % self.dimension, 1.0 if (h >> 31) & 1 else -1.0)
+            self.buckets[token] = bucket
+        return bucket
+
+    def _encode_one(self, text, out):
+        for token in re.findall(r"\w+", text.lower()):
+            idx, sign = self._bucket(token)
+            out[idx] += sign
+
+    def encode(self, sentences, convert_to_numpy=True, convert_to_tensor=False, show_progress_bar=False, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        embs = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for i, text in enumerate(texts):
+            self._encode_one(text, embs[i])
+        embs /= np.linalg.norm(embs, axis=1, keepdims=True) + 1e-12
+        result = embs[0] if single else embs
+        if convert_to_tensor:
+            import torch
+            return torch.from_numpy(result)
+        return result
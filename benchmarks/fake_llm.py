@@ -0,0 +1,73 @@
+import re
+import json
+import time
+import zlib
+import random
+import threading
+
+
+class FakeLLM:
+    """
+    Deterministic stand-in for mistral_utils.answer_question.
+
+    The reply depends only on the prompt, so two runs over the same corpus and
+    queries make the same calls and pick the same chunks. `latency` (seconds,
+    plus optional uniform `jitter`) is slept on every call to simulate Mistral.
+    With `rpm_limit`, calls beyond that many per rolling minute raise a 429
+    error, like the Mistral client does when the rate limit is hit.
+    Replies are JSON-encoded strings, like the real answer_question.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0, rpm_limit=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rpm_limit = rpm_limit
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.recent = []
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+
+    def total_calls(self):
+        return sum(v for k, v in self.calls.items() if k != "rate_limited")
+
+    def _count(self, kind):
+        with self.lock:
+            if self.rpm_limit:
+                now = time.monotonic()
+                self.recent = [t for t in self.recent if now - t < 60.0]
+                if len(self.recent) >= self.rpm_limit:
+                    self.calls["rate_limited"] = self.calls.get("rate_limited", 0) + 1
+                    raise RuntimeError("Error response 429: rate limit exceeded")
+                self.recent.append(now)
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+
+    def answer_question(self, query, task="site_visit", priority=None, cancel=None):
+        # Replies depend on the prompt alone; `task` only picks the real system prompt,
+        # `priority` and `cancel` only matter to the scheduler
+        if query.startswith("Define the construction activity category"):
+            self._count("refine")
+            text = query.rsplit("for:", 1)[-1].strip()
+            words = re.findall(r"\w+", text)
+            reply = ", ".join([" ".join(words[:4]), " ".join(words[-3:])]) if words else text
+        elif query.startswith("Is the following construction activity relevant"):
+            self._count("rerank")
+            reply = str(1 + zlib.crc32(query.encode("utf-8")) % 100)
+        elif query.startswith("Give 5 alternative ways"):
+            self._count("alternatives")
+            text = query.split("as:", 1)[-1].split(", in italian")[0].strip()
+            words = re.findall(r"\w+", text) or [text]
+            reply = "\n".join(" ".join(words[i:] + words[:i]) for i in range(min(5, len(words))))
+        else:
+            self._count("site_visit")
+            # One work per line of the notes, with the keys the site_visit prompt asks for
+            works = [{"Work": line.strip(), "Area": "Area 1", "Subarea": "", "Item": "", "Unit": "m²", "Quantity": 10 + i}
+                     for i, line in enumerate(query.splitlines()) if line.strip()]
+            reply = json.dumps({"Works": works, "Missing": [], "GeneralTimeline": []}, ensure_ascii=False)
+        return json.dumps(reply, ensure_ascii=False)
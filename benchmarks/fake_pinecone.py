@@ -0,0 +1,228 @@
+import json
+import operator
+import threading
+import numpy as np
+
+COMPARISONS = {"$eq": operator.eq, "$ne": operator.ne, "$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le}
+
+
+class InMemoryIndex:
+    """
+    In-memory stand-in for a Pinecone serverless index.
+
+    Implements the subset of the client API the servers use: upsert() with
+    (id, values, metadata) tuples or dicts with optional sparse_values,
+    query() returning {"matches": [...]} with id, score and metadata,
+    fetch() and delete() by ID, and update() of a vector's metadata. query() accepts Pinecone metadata filters ($eq, $ne, $gt,
+    $gte, $lt, $lte, $in, $nin, $and, $or); list-valued metadata matches if
+    any element does. Scores are cosine similarities, or with
+    metric="dotproduct" dot products plus the dot product of the sparse
+    vectors when the query has a sparse_vector, like a Pinecone sparse-dense
+    query. Dense scores are one matrix product over the namespace, sparse
+    ones walk an inverted index of the query's terms.
+    """
+
+    def __init__(self, dimension=None, metric="cosine"):
+        self.dimension = dimension
+        self.metric = metric
+        self.lock = threading.Lock()
+        self.namespaces = {}
+        self.query_count = 0
+        self.fetch_count = 0
+        self.bytes_returned = 0
+        # Highest score returned; hybrid scores must stay on the cosine's scale
+        self.max_score = float("-inf")
+
+    def _ns(self, namespace):
+        if namespace not in self.namespaces:
+            self.namespaces[namespace] = {"ids": [], "pending": [], "metadata": [], "matrix": None, "positions": {}, "columns": {}, "postings": {}, "masks": {}, "sparse": {}, "sparse_values": [], "sparse_arrays": {}}
+        return self.namespaces[namespace]
+
+    def upsert(self, vectors, namespace="default"):
+        with self.lock:
+            ns = self._ns(namespace)
+            ns["columns"], ns["postings"], ns["masks"], ns["sparse_arrays"] = {}, {}, {}, {}
+            for vec in vectors:
+                sparse = None
+                if isinstance(vec, dict):
+                    vec_id, values, metadata, sparse = vec["id"], vec["values"], vec.get("metadata", {}), vec.get("sparse_values")
+                else:
+                    vec_id, values, metadata = vec[0], vec[1], (vec[2] if len(vec) > 2 else {})
+                if sparse is not None and self.metric != "dotproduct":
+                    raise ValueError("Sparse values are only supported by indexes with the dotproduct metric.")
+                values = np.asarray(values, dtype=np.float32)
+                if vec_id in ns["positions"]:
+                    # Overwrite in place, like Pinecone does for an existing ID
+                    self._flush(ns)
+                    pos = ns["positions"][vec_id]
+                    ns["matrix"][pos] = self._stored(values)
+                    ns["metadata"][pos] = metadata
+                    self._unindex_sparse(ns, pos)
+                else:
+                    pos = ns["positions"][vec_id] = len(ns["ids"])
+                    ns["ids"].append(vec_id)
+                    ns["pending"].append(values)
+                    ns["metadata"].append(metadata)
+                    ns["sparse_values"].append(None)
+                if sparse is not None:
+                    ns["sparse_values"][pos] = sparse
+                    for index, value in zip(sparse["indices"], sparse["values"]):
+                        ns["sparse"].setdefault(index, {})[pos] = value
+        return {"upserted_count": len(vectors)}
+
+    def _stored(self, values):
+        return values if self.metric == "dotproduct" else values / (np.linalg.norm(values, axis=-1, keepdims=True) + 1e-12)
+
+    def _unindex_sparse(self, ns, pos):
+        old = ns["sparse_values"][pos]
+        if old is not None:
+            for index in old["indices"]:
+                ns["sparse"].get(index, {}).pop(pos, None)
+            ns["sparse_values"][pos] = None
+
+    def _flush(self, ns):
+        if not ns["pending"]:
+            return
+        block = self._stored(np.vstack(ns["pending"]).astype(np.float32))
+        ns["matrix"] = block if ns["matrix"] is None else np.vstack([ns["matrix"], block])
+        ns["pending"] = []
+
+    def _column(self, ns, field):
+        if field not in ns["columns"]:
+            ns["columns"][field] = [m.get(field) for m in ns["metadata"]]
+        return ns["columns"][field]
+
+    def _postings(self, ns, field):
+        # Inverted index value -> positions, so $eq/$in cost is proportional to the matches
+        if field not in ns["postings"]:
+            postings = {}
+            for pos, value in enumerate(self._column(ns, field)):
+                for v in (value if isinstance(value, list) else [value]):
+                    if isinstance(v, (str, int, float, bool)):
+                        postings.setdefault(v, []).append(pos)
+            ns["postings"][field] = postings
+        return ns["postings"][field]
+
+    def _sparse_postings(self, ns, index):
+        # Positions and values of a sparse dimension as arrays, cached until the next upsert
+        if index not in ns["sparse_arrays"]:
+            postings = ns["sparse"].get(index, {})
+            ns["sparse_arrays"][index] = (np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                                          np.fromiter(postings.values(), dtype=np.float32, count=len(postings)))
+        return ns["sparse_arrays"][index]
+
+    def _mask(self, ns, flt):
+        n = len(ns["ids"])
+        mask = np.ones(n, dtype=bool)
+        for key, cond in flt.items():
+            if key == "$and":
+                for sub in cond:
+                    mask &= self._mask(ns, sub)
+                continue
+            if key == "$or":
+                mask &= np.logical_or.reduce([self._mask(ns, sub) for sub in cond])
+                continue
+            column = self._column(ns, key)
+            if not isinstance(cond, dict):
+                cond = {"$eq": cond}
+            for op, arg in cond.items():
+                if op in ("$in", "$nin", "$eq", "$ne") and not isinstance(arg, dict):
+                    postings = self._postings(ns, key)
+                    hit = np.zeros(n, dtype=bool)
+                    for value in (arg if op in ("$in", "$nin") else [arg]):
+                        hit[postings.get(value, [])] = True
+                    mask &= hit if op in ("$in", "$eq") else ~hit
+                else:
+                    compare = COMPARISONS[op]
+                    mask &= np.fromiter((any(x is not None and compare(x, arg) for x in (v if isinstance(v, list) else [v])) for v in column),
+                                        dtype=bool, count=n)
+        return mask
+
+    def query(self, vector, top_k=10, include_metadata=False, namespace="default", filter=None, sparse_vector=None, **kwargs):
+        with self.lock:
+            ns = self._ns(namespace)
+            self._flush(ns)
+            self.query_count += 1
+            mask = None
+            if filter:
+                # Masks are cached per filter until the next upsert, like a metadata index
+                key = json.dumps(filter, sort_keys=True, default=str)
+                if key not in ns["masks"]:
+                    ns["masks"][key] = self._mask(ns, filter)
+                mask = ns["masks"][key]
+        if ns["matrix"] is None:
+            return {"matches": [], "namespace": namespace}
+        if sparse_vector is not None and self.metric != "dotproduct":
+            raise ValueError("Sparse-dense queries are only supported by indexes with the dotproduct metric.")
+        q = self._stored(np.asarray(vector, dtype=np.float32))
+        scores = ns["matrix"] @ q
+        if sparse_vector is not None:
+            for index, weight in zip(sparse_vector["indices"], sparse_vector["values"]):
+                positions, values = self._sparse_postings(ns, index)
+                scores[positions] += weight * values
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        k = min(top_k, len(scores) if mask is None else int(mask.sum()))
+        if k <= 0:
+            return {"matches": [], "namespace": namespace}
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        self.max_score = max(self.max_score, float(scores[top[0]]))
+        matches = []
+        for pos in top:
+            match = {"id": ns["ids"][pos], "score": float(scores[pos])}
+            if include_metadata:
+                match["metadata"] = ns["metadata"][pos]
+                self.bytes_returned += sum(len(str(v).encode("utf-8")) for v in match["metadata"].values())
+            matches.append(match)
+        return {"matches": matches, "namespace": namespace}
+
+    def fetch(self, ids, namespace="default"):
+        with self.lock:
+            ns = self._ns(namespace)
+            self._flush(ns)
+            self.fetch_count += 1
+        vectors = {}
+        for vec_id in ids:
+            pos = ns["positions"].get(vec_id)
+            if pos is None:
+                continue
+            vectors[vec_id] = {"id": vec_id, "values": ns["matrix"][pos].tolist(), "metadata": ns["metadata"][pos]}
+            if ns["sparse_values"][pos] is not None:
+                vectors[vec_id]["sparse_values"] = ns["sparse_values"][pos]
+            self.bytes_returned += sum(len(str(v).encode("utf-8")) for v in ns["metadata"][pos].values())
+        return {"vectors": vectors, "namespace": namespace}
+
+    def update(self, id, set_metadata=None, namespace="default", **kwargs):
+        with self.lock:
+            ns = self._ns(namespace)
+            pos = ns["positions"].get(id)
+            if pos is not None and set_metadata:
+                ns["metadata"][pos] = {**ns["metadata"][pos], **set_metadata}
+                ns["columns"], ns["postings"], ns["masks"] = {}, {}, {}
+        return {}
+
+    def delete(self, ids, namespace="default"):
+        with self.lock:
+            ns = self._ns(namespace)
+            drop = {ns["positions"][vec_id] for vec_id in ids if vec_id in ns["positions"]}
+            if not drop:
+                return {}
+            self._flush(ns)
+            keep = [pos for pos in range(len(ns["ids"])) if pos not in drop]
+            sparse_values = [ns["sparse_values"][pos] for pos in keep]
+            ns.update(ids=[ns["ids"][pos] for pos in keep], metadata=[ns["metadata"][pos] for pos in keep],
+                      matrix=ns["matrix"][keep], sparse={}, sparse_values=sparse_values,
+                      columns={}, postings={}, masks={}, sparse_arrays={})
+            ns["positions"] = {vec_id: pos for pos, vec_id in enumerate(ns["ids"])}
+            for pos, sparse in enumerate(sparse_values):
+                if sparse is not None:
+                    for index, value in zip(sparse["indices"], sparse["values"]):
+                        ns["sparse"].setdefault(index, {})[pos] = value
+        return {}
+
+    def describe_index_stats(self):
+        return {
+            "dimension": self.dimension,
+            "namespaces": {name: {"vector_count": len(ns["ids"])} for name, ns in self.namespaces.items()},
+        }
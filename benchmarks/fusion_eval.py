@@ -0,0 +1,197 @@
+"""
+Offline eval of the candidate fusion (rag_server_*/fusion.py) on a golden
+set, against the previous max-score deduplication.
+
+The re-rank prompts are scored by an oracle LLM that knows the relevant item
+codes of each golden query, so the eval measures what fusion changes: how
+often the re-rank reaches a relevant candidate (recall) and how many LLM
+scoring calls it takes. Without --golden, the golden set is built from the
+synthetic corpus: a title with its last word dropped, relevant to every
+chunk with that title.
+
+    python -m benchmarks.fusion_eval --sources dei --size 10000
+    python -m benchmarks.fusion_eval --sources pat --corpus chunks.txt --golden golden_pat.jsonl
+
+A --golden file has one {"query": ..., "codes": [...]} object per line.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import importlib
+import tempfile
+import numpy as np
+
+from benchmarks.corpora import GENERATORS
+from benchmarks.fake_embedder import HashingEmbedder
+from benchmarks.fake_llm import FakeLLM
+from benchmarks.fake_pinecone import InMemoryIndex
+from benchmarks.harness import load_pipeline, ingest, run_query
+
+# Title of a synthetic chunk in each source format
+TITLE_PATTERNS = {
+    "pat": re.compile(r"^\S+ (.*?) Unit:"),
+    "piemonte": re.compile(r"Activity: (.*?) Work:"),
+    "dei": re.compile(r"Description: (.*?) Unit:"),
+}
+RELEVANT_SCORE = 95
+IRRELEVANT_SCORE = 40
+
+
+class OracleLLM(FakeLLM):
+    """
+    FakeLLM whose re-rank replies are RELEVANT_SCORE for activities that
+    contain one of the `relevant` codes and IRRELEVANT_SCORE otherwise.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.relevant = set()
+        self.found = False
+
+    def answer_question(self, query, task="site_visit", priority=None, cancel=None):
+        if not query.startswith("Is the following construction activity relevant"):
+            return super().answer_question(query, task, priority, cancel)
+        self._count("rerank")
+        # Codes are compared in normalized (upper) case, like the code index stores them
+        activity = query.split("Activity: '", 1)[-1].upper()
+        relevant = any(code.upper() in activity for code in self.relevant)
+        self.found = self.found or relevant
+        return json.dumps(str(RELEVANT_SCORE if relevant else IRRELEVANT_SCORE))
+
+
+def synthetic_golden(source, chunks, n, seed=0):
+    """
+    (query, relevant codes) pairs from the titles of random chunks.
+    """
+    from code_index import extract_codes
+    by_title = {}
+    for chunk in chunks:
+        match = TITLE_PATTERNS[source].search(chunk)
+        if match:
+            by_title.setdefault(match.group(1), []).extend(extract_codes(chunk, source))
+    rng = random.Random(seed)
+    golden = []
+    for title in rng.sample(sorted(by_title), min(n, len(by_title))):
+        words = title.split()
+        golden.append((" ".join(words[:-1]).lower(), by_title[title]))
+    return golden
+
+
+def load_golden(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [(item["query"], item["codes"]) for item in map(json.loads, f) if item.get("codes")]
+
+
+def previous_fuse(rankings):
+    # Max-score deduplication, as before fusion
+    from rerank import order_candidates
+    return order_candidates([pair for ranking in rankings for pair in ranking])
+
+
+CONFIGS = {
+    "max-score dedup": {"fuse": previous_fuse, "collapse": lambda source, candidates, *args, **kwargs: candidates, "MAX_CANDIDATES": None},
+    "rrf": {"collapse": lambda source, candidates, *args, **kwargs: candidates, "MAX_CANDIDATES": None},
+    "rrf + collapse": {"MAX_CANDIDATES": None},
+    "rrf + collapse + cap": {},
+}
+
+
+def evaluate(source, module, llm, golden, use_pinecone=True):
+    found, latencies, rerank_calls, llm_calls = 0, [], 0, 0
+    for query, codes in golden:
+        llm.reset()
+        llm.relevant = set(codes)
+        llm.found = False
+        start = time.perf_counter()
+        run_query(source, module, query, use_pinecone=use_pinecone)
+        latencies.append(time.perf_counter() - start)
+        found += llm.found
+        rerank_calls += llm.calls.get("rerank", 0)
+        llm_calls += llm.total_calls()
+    n = len(golden) or 1
+    return {
+        "recall": round(found / n, 3),
+        "rerank_calls_per_query": round(rerank_calls / n, 3),
+        "llm_calls_per_query": round(llm_calls / n, 3),
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3) if latencies else 0.0,
+    }
+
+
+def run(source, size, n_queries, seed=0, use_pinecone=True, corpus=None, golden_path=None):
+    llm = OracleLLM(seed=seed)
+    embedder = HashingEmbedder()
+    index = InMemoryIndex(dimension=embedder.dimension)
+    module = load_pipeline(source, llm, embedder, index)
+    # Every config searches each golden query afresh
+    module.get_semantic_cache = lambda source: None
+    if corpus:
+        with open(corpus, "r", encoding="utf-8") as f:
+            chunks = [line.rstrip("\n") for line in f if line.strip()]
+    else:
+        chunks = GENERATORS[source](size, seed=seed)
+    golden = load_golden(golden_path) if golden_path else synthetic_golden(source, chunks, n_queries, seed)
+    fusion = importlib.import_module("fusion")
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix=f"fusion_{source}_") as workdir:
+        os.chdir(workdir)
+        try:
+            ingest(source, module, chunks, embedder, workdir)
+            for name, overrides in CONFIGS.items():
+                saved = {attr: getattr(module, attr) for attr in ("fuse", "collapse", "MAX_CANDIDATES")}
+                for attr, value in overrides.items():
+                    setattr(module, attr, value)
+                try:
+                    result = evaluate(source, module, llm, golden, use_pinecone)
+                finally:
+                    for attr, value in saved.items():
+                        setattr(module, attr, value)
+                results.append({"source": source, "config": name, "queries": len(golden), **result})
+        finally:
+            os.chdir(cwd)
+    print(f"[Fusion] {source}: RRF k={fusion.RRF_K}, cap {fusion.MAX_CANDIDATES}, duplicate similarity {fusion.DUPLICATE_SIMILARITY}", file=sys.stderr)
+    return results
+
+
+def print_table(results):
+    header = f"{'source':<9} {'config':<22} {'queries':>7} {'recall':>7} {'rerank/q':>9} {'llm/q':>7} {'p50 ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['source']:<9} {r['config']:<22} {r['queries']:>7} {r['recall']:>7} {r['rerank_calls_per_query']:>9} "
+              f"{r['llm_calls_per_query']:>7} {r['p50_ms']:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sources", default="pat,piemonte,dei")
+    parser.add_argument("--size", type=int, default=10000, help="synthetic corpus size (chunks)")
+    parser.add_argument("--queries", type=int, default=100, help="synthetic golden queries per source")
+    parser.add_argument("--corpus", help="chunk file to search instead of the synthetic corpus (one source only)")
+    parser.add_argument("--golden", help="golden set JSONL of {query, codes} (one source only)")
+    parser.add_argument("--local", action="store_true", help="evaluate local hybrid retrieval instead of the Pinecone path")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    sources = [s.strip() for s in args.sources.split(",") if s.strip()]
+    if (args.corpus or args.golden) and len(sources) != 1:
+        parser.error("--corpus and --golden apply to a single source")
+    results = []
+    for source in sources:
+        print(f"[Fusion] Evaluating {source}...", file=sys.stderr)
+        results.extend(run(source, args.size, args.queries, seed=args.seed, use_pinecone=not args.local,
+                           corpus=args.corpus, golden_path=args.golden))
+    print_table(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import os
+import sys
+import types
+import importlib
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Keep the pipelines' per-query JSON log lines out of the measurements
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+SERVERS = {
+    "pat": {
+        "dir": "rag_server_pat",
+        "module": "rag_training",
+        "corpus_file": "chunks.txt",
+    },
+    "piemonte": {
+        "dir": "rag_server_piemonte",
+        "module": "rag_txt_chunk_pipeline",
+        "corpus_file": "all_chunks.txt",
+    },
+    "dei": {
+        "dir": "rag_server_dei",
+        "module": "rag_txt_chunk_pipeline_dei",
+        "corpus_file": "DEI_chunks.txt",
+    },
+}
+
+
+def install_fake_llm(llm, scheduler=None):
+    """
+    Registers a fake `mistral_utils` module so the servers never need
+    MISTRAL_API_KEY. The pipelines import answer_question at call time, so
+    swapping `llm` later only requires calling this again. With a
+    `scheduler` (llm_scheduler.LLMScheduler), calls go through it like the
+    real ones.
+    """
+    module = sys.modules.get("mistral_utils")
+    if module is None or not getattr(module, "is_fake", False):
+        module = types.ModuleType("mistral_utils")
+        module.is_fake = True
+        sys.modules["mistral_utils"] = module
+    module.answer_question = llm.answer_question
+    if scheduler is not None:
+        def answer_question(query, task="site_visit", priority=None, cancel=None):
+            return scheduler.call(task, query, lambda: llm.answer_question(query, task), priority=priority, cancel=cancel)
+        module.answer_question = answer_question
+    return module
+
+
+def load_pipeline(source, llm, embedder, index):
+    """
+    Imports the pipeline module of a source server with the LLM, the encoder
+    and the Pinecone index replaced by the given stand-ins. With
+    embedder=None the server keeps its real SentenceTransformer.
+    """
+    cfg = SERVERS[source]
+    server_dir = str(REPO_ROOT / cfg["dir"])
+    if server_dir not in sys.path:
+        sys.path.insert(0, server_dir)
+    # Only the simulated rate limit, if any: the benchmarks measure the pipelines, not Mistral's quota
+    scheduler = importlib.import_module("llm_scheduler").LLMScheduler(rpm=llm.rpm_limit or 0, tpm=0)
+    install_fake_llm(llm, scheduler)
+    module = importlib.import_module(cfg["module"])
+    if embedder is not None:
+        module.get_embedder = lambda: embedder
+        # rag_training's local loader uses its `embedder` global directly
+        if hasattr(module, "embedder"):
+            module.embedder = embedder
+    def get_pinecone_index(*args, metric=None, **kwargs):
+        # The uploader picks the metric when it creates the index; an existing one keeps its own
+        if metric is not None and not index.namespaces:
+            index.metric = metric
+        return index
+    module.get_pinecone_index = get_pinecone_index
+    module.index_metric = lambda index_name: index.metric
+    return module
+
+
+def ingest(source, module, chunks, embedder, workdir):
+    """
+    Writes the corpus file the server expects into `workdir` and uploads the
+    chunks through the server's own uploader, so index-time changes to the
+    upload format are benchmarked as well.
+    """
+    corpus_path = os.path.join(workdir, SERVERS[source]["corpus_file"])
+    with open(corpus_path, "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(chunk + "\n")
+    if source == "piemonte":
+        module.upload_chunks_to_pinecone(chunks)
+    else:
+        module.upload_chunks_to_pinecone(chunks, embedder.encode(chunks, convert_to_numpy=True))
+    return corpus_path
+
+
+def run_query(source, module, query, use_pinecone=True):
+    """
+    Calls the source's search pipeline the way its route does.
+    """
+    if source == "pat":
+        return module.rag_query(query, use_pinecone=use_pinecone)
+    if source == "piemonte":
+        return module.embed_and_retrieve(query, all_chunks_file=SERVERS[source]["corpus_file"], use_pinecone=use_pinecone)
+    return module.embed_and_retrieve_dei(query, all_chunks_file=SERVERS[source]["corpus_file"], use_pinecone=use_pinecone)
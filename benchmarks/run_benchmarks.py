@@ -0,0 +1,171 @@
+"""
+Offline performance benchmarks for rag_query, embed_and_retrieve and
+embed_and_retrieve_dei, using a fake LLM, an in-memory Pinecone index and
+synthetic corpora. Needs no credentials or network.
+
+    python -m benchmarks.run_benchmarks --sizes 10000 --check
+
+Exits with status 1 when --check is given and a result regresses against
+benchmarks/baseline.json.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from benchmarks.corpora import GENERATORS, queries as make_queries
+from benchmarks.fake_embedder import HashingEmbedder
+from benchmarks.fake_llm import FakeLLM
+from benchmarks.fake_pinecone import InMemoryIndex
+from benchmarks.harness import load_pipeline, ingest, run_query
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def benchmark(source, size, n_queries=50, concurrency=1, llm_latency=0.0, seed=0, use_pinecone=True):
+    llm = FakeLLM(latency=llm_latency, seed=seed)
+    embedder = HashingEmbedder()
+    index = InMemoryIndex(dimension=embedder.dimension)
+    module = load_pipeline(source, llm, embedder, index)
+    chunks = GENERATORS[source](size, seed=seed)
+    queries = make_queries(n_queries, seed=seed)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix=f"bench_{source}_") as workdir:
+        os.chdir(workdir)
+        try:
+            start = time.perf_counter()
+            ingest(source, module, chunks, embedder, workdir)
+            ingest_seconds = time.perf_counter() - start
+            del chunks
+            # Warm-up: lazy loads and first-call costs are not part of steady state
+            run_query(source, module, queries[0], use_pinecone=use_pinecone)
+            llm.reset()
+            index.query_count = 0
+            index.fetch_count = 0
+            index.bytes_returned = 0
+            index.max_score = float("-inf")
+
+            def timed(q):
+                t0 = time.perf_counter()
+                run_query(source, module, q, use_pinecone=use_pinecone)
+                return time.perf_counter() - t0
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                latencies = list(executor.map(timed, queries))
+            wall = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    return {
+        "source": source,
+        "size": size,
+        "queries": n_queries,
+        "concurrency": concurrency,
+        "ingest_seconds": round(ingest_seconds, 3),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "throughput_qps": round(n_queries / wall, 3),
+        "llm_calls_per_query": round(llm.total_calls() / n_queries, 3),
+        "llm_calls_by_kind": {k: round(v / n_queries, 3) for k, v in sorted(llm.calls.items())},
+        "index_queries_per_query": round((index.query_count + index.fetch_count) / n_queries, 3),
+        "kb_returned_per_query": round(index.bytes_returned / n_queries / 1024, 3),
+        "max_score": round(index.max_score, 4),
+    }
+
+
+def check_regressions(results, baseline, tolerance):
+    """
+    Latency and throughput may drift by `tolerance` (machines differ); the
+    call counts are deterministic and must not grow at all. Index scores,
+    hybrid ones included, must stay on the cosine's scale (at most 1).
+    """
+    failures = []
+    for r in results:
+        key = f"{r['source']}@{r['size']}"
+        if r["max_score"] > 1 + 1e-6:
+            failures.append(f"{key}: index score {r['max_score']} > 1")
+        base = baseline.get(key)
+        if not base:
+            continue
+        if r["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            failures.append(f"{key}: p95 {r['p95_ms']} ms > baseline {base['p95_ms']} ms (+{tolerance:.0%})")
+        if r["throughput_qps"] < base["throughput_qps"] * (1 - tolerance):
+            failures.append(f"{key}: throughput {r['throughput_qps']} q/s < baseline {base['throughput_qps']} q/s (-{tolerance:.0%})")
+        for field in ("llm_calls_per_query", "index_queries_per_query"):
+            if r[field] > base[field] + 1e-9:
+                failures.append(f"{key}: {field} {r[field]} > baseline {base[field]}")
+    return failures
+
+
+def print_table(results):
+    header = f"{'source':<9} {'chunks':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'q/s':>9} {'llm/q':>7} {'idx/q':>7} {'KB/q':>8} {'ingest s':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['source']:<9} {r['size']:>9} {r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} {r['throughput_qps']:>9} "
+              f"{r['llm_calls_per_query']:>7} {r['index_queries_per_query']:>7} {r['kb_returned_per_query']:>8} {r['ingest_seconds']:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sources", default="pat,piemonte,dei")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated corpus sizes (chunks)")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds slept per fake LLM call")
+    parser.add_argument("--local", action="store_true", help="benchmark local hybrid retrieval instead of the Pinecone path")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--check", action="store_true", help="exit 1 on regressions against the baseline")
+    parser.add_argument("--tolerance", type=float, default=None, help="allowed latency/throughput drift (default: from baseline file)")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the new baseline")
+    args = parser.parse_args(argv)
+
+    results = []
+    for source in [s.strip() for s in args.sources.split(",") if s.strip()]:
+        for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            print(f"[Bench] {source} with {size} chunks...", file=sys.stderr)
+            results.append(benchmark(source, size, n_queries=args.queries, concurrency=args.concurrency,
+                                     llm_latency=args.llm_latency, seed=args.seed, use_pinecone=not args.local))
+    print_table(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    baseline = {"tolerance": 0.5, "results": {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    if args.update_baseline:
+        for r in results:
+            baseline["results"][f"{r['source']}@{r['size']}"] = {
+                k: r[k] for k in ("p95_ms", "throughput_qps", "llm_calls_per_query", "index_queries_per_query")
+            }
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"[Bench] Baseline written to {args.baseline}", file=sys.stderr)
+    if args.check:
+        tolerance = args.tolerance if args.tolerance is not None else baseline.get("tolerance", 0.5)
+        failures = check_regressions(results, baseline.get("results", {}), tolerance)
+        if failures:
+            print("\n[Bench] Regressions:", file=sys.stderr)
+            for failure in failures:
+                print(f"  - {failure}", file=sys.stderr)
+            return 1
+        print("[Bench] No regressions against baseline.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""
+FastAPI apps of the source servers with stubbed backends, for load testing.
+
+`build_app()` returns the real `routes.app` of a server after replacing
+Mistral, the vector index and (optionally) the encoder with the benchmark
+stand-ins and ingesting a synthetic corpus. For uvicorn, the module exposes
+`app`, configured from environment variables so every worker process builds
+its own copy, exactly like the real servers:
+
+    BENCH_SERVER=dei BENCH_CHUNKS=10000 uvicorn benchmarks.stub_app:app --workers 4
+
+Environment: BENCH_SERVER (pat, piemonte, dei, all), BENCH_CHUNKS,
+BENCH_LLM_LATENCY (seconds per LLM call), BENCH_LLM_RPM (simulated rate
+limit), BENCH_LOCAL=1 (local hybrid retrieval with BM25 instead of the
+vector index), BENCH_REAL_ENCODER=1 (load the real SentenceTransformer),
+BENCH_SEED.
+"""
+import os
+import sys
+import importlib
+import tempfile
+
+from benchmarks.corpora import GENERATORS
+from benchmarks.fake_embedder import HashingEmbedder
+from benchmarks.fake_llm import FakeLLM
+from benchmarks.fake_pinecone import InMemoryIndex
+from benchmarks.harness import REPO_ROOT, SERVERS, install_fake_llm, load_pipeline, ingest
+
+def build_app(server, chunks=10000, llm_latency=0.0, rpm_limit=None, local=False, real_encoder=False, seed=0):
+    llm = FakeLLM(latency=llm_latency, seed=seed, rpm_limit=rpm_limit)
+    install_fake_llm(llm)
+    embedder = HashingEmbedder()
+    workdir = tempfile.mkdtemp(prefix=f"loadtest_{server}_")
+    sources = list(SERVERS) if server == "all" else [server]
+    indexes = {}
+    os.chdir(workdir)
+    for source in sources:
+        index = InMemoryIndex(dimension=embedder.dimension)
+        module = load_pipeline(source, llm, None if real_encoder else embedder, index)
+        ingest(source, module, GENERATORS[source](chunks, seed=seed), module.get_embedder(), workdir)
+        indexes[source] = index
+    server_dir = str(REPO_ROOT / ("rag_server_all" if server == "all" else SERVERS[server]["dir"]))
+    # Every server has a routes.py: make sure this server's one is imported
+    if server_dir in sys.path:
+        sys.path.remove(server_dir)
+    sys.path.insert(0, server_dir)
+    sys.modules.pop("routes", None)
+    routes = importlib.import_module("routes")
+    if server == "all":
+        import federated_search
+        if not real_encoder:
+            federated_search.embedder_global = embedder
+        for source, index in indexes.items():
+            federated_search.pinecone_indexes[federated_search.SOURCES[source]["index_name"]] = index
+    elif local:
+        # Routes read LOCAL_SEARCH at call time
+        routes.LOCAL_SEARCH = True
+    routes.app.state.fake_llm = llm
+    return routes.app
+
+
+def app_from_env():
+    return build_app(
+        os.environ.get("BENCH_SERVER", "pat"),
+        chunks=int(os.environ.get("BENCH_CHUNKS", "10000")),
+        llm_latency=float(os.environ.get("BENCH_LLM_LATENCY", "0")),
+        rpm_limit=int(os.environ["BENCH_LLM_RPM"]) if os.environ.get("BENCH_LLM_RPM") else None,
+        local=os.environ.get("BENCH_LOCAL") == "1",
+        real_encoder=os.environ.get("BENCH_REAL_ENCODER") == "1",
+        seed=int(os.environ.get("BENCH_SEED", "0")),
+    )
+
+
+def __getattr__(name):
+    # Built on first access so importing this module for build_app() is cheap
+    if name == "app":
+        globals()["app"] = app_from_env()
+        return globals()["app"]
+    raise AttributeError(name)
@@ -0,0 +1,223 @@
+"""
+Site visit notes to a priced bill of quantities (BOQ) in one request.
+
+Mistral's site_visit task plans the notes into a Works list (Area, Subarea,
+Item, Unit, Quantity). Every work is then searched in the selected price
+lists and its candidate items re-ranked with the LLM, BOQ_CONCURRENCY works
+at a time and within one shared time budget. The best item of each work
+becomes a BOQ row priced as quantity x unit price, with the fields of the
+boq_items table in shared/schema.ts.
+"""
+import os
+import re
+import json
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from metrics import get_logger, stage_timer
+from rerank import Deadline, rerank
+from chunk_store import get_chunk_store, normalize_unit, stored_records, vector_position
+from dedup import load_dedup_index
+from federated_search import search_all, SOURCES, SOURCE
+
+logger = get_logger(SOURCE)
+
+# Works searched and re-ranked at the same time
+BOQ_CONCURRENCY = int(os.getenv("BOQ_CONCURRENCY", "8"))
+# Time for the whole job, planning included; works still being re-ranked then keep their best item so far
+BOQ_BUDGET_SECONDS = float(os.getenv("BOQ_BUDGET_SECONDS", "120"))
+# Candidate items re-ranked per work, in retrieval order; 0 re-ranks all
+MAX_CANDIDATES = int(os.getenv("RERANK_MAX_CANDIDATES", "10")) or None
+RERANK_THRESHOLD = 85
+# Keys the site_visit reply may name a work with, in order of preference
+WORK_KEYS = ("Work", "Activity", "Name", "Description", "Item")
+NUMBER = re.compile(r"-?\d[\d.,]*")
+
+
+def to_number(value):
+    """
+    First number in `value` ("12,5 m2" -> 12.5, "1.234,50" -> 1234.5), or None.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = NUMBER.search(str(value or ""))
+    if match is None:
+        return None
+    text = match.group().rstrip(".,")
+    if "," in text:
+        text = text.replace(".", "").replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def parse_plan(reply):
+    """
+    The site_visit reply as a dict. answer_question returns the model's text
+    JSON-encoded, possibly wrapped in a code block despite the prompt.
+    """
+    text = reply
+    try:
+        decoded = json.loads(reply)
+        if isinstance(decoded, dict):
+            return decoded
+        if isinstance(decoded, str):
+            text = decoded
+    except (TypeError, ValueError):
+        pass
+    start, end = str(text).find("{"), str(text).rfind("}")
+    if start < 0 or end < start:
+        raise ValueError("The site visit plan is not a JSON object.")
+    return json.loads(text[start:end + 1])
+
+
+def work_description(work):
+    if isinstance(work, str):
+        return work.strip()
+    for key in WORK_KEYS:
+        if isinstance(work.get(key), str) and work[key].strip():
+            return work[key].strip()
+    return ""
+
+
+def with_members(hits):
+    """
+    Search hits, each followed by the near-duplicates its source collapsed
+    into it at upload, read from the source's chunk store. Variants differ
+    in their price, so every one of them is a candidate item.
+    """
+    expanded = []
+    for hit in hits:
+        expanded.append(hit)
+        if hit["source"] not in SOURCES:
+            continue
+        dedup = load_dedup_index(SOURCES[hit["source"]]["dedup"], SOURCE)
+        store = get_chunk_store(SOURCES[hit["source"]]["store"])
+        members = dedup.members.get(vector_position(hit["id"]), []) if dedup is not None and store is not None else []
+        if not members:
+            continue
+        # Members have no vector: their text is only in the store
+        records = stored_records(store, members, SOURCES[hit["source"]]["parse"], store.get_many)
+        expanded.extend({"source": hit["source"], "id": f"chunk_{pos}", "results": results} for pos, results in zip(members, records))
+    return expanded
+
+
+def priced_items(hits):
+    """
+    Priced items of federated search hits, in ranking order: a PAT analysis
+    is priced as a whole (its application price), Piemonte and DEI chunks by
+    each of their items.
+    """
+    items = []
+    for hit in hits:
+        for activity in hit["results"]:
+            summary = activity.get("summary") or {}
+            if summary.get("application_price") is not None:
+                # An analysis is priced as a whole or not at all, even when its price does not parse
+                price = to_number(summary["application_price"])
+                if price is not None:
+                    items.append({"code": activity.get("code", ""), "description": activity.get("title", ""), "unit": activity.get("unit", ""),
+                                  "unitPrice": price, "priceSource": hit["source"]})
+                continue
+            for resource in activity.get("resources", []):
+                price = to_number(resource.get("price"))
+                if price is None:
+                    continue
+                # A Piemonte Work is only meaningful under its activity
+                description = resource.get("description", "")
+                if activity.get("title"):
+                    description = f"{activity['title']} - {description}"
+                items.append({"code": resource.get("code", ""), "description": description, "unit": resource.get("unit", ""),
+                              "unitPrice": price, "priceSource": hit["source"]})
+    return items
+
+
+def price_work(work, sources, deadline, top_k=5):
+    """
+    BOQ row for one work of the plan: its best item by LLM re-rank among the
+    search results, priced by the work's quantity.
+    """
+    from mistral_utils import answer_question
+    description = work_description(work)
+    details = work if isinstance(work, dict) else {}
+    unit = normalize_unit(str(details.get("Unit") or "")) or None
+    quantity = to_number(details.get("Quantity"))
+    row = {"work": description, "area": details.get("Area"), "subarea": details.get("Subarea"), "item": details.get("Item"),
+           "quantity": quantity, "unit": unit}
+    if not description:
+        return {**row, "error": "The work has no description."}
+    timings = {}
+    start = time.perf_counter()
+    # Items in the work's unit first; without any, any unit
+    found = search_all(description, top_k=top_k, sources=sources, filter={"unit": unit} if unit else None)
+    if unit and not found.get("results"):
+        found = search_all(description, top_k=top_k, sources=sources)
+    timings["search"] = time.perf_counter() - start
+    if found.get("errors"):
+        row["errors"] = found["errors"]
+    # Search results are cluster representatives; their variants are priced too
+    items = priced_items(with_members(found.get("results", [])))
+    items.sort(key=lambda item: unit is not None and normalize_unit(item["unit"]) != unit)
+    if not items:
+        return {**row, "error": "No priced item found.", "timings": {k: round(v, 4) for k, v in timings.items()}}
+    start = time.perf_counter()
+    candidates = list(range(len(items)))[:MAX_CANDIDATES]
+    texts = {i: f"{items[i]['code']} {items[i]['description']} ({items[i]['unit']})" for i in candidates}
+    accuracy, best, _, calls = rerank(description, candidates, answer_question, SOURCE, RERANK_THRESHOLD, deadline, texts=texts)
+    timings["rerank"] = time.perf_counter() - start
+    if best is None:
+        # Out of time before any score: the best retrieved item
+        best, accuracy = 0, None
+    item = items[best]
+    unit_mismatch = unit is not None and normalize_unit(item["unit"]) != unit
+    total = round(quantity * item["unitPrice"], 2) if quantity is not None and not unit_mismatch else None
+    logger.info(f"[BOQ] {description}: {item['priceSource']} {item['code']} (accuracy {accuracy}, {calls} re-rank calls)")
+    return {**row, "code": item["code"], "description": item["description"], "unit": unit or normalize_unit(item["unit"]),
+            "unitPrice": item["unitPrice"], "total": total, "priceSource": item["priceSource"], "accuracy": accuracy,
+            "unitMismatch": unit_mismatch, "rerankCalls": calls, "timings": {k: round(v, 4) for k, v in timings.items()}}
+
+
+def site_visit_boq(notes, sources=None, budget=None, top_k=5):
+    """
+    Plans the site visit notes and prices every work concurrently. Returns
+    the BOQ rows with their total, the plan's Missing and GeneralTimeline,
+    and timings in seconds: planning, pricing (wall time) and total, plus
+    search and re-rank per row.
+    """
+    from mistral_utils import answer_question
+    deadline = Deadline(BOQ_BUDGET_SECONDS if budget is None else budget)
+    timings = {}
+    total_start = time.perf_counter()
+    start = time.perf_counter()
+    with stage_timer(SOURCE, "site_visit"):
+        reply = answer_question(notes, task="site_visit")
+    timings["site_visit"] = time.perf_counter() - start
+    if isinstance(reply, dict) and "error" in reply:
+        return reply
+    plan = parse_plan(reply)
+    works = plan.get("Works") or []
+    logger.info(f"[BOQ] Pricing {len(works)} works from the site visit plan")
+
+    def price(work):
+        try:
+            return price_work(work, sources, deadline, top_k)
+        except Exception as e:
+            return {"work": work_description(work), "error": str(e)}
+
+    start = time.perf_counter()
+    rows = []
+    if works:
+        with ThreadPoolExecutor(max_workers=min(BOQ_CONCURRENCY, len(works))) as executor:
+            # copy_context keeps the request ID on log lines written by the worker threads
+            rows = list(executor.map(lambda work: contextvars.copy_context().run(price, work), works))
+    timings["pricing"] = time.perf_counter() - start
+    timings["total"] = time.perf_counter() - total_start
+    return {
+        "rows": rows,
+        "total": round(sum(row.get("total") or 0.0 for row in rows), 2),
+        "missing": plan.get("Missing", []),
+        "timeline": plan.get("GeneralTimeline", []),
+        "timings": {k: round(v, 4) for k, v in timings.items()},
+        "degraded": deadline.degraded,
+    }
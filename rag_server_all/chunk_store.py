@@ -0,0 +1,156 @@
+"""
+Local keyed store for full chunk text and parsed records.
+
+The vector index only carries each chunk's ID (chunk_<i>) and a few small
+filterable fields; the uploader writes the full text here, in a SQLite file
+keyed by the chunk position i, together with the chunk's parsed activities
+(JSON), so searches look both up by ID instead of parsing at query time.
+"""
+import os
+import json
+import sqlite3
+import operator
+import threading
+
+# Same spellings of square and cubic metres are used across price lists
+UNIT_ALIASES = {"m2": "m²", "mq": "m²", "m3": "m³", "mc": "m³"}
+COMPARISONS = {"$eq": operator.eq, "$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le}
+
+
+def normalize_unit(unit):
+    unit = (unit or "").strip().rstrip(".")
+    return UNIT_ALIASES.get(unit.lower(), unit)
+
+
+def vector_position(vector_id):
+    return int(str(vector_id).rsplit("_", 1)[-1])
+
+
+class ChunkStore:
+    def __init__(self, path):
+        self.path = path
+        # sqlite3 connections cannot be shared between the threadpool's threads
+        self.local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, text TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self.local.conn = conn
+        return conn
+
+    def write(self, chunks, start=0, records=None):
+        """
+        Stores chunks at positions start, start+1, ... and, when given, their
+        parsed records (one list of activities per chunk). Writing from
+        position 0 replaces the whole store, like a full upload replaces the index.
+        """
+        conn = self._connection()
+        with conn:
+            if start == 0:
+                conn.execute("DELETE FROM chunks")
+                conn.execute("DELETE FROM records")
+            conn.executemany("INSERT OR REPLACE INTO chunks (id, text) VALUES (?, ?)",
+                             ((start + i, chunk) for i, chunk in enumerate(chunks)))
+            if records is not None:
+                conn.executemany("INSERT OR REPLACE INTO records (id, data) VALUES (?, ?)",
+                                 ((start + i, json.dumps(r, ensure_ascii=False, separators=(",", ":"))) for i, r in enumerate(records)))
+
+    def _select(self, table, column, positions, batch_size=500):
+        positions = [int(p) for p in positions]
+        found = {}
+        conn = self._connection()
+        for i in range(0, len(positions), batch_size):
+            batch = positions[i:i+batch_size]
+            rows = conn.execute(f"SELECT id, {column} FROM {table} WHERE id IN ({','.join('?' * len(batch))})", batch)
+            found.update(rows.fetchall())
+        return [found.get(p) for p in positions]
+
+    def get_many(self, positions):
+        """
+        Texts for the given positions, in order; None where a chunk is missing.
+        """
+        return self._select("chunks", "text", positions)
+
+    def get_records(self, positions):
+        """
+        Parsed records for the given positions, in order; None where the
+        uploader wrote none.
+        """
+        return [json.loads(data) if data is not None else None for data in self._select("records", "data", positions)]
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+
+_stores = {}
+
+
+def get_chunk_store(path, create=False):
+    """
+    Store at `path`, or None when it does not exist yet (indexes uploaded with
+    the full text in metadata) unless `create` is set.
+    """
+    # Keyed by absolute path, so a different working directory gets its own store
+    path = os.path.abspath(path)
+    if not create and not os.path.exists(path):
+        return None
+    if path not in _stores:
+        _stores[path] = ChunkStore(path)
+    return _stores[path]
+
+
+def hit_texts(hits, store):
+    """
+    Chunk texts for vector matches: from the store by ID, or from the `chunk`
+    metadata field of vectors uploaded with the full text.
+    """
+    texts = store.get_many([vector_position(hit['id']) for hit in hits]) if store is not None else [None] * len(hits)
+    return [text if text is not None else (hit.get('metadata') or {}).get('chunk', hit['id']) for hit, text in zip(hits, texts)]
+
+
+def stored_records(store, positions, parse, texts_at):
+    """
+    Parsed records per position: read from the store, and parsed from the
+    chunk text (`texts_at(positions)`) only where the store has none.
+    """
+    records = store.get_records(positions) if store is not None else [None] * len(positions)
+    missing = [p for p, r in zip(positions, records) if r is None]
+    if missing:
+        parsed = {p: parse(text) for p, text in zip(missing, texts_at(missing)) if text is not None}
+        records = [r if r is not None else parsed.get(p, []) for p, r in zip(positions, records)]
+    return records
+
+
+def matches_filter(metadata, flt):
+    """
+    Evaluates a Pinecone metadata filter against one metadata dict, for
+    searches that run locally. List values match if any element does.
+    """
+    for key, cond in flt.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, sub) for sub in cond):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches_filter(metadata, sub) for sub in cond):
+                return False
+            continue
+        value = metadata.get(key)
+        values = value if isinstance(value, list) else [value]
+        if not isinstance(cond, dict):
+            cond = {"$eq": cond}
+        for op, arg in cond.items():
+            if op == "$in":
+                ok = any(v in arg for v in values)
+            elif op == "$nin":
+                ok = not any(v in arg for v in values)
+            elif op == "$ne":
+                ok = arg not in values
+            else:
+                ok = any(v is not None and COMPARISONS[op](v, arg) for v in values)
+            if not ok:
+                return False
+    return True
@@ -0,0 +1,256 @@
+import os
+import re
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+from pinecone import Pinecone
+from parse_activity_chunks import parse_activity_chunks
+from parse_source_chunks import parse_piemonte_chunk, parse_dei_chunk
+from metrics import get_logger, stage_timer, record_cache
+from query_expansion import expand_query
+from speculation import Speculation
+from semantic_cache import get_semantic_cache, cache_context
+from chunk_store import get_chunk_store, hit_texts, stored_records, vector_position
+from sparse_encoder import load_sparse_encoder, hybrid_query
+
+load_dotenv()
+
+SOURCE = "all"
+logger = get_logger(SOURCE)
+
+# Every source server encodes its chunks with the same model, so one query
+# embedding can be sent to all three Pinecone indexes. Parsed records are read
+# from the chunk store each source server writes when uploading; `parse` only
+# runs for chunks uploaded without one. The BM25 sparse part of each query is
+# encoded with the statistics of its source's upload (`sparse`). `price_diff`
+# is written by price_diff.py when a new Prezziario version is uploaded;
+# `dedup` by the source server's upload, with the near-duplicates collapsed
+# into each uploaded vector.
+SOURCES = {
+    "pat": {
+        "index_name": "pat-chunks",
+        "store": "chunk_store_pat.sqlite",
+        "sparse": "sparse_encoder_pat.json",
+        "price_diff": "price_diff_pat.json",
+        "dedup": "dedup_index_pat.npz",
+        "parse": lambda chunk: parse_activity_chunks([chunk]),
+    },
+    "piemonte": {
+        "index_name": "piemonte-chunks",
+        "store": "chunk_store_piemonte.sqlite",
+        "sparse": "sparse_encoder_piemonte.json",
+        "price_diff": "price_diff_piemonte.json",
+        "dedup": "dedup_index_piemonte.npz",
+        "parse": parse_piemonte_chunk,
+    },
+    "dei": {
+        "index_name": "dei-chunks",
+        "store": "chunk_store_dei.sqlite",
+        "sparse": "sparse_encoder_dei.json",
+        "price_diff": "price_diff_dei.json",
+        "dedup": "dedup_index_dei.npz",
+        "parse": parse_dei_chunk,
+    },
+}
+
+# Scores of the merged ranking, the cosine's range (bounded hybrid scores included)
+SCORE_RANGE = (0.0, 1.0)
+
+# Built from activity_keywords.txt on first use; the source servers add their titles to their own
+EXPANSION_INDEX_PATH = "expansion_index_all.npz"
+
+embedder_global = None
+def get_embedder():
+    global embedder_global
+    if embedder_global is None:
+        from sentence_transformers import SentenceTransformer
+        embedder_global = SentenceTransformer('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+    return embedder_global
+
+# Index handles are reused across requests: creating a client and listing the
+# indexes costs a round trip per source.
+pinecone_indexes = {}
+def get_pinecone_index(index_name):
+    record_cache(SOURCE, "pinecone_index", hit=index_name in pinecone_indexes)
+    if index_name not in pinecone_indexes:
+        api_key = os.getenv("PINECONE_API_KEY")
+        if not api_key:
+            raise RuntimeError("PINECONE_API_KEY not set in environment.")
+        pc = Pinecone(api_key=api_key)
+        if index_name not in pc.list_indexes().names():
+            raise RuntimeError(f"Pinecone index '{index_name}' not found. Upload it from its source server first.")
+        pinecone_indexes[index_name] = pc.Index(index_name)
+    return pinecone_indexes[index_name]
+
+def refine_query(query, cancel=None):
+    """
+    Runs the Mistral category refinement once for all sources and returns the
+    list of synonym queries, falling back to the original query if Mistral
+    fails. `cancel` drops the call if it is set before the call is sent.
+    """
+    try:
+        from mistral_utils import answer_question
+        refined_query = answer_question(f"Define the construction activity category in italian that describes it best in Prezziario with one to max 10 words, exclude any other commentary, for: {query}", task="refine", cancel=cancel)
+    except Exception as e:
+        logger.warning(f"[Federated] Mistral exception: {e}. Using original query.")
+        return [query]
+    if isinstance(refined_query, dict) and ("error" in refined_query or "rate limit" in str(refined_query).lower()):
+        logger.warning("[Federated] Mistral failed or rate limit exceeded, using original query.")
+        return [query]
+    if not isinstance(refined_query, str):
+        return [str(refined_query)]
+    queries = [q.strip().strip('"').strip() for q in re.split(r'[\n,;]+', refined_query)]
+    queries = [q for q in queries if q]
+    return queries or [query]
+
+def search_source(source, queries, query_embs, top_k=5, namespace="default", filter=None):
+    """
+    Queries one source index with every encoded synonym and keeps the best
+    score per chunk. Returns (hits, seconds).
+    """
+    start = time.perf_counter()
+    index = get_pinecone_index(SOURCES[source]["index_name"])
+    # Without a chunk store (older uploads) the text is in the vector metadata
+    store = get_chunk_store(SOURCES[source]["store"])
+    # Dense and BM25 sparse vector in one query, when the source was uploaded with both
+    encoder = load_sparse_encoder(SOURCES[source]["sparse"], SOURCE)
+    best = {}
+    for query, query_emb in zip(queries, query_embs):
+        # Labelled with the searched source so per-index latency can be compared
+        with stage_timer(source, "vector_query"):
+            result = index.query(**hybrid_query(query_emb, query, encoder), top_k=top_k, include_metadata=store is None, namespace=namespace, filter=filter)
+        for hit in result.get('matches', []):
+            if hit['id'] not in best or hit['score'] > best[hit['id']]['raw_score']:
+                best[hit['id']] = {"source": source, "id": hit['id'], "raw_score": hit['score'], "metadata": hit.get('metadata')}
+    hits = list(best.values())
+    by_position = {vector_position(hit["id"]): hit for hit in hits}
+    def texts_at(positions):
+        return hit_texts([by_position[p] for p in positions], store)
+    with stage_timer(source, "parse"):
+        records = stored_records(store, list(by_position), SOURCES[source]["parse"], texts_at)
+    for hit, results in zip(by_position.values(), records):
+        del hit["metadata"]
+        hit["results"] = results
+    return hits, time.perf_counter() - start
+
+def fan_out(queries, sources, top_k, filter, hits, errors, timings):
+    """
+    Encodes `queries` once and searches every source index in parallel,
+    keeping the best hit per chunk in `hits` (source -> id -> hit). Failed
+    sources are moved to `errors` and not searched again.
+    """
+    start = time.perf_counter()
+    with stage_timer(SOURCE, "encode"):
+        query_embs = get_embedder().encode(queries, convert_to_numpy=True)
+    timings["encode"] = timings.get("encode", 0.0) + time.perf_counter() - start
+    sources = [source for source in sources if source not in errors]
+    if not sources:
+        return
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        # copy_context keeps the request ID on log lines written by the worker threads
+        futures = {executor.submit(contextvars.copy_context().run, search_source, source, queries, query_embs, top_k, "default", filter): source for source in sources}
+        for future in as_completed(futures):
+            source = futures[future]
+            try:
+                found, seconds = future.result()
+            except Exception as e:
+                logger.warning(f"[Federated] {source} search failed: {e}")
+                errors[source] = str(e)
+                hits.pop(source, None)
+                continue
+            timings[source] = timings.get(source, 0.0) + seconds
+            best = hits.setdefault(source, {})
+            for hit in found:
+                if hit["id"] not in best or hit["raw_score"] > best[hit["id"]]["raw_score"]:
+                    best[hit["id"]] = hit
+
+def normalize_scores(hits):
+    # Every source scores on the cosine scale, so all share one fixed range: per-source min-max would
+    # give a source's only hit 1.0 however weak it is. Hybrid scores stay in it because the source
+    # servers bound each chunk's sparse weights (sparse_encoder.py); the clip only guards older
+    # uploads, and search_all ranks clipped ties by raw_score
+    for h in hits:
+        h["score"] = min(max(h["raw_score"], SCORE_RANGE[0]), SCORE_RANGE[1])
+    return hits
+
+def search_all(query, top_k=5, sources=None, filter=None):
+    """
+    Federated search over the PAT, Piemonte and DEI indexes: one refinement,
+    one encoding, then a parallel fan-out to every source index. When Mistral
+    has to refine the query, the raw query is searched meanwhile, and a
+    confident raw hit cancels the refinement. `filter` is a
+    Pinecone metadata filter on the compact fields (code, unit, price,
+    category, source_year). Returns a merged, source-tagged ranking with
+    per-source timings in seconds.
+    """
+    sources = sources or list(SOURCES)
+    timings = {}
+    total_start = time.perf_counter()
+
+    # Near-duplicates of a recent query reuse its results, or at least its refinement
+    cache = get_semantic_cache(SOURCE)
+    lookup = None
+    if cache is not None:
+        start = time.perf_counter()
+        with stage_timer(SOURCE, "semantic_cache"):
+            lookup = cache.lookup(get_embedder(), query, cache_context(filter=filter, sources=sorted(sources), top_k=top_k))
+        timings["semantic_cache"] = time.perf_counter() - start
+        if lookup.result is not None:
+            timings["total"] = time.perf_counter() - total_start
+            return {**lookup.result, "timings": {k: round(v, 4) for k, v in timings.items()}, "cached": True}
+
+    queries = lookup.refinement if lookup is not None else None
+    speculation = None
+    if queries is None:
+        start = time.perf_counter()
+        with stage_timer(SOURCE, "expand"):
+            queries = expand_query(query, EXPANSION_INDEX_PATH, SOURCE, get_embedder())
+        timings["expand"] = time.perf_counter() - start
+    if queries is None:
+        # Mistral refines the query while the raw query is encoded and searched
+        speculation = Speculation(SOURCE, lambda cancel: refine_query(query, cancel))
+
+    hits = {}
+    errors = {}
+    if speculation is not None:
+        fan_out([query], sources, top_k, filter, hits, errors, timings)
+        # Pinecone scores are cosine similarities, or hybrid scores on the same scale
+        best = max((hit["raw_score"] for found in hits.values() for hit in found.values()), default=0.0)
+        if speculation.settle(best):
+            queries = [query]
+        else:
+            start = time.perf_counter()
+            with stage_timer(SOURCE, "refine"):
+                queries = speculation.result()
+            timings["refine"] = time.perf_counter() - start
+    logger.info(f"[Federated] Refined query/categories: {queries}")
+    # The raw query's hits are merged with those of the refined queries
+    pending = [q for q in queries if speculation is None or q != query]
+    if pending:
+        fan_out(pending, sources, top_k, filter, hits, errors, timings)
+
+    merged = []
+    for found in hits.values():
+        merged.extend(normalize_scores(list(found.values())))
+    merged.sort(key=lambda h: (h["score"], h["raw_score"]), reverse=True)
+
+    results = [{
+        "source": h["source"],
+        "id": h["id"],
+        "score": round(h["score"], 4),
+        "raw_score": round(h["raw_score"], 4),
+        "results": h["results"],
+    } for h in merged]
+    timings["total"] = time.perf_counter() - total_start
+    response = {
+        "queries": queries,
+        "results": results,
+        "timings": {k: round(v, 4) for k, v in timings.items()},
+    }
+    if errors:
+        response["errors"] = errors
+    # Responses missing a source are not worth reusing
+    elif lookup is not None:
+        cache.store(lookup, query, queries, {"queries": queries, "results": results})
+    return response
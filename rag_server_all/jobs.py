@@ -0,0 +1,315 @@
+"""
+Background re-pricing of BOQ items, e.g. every open project when a new
+Prezziario year lands.
+
+POST /jobs/reprice only queues the items in a local SQLite file (JOBS_DB);
+worker processes started with `python jobs.py` do the matching, so bulk jobs
+never take the API's threads or its Mistral quota. Every item is matched
+like a site visit work (boq.price_work: federated search, then LLM re-rank)
+and its result row is written as soon as it is priced. Workers lease one
+item at a time: an item whose worker crashed is picked up again once its
+lease expires, and items already priced are never redone, so a job resumes
+where it stopped. Jobs are served first come first served. Incremental jobs
+only hold the items whose code changed in the new Prezziario version (see
+price_diff.py); an item that only changed price is priced from the diff.
+
+Workers pace themselves to JOB_ITEMS_PER_MINUTE each, and their Mistral
+calls go through a scheduler limited to JOB_MISTRAL_RPM, the share of the
+workspace's requests per minute left to them. An item the re-rank could
+not score (Mistral rate-limited or down) goes back to the queue after
+JOB_BACKOFF_SECONDS, up to JOB_MAX_ATTEMPTS times; after that its best
+retrieved item is kept.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+from dotenv import load_dotenv
+from metrics import get_logger
+
+load_dotenv()
+
+SOURCE = "all"
+logger = get_logger(SOURCE)
+
+JOBS_DB = os.getenv("JOBS_DB", "jobs.sqlite")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+# Items started per minute by each worker; 0 does not pace
+JOB_ITEMS_PER_MINUTE = float(os.getenv("JOB_ITEMS_PER_MINUTE", "20"))
+# Mistral requests per minute of each worker process (MISTRAL_RPM of the API servers is separate)
+JOB_MISTRAL_RPM = os.getenv("JOB_MISTRAL_RPM", "10")
+# Time to price one item; its re-rank then keeps the best item so far
+JOB_ITEM_BUDGET_SECONDS = float(os.getenv("JOB_ITEM_BUDGET_SECONDS", "60"))
+# An item leased for longer is assumed to belong to a crashed worker
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_BACKOFF_SECONDS = float(os.getenv("JOB_BACKOFF_SECONDS", "30"))
+POLL_SECONDS = 2.0
+# boqItems fields copied to the result, so rows can be written back
+PASSTHROUGH = ("id", "projectId")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    input TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    worker TEXT,
+    data TEXT,
+    error TEXT,
+    PRIMARY KEY (job_id, position)
+);
+CREATE INDEX IF NOT EXISTS results_queue ON results (status, available_at);
+"""
+
+
+class JobQueue:
+    def __init__(self, path):
+        self.path = path
+        # sqlite3 connections cannot be shared between the threadpool's threads
+        self.local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # Workers and the API write concurrently: wait for the lock instead of failing
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def submit(self, items, params, kind="reprice"):
+        """
+        Queues one job over `items` and returns its ID.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # A job without items (nothing changed) is done at once
+            conn.execute("INSERT INTO jobs (id, kind, params, total, created_at, started_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (job_id, kind, json.dumps(params), len(items), now, None if items else now, None if items else now))
+            conn.executemany("INSERT INTO results (job_id, position, input) VALUES (?, ?, ?)",
+                             ((job_id, i, json.dumps(item, ensure_ascii=False)) for i, item in enumerate(items)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def claim(self, worker):
+        """
+        Leases the next pending item, oldest job first, or an item whose
+        lease expired. Returns (job_id, position, item, params, attempts) or None.
+        """
+        now = time.time()
+        conn = self._connection()
+        # BEGIN IMMEDIATE takes the write lock, so two workers never lease the same item
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                row = conn.execute(
+                    "SELECT r.job_id, r.position, r.input, j.params, r.attempts, r.status FROM results r JOIN jobs j ON j.id = r.job_id "
+                    "WHERE r.status IN ('pending', 'running') AND r.available_at <= ? ORDER BY j.created_at, r.position LIMIT 1",
+                    (now,)).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                job_id, position, item, params, attempts, status = row
+                if status == "pending" or attempts < JOB_MAX_ATTEMPTS:
+                    break
+                # Its workers kept dying on it: give up on the item rather than on the queue
+                conn.execute("UPDATE results SET status = 'failed', error = ? WHERE job_id = ? AND position = ?",
+                             (f"No worker finished this item in {attempts} attempts.", job_id, position))
+                self._close_if_done(conn, job_id)
+            conn.execute("UPDATE results SET status = 'running', attempts = attempts + 1, available_at = ?, worker = ? "
+                         "WHERE job_id = ? AND position = ?", (now + JOB_LEASE_SECONDS, worker, job_id, position))
+            conn.execute("UPDATE jobs SET started_at = ? WHERE id = ? AND started_at IS NULL", (now, job_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job_id, position, json.loads(item), json.loads(params), attempts + 1
+
+    def finish(self, job_id, position, data=None, error=None):
+        """
+        Writes an item's result (or error) and closes the job after its last item.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("UPDATE results SET status = ?, data = ?, error = ? WHERE job_id = ? AND position = ?",
+                         ("failed" if error else "done", json.dumps(data, ensure_ascii=False) if data is not None else None,
+                          error, job_id, position))
+            self._close_if_done(conn, job_id)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _close_if_done(conn, job_id):
+        left = conn.execute("SELECT COUNT(*) FROM results WHERE job_id = ? AND status IN ('pending', 'running')",
+                            (job_id,)).fetchone()[0]
+        if not left:
+            conn.execute("UPDATE jobs SET finished_at = ? WHERE id = ? AND finished_at IS NULL", (time.time(), job_id))
+
+    def retry(self, job_id, position, delay):
+        """
+        Puts a leased item back in the queue, available again after `delay` seconds.
+        """
+        self._connection().execute("UPDATE results SET status = 'pending', available_at = ?, worker = NULL WHERE job_id = ? AND position = ?",
+                                   (time.time() + delay, job_id, position))
+
+    def status(self, job_id):
+        """
+        Progress of a job, with an estimated time left once items are
+        priced; None for an unknown job.
+        """
+        conn = self._connection()
+        job = conn.execute("SELECT kind, params, total, created_at, started_at, finished_at FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        kind, params, total, created_at, started_at, finished_at = job
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM results WHERE job_id = ? GROUP BY status", (job_id,)).fetchall())
+        completed = counts.get("done", 0) + counts.get("failed", 0)
+        state = "done" if finished_at else "running" if started_at else "queued"
+        eta = None
+        if started_at and not finished_at and completed:
+            eta = round((time.time() - started_at) / completed * (total - completed), 1)
+        return {
+            "job_id": job_id, "kind": kind, "status": state, "params": json.loads(params),
+            "total": total, "done": counts.get("done", 0), "failed": counts.get("failed", 0),
+            "pending": counts.get("pending", 0), "running": counts.get("running", 0),
+            "progress": round(completed / total, 4) if total else 1.0, "eta_seconds": eta,
+            "created_at": created_at, "started_at": started_at, "finished_at": finished_at,
+        }
+
+    def results(self, job_id, offset=0, limit=100):
+        """
+        Result rows of the job's priced items, in submission order.
+        """
+        rows = self._connection().execute(
+            "SELECT position, status, data, error FROM results WHERE job_id = ? AND status IN ('done', 'failed') "
+            "ORDER BY position LIMIT ? OFFSET ?", (job_id, limit, offset)).fetchall()
+        return [{"position": position, "status": status, **(json.loads(data) if data else {}), **({"error": error} if error else {})}
+                for position, status, data, error in rows]
+
+
+_queues = {}
+
+
+def get_job_queue(path=JOBS_DB):
+    # Keyed by absolute path, so a different working directory gets its own queue
+    path = os.path.abspath(path)
+    if path not in _queues:
+        _queues[path] = JobQueue(path)
+    return _queues[path]
+
+
+def reprice_item(item, params):
+    """
+    Result row for one boqItems row: its best match in the selected price
+    lists, priced at the item's quantity, next to its previous price. An item
+    whose code only changed price (its "priceChange" from price_diff) keeps
+    its code at the new price, without a search.
+    """
+    from boq import price_work, to_number
+    from rerank import Deadline
+    change = item.get("priceChange") or {}
+    if change and not change.get("removed") and not change.get("unitChanged"):
+        quantity = to_number(item.get("quantity"))
+        row = {"work": item.get("description"), "quantity": quantity, "unit": change["unit"], "code": item["code"],
+               "description": change["description"], "unitPrice": change["unitPrice"],
+               "total": round(quantity * change["unitPrice"], 2) if quantity is not None else None,
+               "priceSource": item.get("priceSource"), "accuracy": None, "unitMismatch": False, "rerankCalls": 0, "matchedBy": "code"}
+    else:
+        work = {"Work": item.get("description") or "", "Unit": item.get("unit") or "", "Quantity": item.get("quantity")}
+        row = {**price_work(work, params.get("sources"), Deadline(JOB_ITEM_BUDGET_SECONDS), params.get("top_k", 5)), "matchedBy": "search"}
+    previous = to_number(item.get("unitPrice"))
+    change = None
+    if previous and row.get("unitPrice") is not None:
+        change = round((row["unitPrice"] - previous) / previous * 100, 2)
+    return {**{k: item[k] for k in PASSTHROUGH if k in item}, **row, "previousCode": item.get("code"),
+            "previousPriceSource": item.get("priceSource"), "previousUnitPrice": previous, "priceChangePercent": change}
+
+
+def run_worker(queue=None, stop=None, idle_exit=False):
+    """
+    Prices queued items until `stop` is set, or until the queue is empty
+    with `idle_exit`.
+    """
+    queue = queue or get_job_queue()
+    worker = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    interval = 60.0 / JOB_ITEMS_PER_MINUTE if JOB_ITEMS_PER_MINUTE > 0 else 0.0
+    next_start = 0.0
+    while stop is None or not stop.is_set():
+        time.sleep(max(next_start - time.monotonic(), 0.0))
+        claimed = queue.claim(worker)
+        if claimed is None:
+            if idle_exit:
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+        job_id, position, item, params, attempts = claimed
+        next_start = time.monotonic() + interval
+        try:
+            row = reprice_item(item, params)
+        except Exception as e:
+            logger.exception(f"[Jobs] Job {job_id} item {position} failed")
+            queue.finish(job_id, position, error=str(e))
+            continue
+        if row.get("rerankCalls") and row.get("accuracy") is None and attempts < JOB_MAX_ATTEMPTS:
+            # Not a single score: Mistral is rate-limited or down, so back off and price the item later
+            logger.warning(f"[Jobs] Job {job_id} item {position} could not be re-ranked (attempt {attempts}), retrying in {JOB_BACKOFF_SECONDS}s")
+            queue.retry(job_id, position, JOB_BACKOFF_SECONDS)
+            time.sleep(JOB_BACKOFF_SECONDS)
+            continue
+        queue.finish(job_id, position, data=row, error=row.get("error"))
+        logger.info(f"[Jobs] Job {job_id} item {position} priced: {row.get('priceSource')} {row.get('code')}")
+
+
+def worker_process():
+    # Set before the first import of mistral_utils, whose scheduler reads it
+    os.environ["MISTRAL_RPM"] = JOB_MISTRAL_RPM
+    try:
+        run_worker()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    import signal
+    import multiprocessing
+    # Spawned, so every worker builds its own Mistral client and scheduler
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=worker_process, name=f"job-worker-{i}") for i in range(JOB_WORKERS)]
+    for process in processes:
+        process.start()
+    # docker stop sends SIGTERM: stop the workers like on Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    logger.info(f"[Jobs] {JOB_WORKERS} workers pricing queued items from {JOBS_DB}")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # An item a worker was pricing is leased again once its lease expires
+        for process in processes:
+            process.terminate()
+            process.join()
@@ -0,0 +1,232 @@
+"""
+Rate-limit-aware scheduler for the Mistral calls of a worker process.
+
+Calls wait for two token buckets, requests per minute (MISTRAL_RPM) and
+tokens per minute (MISTRAL_TPM), instead of running into 429 errors. The
+Mistral limits are per workspace, so with several workers each one should get
+its share. Waiting calls are served by priority class: interactive
+(refinement) before normal (alternative phrasings, site visits) before batch
+(re-rank scoring), first come first served within a class. A call that waited
+MISTRAL_MAX_WAIT seconds gives up with RateLimitExceeded.
+
+Identical prompts in flight at the same time are sent once and every caller
+gets the same reply. A 429 blocks all calls for the time given by its
+Retry-After header (or an exponential backoff) and the call is retried;
+remaining-quota headers of other responses drain the buckets to match.
+"""
+import os
+import time
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+from metrics import get_logger, LLM_CALLS, LLM_QUEUE_DEPTH, LLM_QUEUE_SECONDS
+
+RPM = float(os.getenv("MISTRAL_RPM", "60"))
+TPM = float(os.getenv("MISTRAL_TPM", "500000"))
+# Bucket size in seconds of the rate: how far calls may burst after an idle spell
+BURST_SECONDS = float(os.getenv("MISTRAL_BURST_SECONDS", "1"))
+MAX_WAIT = float(os.getenv("MISTRAL_MAX_WAIT", "30"))
+RETRIES = int(os.getenv("MISTRAL_RATE_LIMIT_RETRIES", "3"))
+# First backoff after a 429 without Retry-After, doubled on every retry
+BACKOFF_SECONDS = 1.0
+# How often a cancellable call waiting for a slot checks whether it is still wanted
+CANCEL_POLL_SECONDS = 0.1
+
+PRIORITIES = {"interactive": 0, "normal": 1, "batch": 2}
+TASK_PRIORITY = {"refine": "interactive", "alternatives": "normal", "site_visit": "normal", "rerank": "batch"}
+
+
+class RateLimitExceeded(RuntimeError):
+    pass
+
+
+class CallCancelled(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, per_minute, burst_seconds=BURST_SECONDS):
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate * burst_seconds, 1.0)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost, now):
+        # A call larger than the bucket goes once it is full and leaves it in debt
+        self.refill(now)
+        missing = min(cost, self.capacity) - self.level
+        return max(missing, 0.0) / self.rate
+
+    def take(self, cost):
+        self.level = min(self.capacity, self.level - cost)
+
+    def drain_to(self, remaining):
+        self.level = min(self.level, remaining)
+
+
+def retry_after(headers):
+    """
+    Seconds to wait from Retry-After (seconds or an HTTP date) or a
+    rate-limit reset header, or None.
+    """
+    headers = {k.lower(): v for k, v in (headers or {}).items()}
+    values = [headers.get("retry-after")] + [v for k, v in headers.items() if "ratelimit" in k and "reset" in k]
+    for value in values:
+        if not value:
+            continue
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def is_rate_limited(error):
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    text = str(error).lower()
+    return "429" in text or "rate limit" in text
+
+
+class LLMScheduler:
+    def __init__(self, rpm=RPM, tpm=TPM):
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.cond = threading.Condition()
+        # (priority, arrival) of the waiting calls; the smallest goes next
+        self.waiting = []
+        self.arrivals = itertools.count()
+        self.blocked_until = 0.0
+        self.in_flight = {}
+
+    def call(self, task, prompt, send, tokens=0, priority=None, cancel=None):
+        """
+        Returns send() once the limits allow it; `tokens` is its estimated
+        size. Concurrent calls with the same task and prompt share one send().
+        A call with a `cancel` event raises CallCancelled instead of being
+        sent once the event is set; it is not shared, so cancelling it never
+        fails another caller.
+        """
+        priority = priority or TASK_PRIORITY.get(task, "normal")
+        if cancel is not None:
+            return self._send(task, send, tokens, priority, cancel)
+        key = (task, prompt)
+        with self.cond:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+        if not leader:
+            LLM_CALLS.labels(task=task, outcome="coalesced").inc()
+            return future.result()
+        try:
+            result = self._send(task, send, tokens, priority)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.cond:
+                del self.in_flight[key]
+
+    def _send(self, task, send, tokens, priority, cancel=None):
+        for attempt in range(RETRIES + 1):
+            self.acquire(task, tokens, priority, cancel)
+            try:
+                result = send()
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == RETRIES:
+                    LLM_CALLS.labels(task=task, outcome="rate_limited" if is_rate_limited(e) else "error").inc()
+                    raise
+                delay = retry_after(getattr(getattr(e, "response", None), "headers", None))
+                delay = delay if delay is not None else BACKOFF_SECONDS * 2 ** attempt
+                get_logger("mistral").warning(f"[RAG] Mistral rate limit hit by a {task} call, pausing calls for {delay:.1f} s.")
+                self.back_off(delay)
+                LLM_CALLS.labels(task=task, outcome="retried").inc()
+                continue
+            LLM_CALLS.labels(task=task, outcome="sent").inc()
+            return result
+
+    def acquire(self, task, tokens, priority, cancel=None):
+        start = time.monotonic()
+        entry = (PRIORITIES[priority], next(self.arrivals))
+        with self.cond:
+            heapq.heappush(self.waiting, entry)
+            LLM_QUEUE_DEPTH.labels(priority=priority).inc()
+            try:
+                while True:
+                    if cancel is not None and cancel.is_set():
+                        LLM_CALLS.labels(task=task, outcome="cancelled").inc()
+                        raise CallCancelled(f"The {task} call was cancelled before it was sent.")
+                    now = time.monotonic()
+                    wait = None
+                    if self.waiting[0] == entry:
+                        wait = max(self.blocked_until - now,
+                                   self.requests.wait_time(1, now) if self.requests else 0.0,
+                                   self.tokens.wait_time(tokens, now) if self.tokens and tokens else 0.0)
+                        if wait <= 0:
+                            if self.requests:
+                                self.requests.take(1)
+                            if self.tokens:
+                                self.tokens.take(tokens)
+                            break
+                    left = MAX_WAIT - (now - start)
+                    if left <= 0:
+                        LLM_CALLS.labels(task=task, outcome="queue_timeout").inc()
+                        raise RateLimitExceeded(f"Mistral rate limit: no slot for the {task} call within {MAX_WAIT:.0f} s.")
+                    if cancel is not None:
+                        left = min(left, CANCEL_POLL_SECONDS)
+                    self.cond.wait(min(wait, left) if wait is not None else left)
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                LLM_QUEUE_DEPTH.labels(priority=priority).dec()
+                self.cond.notify_all()
+        LLM_QUEUE_SECONDS.labels(task=task).observe(time.monotonic() - start)
+
+    def settle(self, delta):
+        # The real size of a call once known, minus the estimate it was admitted with
+        if self.tokens:
+            with self.cond:
+                self.tokens.take(delta)
+
+    def back_off(self, seconds):
+        with self.cond:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.cond.notify_all()
+
+    def observe(self, status_code, headers):
+        """
+        Response hook: remaining-quota headers drain the buckets, so the next
+        calls wait instead of failing.
+        """
+        if status_code == 429:
+            delay = retry_after(headers)
+            if delay is not None:
+                self.back_off(delay)
+            return
+        with self.cond:
+            for name, value in headers.items():
+                name = name.lower()
+                if "ratelimit" not in name or "remaining" not in name or "month" in name:
+                    continue
+                try:
+                    remaining = float(value)
+                except ValueError:
+                    continue
+                if "token" in name and self.tokens:
+                    self.tokens.drain_to(remaining)
+                elif "req" in name and self.requests:
+                    self.requests.drain_to(remaining)
@@ -0,0 +1 @@
+from routes import app
\ No newline at end of file
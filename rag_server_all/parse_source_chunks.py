@@ -0,0 +1,91 @@
+import re
+
+# Compiled once, since a search parses every chunk uploaded without a stored record
+ACTIVITY_PATTERN = re.compile(r"Activity:(.*?)(?=Activity:|$)", re.DOTALL)
+WORK_TITLE_PATTERN = re.compile(r"Work:(.*?)Codice:", re.DOTALL)
+WORK_SPLIT_PATTERN = re.compile(r"Work:")
+CODE_PATTERN = re.compile(r"Codice:\s*([^,\n]*)")
+UNIT_PATTERN = re.compile(r"U\.M\.:\s*([^,\n]*)")
+PRICE_PATTERN = re.compile(r"Euro:\s*([^,\n]*)")
+DEI_PATTERN = re.compile(r"Code:\s*([^\s]+)\s+Description:\s*(.*?)\s+Unit:\s*([^\n]*)\s+Price:\s*([0-9]+\.[0-9]{2})")
+
+
+def parse_piemonte_chunk(chunk):
+    """
+    Parses a Piemonte chunk (Main Category / Category / Activity / Work text)
+    into the same structure returned by /search_piemonte.
+    """
+    # Find all Activity blocks
+    activities = ACTIVITY_PATTERN.findall(chunk)
+    results = []
+    for activity_block in activities:
+        # Title: from start to first Work
+        work_match = WORK_TITLE_PATTERN.search(activity_block)
+        if work_match:
+            title = activity_block.split('Work:')[0].strip()
+        else:
+            title = activity_block.strip()
+        # Find all Work blocks
+        work_blocks = WORK_SPLIT_PATTERN.split(activity_block)
+        resources = []
+        for wb in work_blocks[1:]:
+            desc = wb.split('Codice:')[0].strip() if 'Codice:' in wb else wb.strip()
+            code = ""
+            unit = ""
+            price = ""
+            code_match = CODE_PATTERN.search(wb)
+            if code_match:
+                code = code_match.group(1).strip()
+            unit_match = UNIT_PATTERN.search(wb)
+            if unit_match:
+                unit = unit_match.group(1).strip()
+            price_match = PRICE_PATTERN.search(wb)
+            if price_match:
+                price = price_match.group(1).strip()
+            resources.append({
+                "description": desc,
+                "code": code,
+                "unit": unit,
+                "price": price,
+                "total": "",
+                "formula": "",
+                "quantity": ""
+            })
+        results.append({
+            "code": "",
+            "title": title,
+            "unit": "",
+            "quantity": "",
+            "resources": resources
+        })
+    return results
+
+
+def parse_dei_chunk(chunk):
+    """
+    Parses a DEI chunk (Code: <code> Description: <desc> Unit: <unit> Price: <price>)
+    into the same structure returned by /search_dei.
+    """
+    results = []
+    matches = DEI_PATTERN.findall(chunk)
+    resources = []
+    for code, desc, unit, price in matches:
+        resources.append({
+            "code": code,
+            "description": desc,
+            "unit": unit.strip(),
+            "price": price,
+            "total": "",
+            "formula": "",
+            "quantity": ""
+        })
+    # Each chunk is a flat resource list, so wrap in a single result object
+    if resources:
+        results.append({
+            "code": "",
+            "title": "",
+            "unit": "",
+            "quantity": "",
+            "resources": resources
+        })
+    return results
@@ -0,0 +1,153 @@
+"""
+Price differences between two versions of a Prezziario, by item code.
+
+Item codes are stable across years (PAT B.xx.xx.xxxx.xxx, Piemonte Codice:,
+DEI Code:), so two chunk stores of a source, the one of last year's upload
+and the current one, are compared code by code: items only in the new
+version are added, items only in the old one removed, and items in both
+changed when their price or unit differs. Price changes are computed over
+all common codes at once.
+
+`python price_diff.py <source> <old store> [<new store>]` writes the diff
+next to the server (price_diff_<source>.json). Incremental re-pricing jobs
+read it to leave BOQ items whose code did not change alone, price those
+whose price changed from the diff, and only re-match items whose code was
+removed or changed unit.
+"""
+import os
+import sys
+import json
+import numpy as np
+from metrics import record_cache
+from chunk_store import ChunkStore, normalize_unit, stored_records
+
+SOURCE = "all"
+# Prices closer than this are the same price written with different rounding
+PRICE_TOLERANCE = 0.005
+
+
+def catalog(path, source):
+    """
+    Priced items of a chunk store by code, in the order of the first chunk
+    that has them: {code: {"description", "unit", "unitPrice"}}.
+    """
+    from boq import priced_items
+    from federated_search import SOURCES
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Chunk store not found: {path}")
+    store = ChunkStore(path)
+    positions = list(range(len(store)))
+    records = stored_records(store, positions, SOURCES[source]["parse"], store.get_many)
+    items = {}
+    for activities in records:
+        for item in priced_items([{"source": source, "results": activities}]):
+            # Split chunks repeat items of their activity: the first one wins
+            if item["code"] and item["code"] not in items:
+                items[item["code"]] = {"description": item["description"], "unit": normalize_unit(item["unit"]), "unitPrice": item["unitPrice"]}
+    return items
+
+
+def diff_catalogs(old, new):
+    """
+    Added, removed and changed items between two catalogs, with the change
+    of price in percent of the old price (None from a zero price).
+    """
+    added = [{"code": code, **new[code]} for code in new if code not in old]
+    removed = [{"code": code, **old[code]} for code in old if code not in new]
+    common = [code for code in new if code in old]
+    old_prices = np.array([old[code]["unitPrice"] for code in common], dtype=np.float64)
+    new_prices = np.array([new[code]["unitPrice"] for code in common], dtype=np.float64)
+    unit_changed = np.array([old[code]["unit"] for code in common], dtype=str) != np.array([new[code]["unit"] for code in common], dtype=str)
+    price_changed = np.abs(new_prices - old_prices) >= PRICE_TOLERANCE
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percent = np.round((new_prices - old_prices) / old_prices * 100, 2)
+    changed = []
+    for i in np.flatnonzero(price_changed | unit_changed):
+        code = common[i]
+        changed.append({
+            "code": code, "description": new[code]["description"], "unit": new[code]["unit"], "previousUnit": old[code]["unit"],
+            "unitPrice": new[code]["unitPrice"], "previousUnitPrice": old[code]["unitPrice"],
+            "changePercent": float(percent[i]) if np.isfinite(percent[i]) else None,
+            "priceChanged": bool(price_changed[i]), "unitChanged": bool(unit_changed[i]),
+        })
+    moved = percent[price_changed & np.isfinite(percent)]
+    return {
+        "added": added,
+        "removed": removed,
+        "changed": changed,
+        "summary": {
+            "old": len(old), "new": len(new), "added": len(added), "removed": len(removed), "changed": len(changed),
+            "unchanged": len(common) - len(changed),
+            "meanChangePercent": round(float(moved.mean()), 2) if len(moved) else None,
+            "medianChangePercent": round(float(np.median(moved)), 2) if len(moved) else None,
+        },
+    }
+
+
+def diff_stores(source, old_path, new_path):
+    diff = diff_catalogs(catalog(old_path, source), catalog(new_path, source))
+    return {"source": source, "old": old_path, "new": new_path, **diff}
+
+
+def save_price_diff(path, diff):
+    # Written aside and renamed, so a server never reads half a diff
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(diff, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    _loaded.pop(path, None)
+
+
+_loaded = {}
+
+
+def load_price_diff(path):
+    """
+    Changes by code of the diff file, cached until the file changes; None
+    without a file. Removed codes have {"removed": True}.
+    """
+    if not os.path.exists(path):
+        return None
+    stamp = os.path.getmtime(path)
+    cached = _loaded.get(path)
+    if cached and cached[0] == stamp:
+        record_cache(SOURCE, "price_diff", hit=True)
+        return cached[1]
+    record_cache(SOURCE, "price_diff", hit=False)
+    with open(path, "r", encoding="utf-8") as f:
+        diff = json.load(f)
+    changes = {item["code"]: item for item in diff["changed"]}
+    changes.update((item["code"], {**item, "removed": True}) for item in diff["removed"])
+    _loaded[path] = (stamp, changes)
+    return changes
+
+
+def changed_items(items):
+    """
+    Splits boqItems rows into the rows a re-pricing needs to touch, with
+    the change of their code under "priceChange", and the number left alone
+    because their code did not change. Rows without a code, or priced from
+    a source without a diff, are kept as they are, to be re-matched.
+    """
+    from federated_search import SOURCES
+    touched, unchanged = [], 0
+    for item in items:
+        source = str(item.get("priceSource") or "").lower()
+        changes = load_price_diff(SOURCES[source]["price_diff"]) if source in SOURCES else None
+        if changes is None or not item.get("code"):
+            touched.append(item)
+        elif item["code"] in changes:
+            touched.append({**item, "priceChange": changes[item["code"]]})
+        else:
+            unchanged += 1
+    return touched, unchanged
+
+
+if __name__ == "__main__":
+    from federated_search import SOURCES
+    if len(sys.argv) not in (3, 4) or sys.argv[1] not in SOURCES:
+        sys.exit(f"Usage: python price_diff.py {{{','.join(SOURCES)}}} <old chunk store> [<new chunk store>]")
+    source = sys.argv[1]
+    diff = diff_stores(source, sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else SOURCES[source]["store"])
+    save_price_diff(SOURCES[source]["price_diff"], diff)
+    print(json.dumps({"written": SOURCES[source]["price_diff"], **diff["summary"]}, ensure_ascii=False))
@@ -0,0 +1,172 @@
+"""
+Local query expansion: maps free text to Prezziario vocabulary without the
+Mistral refinement call.
+
+The expansion index holds short labels (the activity descriptions and main
+categories of activity_keywords.txt plus the category and activity titles of
+the indexed chunks) and their embeddings. A query is first rewritten with a
+curated synonym map, then its nearest labels by cosine similarity become the
+synonym queries. The similarity of the best label is the confidence: below
+EXPANSION_MIN_CONFIDENCE the caller falls back to the LLM refinement.
+"""
+import os
+import re
+import json
+import threading
+import numpy as np
+from metrics import get_logger, record_cache
+
+KEYWORDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "activity_keywords.txt")
+# Best label similarity needed to skip the LLM; set above 1 to always call it
+MIN_CONFIDENCE = float(os.getenv("EXPANSION_MIN_CONFIDENCE", "0.65"))
+# At most this many labels (those above MIN_CONFIDENCE) are searched, after the rewritten query itself
+NEIGHBOURS = int(os.getenv("EXPANSION_NEIGHBOURS", "1"))
+# Labels are cut to their first clause and at most this many words, like the LLM's answers
+LABEL_WORDS = 10
+
+# Everyday wording -> the term the price lists use
+SYNONYMS = {
+    "tetto": "copertura",
+    "tegole": "coppi",
+    "tegola": "coppo",
+    "grondaia": "canale di gronda",
+    "grondaie": "canali di gronda",
+    "pittura": "tinteggiatura",
+    "imbiancatura": "tinteggiatura",
+    "verniciatura": "tinteggiatura",
+    "piastrelle": "pavimento in ceramica",
+    "mattonelle": "pavimento in ceramica",
+    "parquet": "pavimento in legno",
+    "cemento": "calcestruzzo",
+    "rimozione": "demolizione",
+    "abbattimento": "demolizione",
+    "smaltimento": "conferimento a discarica",
+    "macerie": "rifiuti da demolizione",
+    "cappotto": "isolamento termico",
+    "coibentazione": "isolamento termico",
+    "impalcatura": "ponteggio",
+    "impalcature": "ponteggi",
+}
+KEYWORD_LINE = re.compile(r"Main Category:\s*(.*?)\s+Category:\s*(.*?)\s+Description:\s*(.*)")
+WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def short_label(text):
+    text = re.split(r"\s*[,;:(]\s*", text.strip(), maxsplit=1)[0]
+    return " ".join(text.split()[:LABEL_WORDS]).rstrip(".")
+
+
+def keyword_labels(path=KEYWORDS_PATH):
+    """
+    Labels from activity_keywords.txt: each description's first clause and
+    each main category.
+    """
+    labels = []
+    if not os.path.exists(path):
+        return labels
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            match = KEYWORD_LINE.match(line.strip())
+            if match:
+                labels.extend([short_label(match.group(3)), " ".join(match.group(1).split())])
+    return labels
+
+
+def apply_synonyms(query):
+    return WORD.sub(lambda m: SYNONYMS.get(m.group(0).lower(), m.group(0)), query)
+
+
+def _normalize(matrix):
+    return matrix / (np.linalg.norm(matrix, axis=-1, keepdims=True) + 1e-12)
+
+
+class ExpansionIndex:
+    def __init__(self, labels, embeddings):
+        self.labels = labels
+        self.embeddings = embeddings
+
+    @classmethod
+    def build(cls, labels, embedder):
+        labels = [label for label in dict.fromkeys(short_label(label) for label in labels) if label]
+        embeddings = embedder.encode(labels, convert_to_numpy=True) if labels else np.zeros((0, 1))
+        return cls(labels, _normalize(np.asarray(embeddings, dtype=np.float32)))
+
+    def neighbours(self, query_emb, k=NEIGHBOURS):
+        """
+        The k most similar labels as (label, cosine similarity), best first.
+        """
+        if not self.labels:
+            return []
+        scores = self.embeddings @ _normalize(np.asarray(query_emb, dtype=np.float32).reshape(-1))
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        return [(self.labels[i], float(scores[i])) for i in sorted(top, key=lambda i: -scores[i])]
+
+    def save(self, path):
+        # Written aside and renamed, so concurrent searches never load a partial file
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, labels=np.array(json.dumps(self.labels, ensure_ascii=False)), embeddings=self.embeddings)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(json.loads(str(data["labels"])), data["embeddings"])
+
+
+def update_expansion_index(path, titles, embedder, source, start=0):
+    """
+    Rebuilds the expansion index from activity_keywords.txt and the titles of
+    uploaded chunks. Uploads from position 0 start over; later batches add
+    their titles to the existing labels.
+    """
+    labels = keyword_labels()
+    if start and os.path.exists(path):
+        labels = ExpansionIndex.load(path).labels + labels
+    index = ExpansionIndex.build(labels + list(titles), embedder)
+    index.save(path)
+    _loaded.pop(path, None)
+    get_logger(source).info(f"[Main] Expansion index with {len(index.labels)} labels written to {path}.")
+    return index
+
+
+_loaded = {}
+
+
+def load_expansion_index(path, source, embedder):
+    """
+    Loads the expansion index written at upload time, cached until the file
+    changes. Without one, it is built from activity_keywords.txt alone.
+    """
+    if not os.path.exists(path):
+        update_expansion_index(path, [], embedder, source)
+    stamp = os.path.getmtime(path)
+    cached = _loaded.get(path)
+    if cached and cached[0] == stamp:
+        record_cache(source, "expansion_index", hit=True)
+        return cached[1]
+    record_cache(source, "expansion_index", hit=False)
+    index = ExpansionIndex.load(path)
+    _loaded[path] = (stamp, index)
+    return index
+
+
+def expand_query(query, path, source, embedder):
+    """
+    Synonym queries for `query` from the expansion index, or None when the
+    best label is less similar than MIN_CONFIDENCE and the LLM should refine.
+    """
+    if MIN_CONFIDENCE > 1:
+        return None
+    index = load_expansion_index(path, source, embedder)
+    rewritten = apply_synonyms(query)
+    hits = index.neighbours(embedder.encode(rewritten, convert_to_numpy=True))
+    confidence = hits[0][1] if hits else 0.0
+    # Counted as a cache: a hit is a refinement answered locally
+    record_cache(source, "query_expansion", hit=confidence >= MIN_CONFIDENCE)
+    if confidence < MIN_CONFIDENCE:
+        get_logger(source).info(f"[RAG] Local expansion confidence {confidence:.2f} below {MIN_CONFIDENCE}, asking the LLM.")
+        return None
+    queries = list(dict.fromkeys([rewritten] + [label for label, score in hits if score >= MIN_CONFIDENCE]))
+    get_logger(source).info(f"[RAG] Local expansion (confidence {confidence:.2f}): {queries}")
+    return queries
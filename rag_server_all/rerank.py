@@ -0,0 +1,109 @@
+import os
+import time
+from metrics import get_logger, stage_timer, DEGRADED
+
+# Time a search may take before re-ranking stops and the best result so far is returned
+DEFAULT_BUDGET_SECONDS = float(os.getenv("SEARCH_BUDGET_SECONDS", "25"))
+# The alternative-phrasings fallback is only started with at least this much time left
+ALT_PHRASINGS_MIN_SECONDS = float(os.getenv("ALT_PHRASINGS_MIN_SECONDS", "5"))
+
+
+class Deadline:
+    """
+    Per-request time budget. Routes create one when the request arrives and
+    pass it to the pipeline, which sets `degraded` when it cut work short to
+    stay within the budget.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = DEFAULT_BUDGET_SECONDS if budget is None else float(budget)
+        self.expires_at = time.monotonic() + self.budget
+        self.degraded = False
+        self.llm_seconds = []
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def llm_call_seconds(self):
+        return sum(self.llm_seconds) / len(self.llm_seconds) if self.llm_seconds else 0
+
+    def expired(self):
+        # Not worth starting another LLM call that would end past the deadline
+        return self.remaining() <= self.llm_call_seconds()
+
+    def near(self):
+        # The fallback needs one call for the phrasings and at least one re-rank call
+        return self.remaining() < max(ALT_PHRASINGS_MIN_SECONDS, 2 * self.llm_call_seconds())
+
+    def degrade(self, source, reason):
+        if not self.degraded:
+            self.degraded = True
+            DEGRADED.labels(source=source, reason=reason).inc()
+            get_logger(source).warning(f"[RAG] Returning best result so far ({reason}, {self.remaining():.1f}s left)")
+
+
+def order_candidates(scored):
+    """
+    Deduplicates (chunk ID, retrieval score) pairs from several queries, keeping
+    the best score per chunk, and sorts them so likely winners are re-ranked first.
+    """
+    best = {}
+    for chunk, score in scored:
+        if chunk not in best or score > best[chunk]:
+            best[chunk] = score
+    return sorted(best, key=lambda chunk: best[chunk], reverse=True)
+
+
+def resolve_texts(source, candidates, texts, chunks_at):
+    """
+    Looks up the texts of candidate IDs not yet in `texts` with `chunks_at` and
+    returns the candidates that have a text, in order.
+    """
+    new = [c for c in candidates if c not in texts]
+    if new:
+        with stage_timer(source, "chunk_store"):
+            texts.update(zip(new, chunks_at(new)))
+    return [c for c in candidates if texts.get(c) is not None]
+
+
+def parse_accuracy(reply):
+    try:
+        return int(''.join(filter(str.isdigit, str(reply))))
+    except Exception:
+        return 0
+
+
+def rerank(query, candidates, answer_question, source, threshold, deadline, best=(0, None, 0), label="Chunk", texts=None):
+    """
+    Scores candidates with the LLM in order and stops at the first one that
+    reaches `threshold`, or when the deadline expires. Candidates are chunk
+    texts, or chunk IDs with their texts in `texts`. `best` carries the
+    result of a previous round. Returns (best_accuracy, best_chunk, best_idx, calls),
+    where best_chunk is the winning candidate.
+    """
+    logger = get_logger(source)
+    best_accuracy, best_chunk, best_idx = best
+    calls = 0
+    for i, candidate in enumerate(candidates):
+        if deadline.expired():
+            deadline.degrade(source, "deadline")
+            break
+        chunk = texts[candidate] if texts is not None else candidate
+        title = chunk.split("\n")[0] if "\n" in chunk else chunk[:500]
+        prompt = f"Is the following construction activity relevant to the query '{query}'? Activity: '{title}'. Return number from 1 to 100 representing accuracy."
+        start = time.perf_counter()
+        try:
+            calls += 1
+            with stage_timer(source, "rerank_llm"):
+                accuracy = parse_accuracy(answer_question(prompt, task="rerank"))
+        except Exception:
+            accuracy = 0
+        deadline.llm_seconds.append(time.perf_counter() - start)
+        logger.info(f"{label} {i+1} title: {title}\nAccuracy: {accuracy}")
+        if accuracy > best_accuracy:
+            best_accuracy = accuracy
+            best_chunk = candidate
+            best_idx = i
+        if best_accuracy >= threshold:
+            break
+    return best_accuracy, best_chunk, best_idx, calls
@@ -0,0 +1,109 @@
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from dotenv import load_dotenv
+from federated_search import search_all, SOURCES, SOURCE
+from boq import site_visit_boq
+from jobs import get_job_queue
+from price_diff import changed_items
+from chunk_store import normalize_unit
+from fastapi import Form
+import json
+from coalesce import SingleFlight, normalize_query
+import metrics
+
+load_dotenv()
+
+app = FastAPI()
+
+# Allow CORS for local dev and deployment
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["https://billquant-1.onrender.com", "http://localhost:5173/"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Request IDs, per-stage latency histograms and the /metrics endpoint
+metrics.install(app, SOURCE)
+# Concurrent identical searches run the pipeline once
+coalescer = SingleFlight(SOURCE, "/search_all")
+
+@app.get("/health")
+def health_check():
+    return {"status": "ok"}
+
+def parse_sources(sources):
+    # Comma-separated source names; (selected, error)
+    selected = [s.strip().lower() for s in sources.split(",") if s.strip()]
+    unknown = [s for s in selected if s not in SOURCES]
+    if unknown:
+        return selected, {"error": f"Unknown source(s): {', '.join(unknown)}. Available: {', '.join(SOURCES)}"}
+    return selected, None
+
+# Federated search across the PAT, Piemonte and DEI Prezziari
+def run_search(query, top_k, sources, unit):
+    selected, error = parse_sources(sources)
+    if error:
+        return error
+    try:
+        # Optional unit of measure, matched against the index metadata (m2, mq and m² are the same unit)
+        filter = {"unit": normalize_unit(unit)} if unit else None
+        return search_all(query, top_k=top_k, sources=selected or None, filter=filter)
+    except Exception as e:
+        return {"error": str(e)}
+
+@app.post("/search_all")
+async def search_all_sources(query: str = Form(...), top_k: int = Form(5), sources: str = Form(""), unit: str = Form(None)):
+    # Identical searches in flight share one pipeline run
+    return await coalescer.run((normalize_query(query), top_k, sources.replace(" ", "").lower(), normalize_unit(unit) if unit else None), run_search, query, top_k, sources, unit)
+
+# Site visit notes to priced BOQ rows: one plan, then every work searched and re-ranked concurrently
+@app.post("/site_visit_boq")
+def site_visit_to_boq(notes: str = Form(...), sources: str = Form(""), budget: float = Form(None)):
+    selected, error = parse_sources(sources)
+    if error:
+        return error
+    try:
+        return site_visit_boq(notes, sources=selected or None, budget=budget)
+    except Exception as e:
+        return {"error": str(e)}
+
+# Bulk re-pricing of boqItems rows: queued here, priced by the `python jobs.py` worker processes
+@app.post("/jobs/reprice")
+def submit_reprice(items: str = Form(...), sources: str = Form(""), top_k: int = Form(5), incremental: bool = Form(False)):
+    selected, error = parse_sources(sources)
+    if error:
+        return error
+    try:
+        rows = json.loads(items)
+    except ValueError as e:
+        return {"error": f"items is not JSON: {e}"}
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        return {"error": "items must be a JSON array of boqItems objects."}
+    if not rows:
+        return {"error": "items is empty."}
+    try:
+        params = {"sources": selected or None, "top_k": top_k}
+        if incremental:
+            # Only the items whose code changed in the new Prezziario versions
+            rows, params["unchanged"] = changed_items(rows)
+            params["incremental"] = True
+        queue = get_job_queue()
+        job_id = queue.submit(rows, params)
+        return queue.status(job_id)
+    except Exception as e:
+        return {"error": str(e)}
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    status = get_job_queue().status(job_id)
+    return status if status is not None else {"error": f"Unknown job: {job_id}"}
+
+@app.get("/jobs/{job_id}/results")
+def job_results(job_id: str, offset: int = 0, limit: int = 100):
+    queue = get_job_queue()
+    status = queue.status(job_id)
+    if status is None:
+        return {"error": f"Unknown job: {job_id}"}
+    return {**status, "offset": offset, "results": queue.results(job_id, offset, limit)}
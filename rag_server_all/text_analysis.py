@@ -0,0 +1,165 @@
+"""
+Italian text analysis and the pre-tokenized lexical index built with it.
+
+Chunks are analyzed once, when the corpus is indexed: Unicode and accent
+folding, splitting on punctuation (codes such as B.02.10.0070.040 stay one
+word), unit normalization (m2, m², mq -> m2; m3, m³, mc -> m3) and light
+Italian stemming of plural and gender endings. The resulting token IDs are
+stored with their postings in the corpus's index snapshot (index_snapshot.py),
+so a BM25 query only analyzes the query and walks the postings of its terms.
+"""
+import os
+import re
+import json
+import bisect
+import unicodedata
+import numpy as np
+
+# Words split on punctuation; dots and dashes inside a word (codes, decimals) are kept
+WORD_PATTERN = re.compile(r"[^\W_]+(?:[.\-][^\W_]+)*")
+# Spellings of the same unit, after folding (m² folds to m2)
+UNIT_TOKENS = {"mq": "m2", "mc": "m3", "mt": "m", "ml": "m"}
+# Okapi BM25 parameters, as in rank_bm25.BM25Okapi
+K1 = 1.5
+B = 0.75
+EPSILON = 0.25
+# Arrays of a LexicalIndex, in constructor order after the vocabulary
+ARRAYS = ("tokens", "doc_offsets", "term_offsets", "post_docs", "post_tf")
+
+
+def fold(text):
+    """
+    Lower-cases and removes accents; compatibility forms are decomposed too,
+    so superscripts become digits (m² -> m2).
+    """
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text if not unicodedata.combining(c)).casefold()
+
+
+def stem(word):
+    """
+    Light Italian stemmer: strips the final vowel, so singular and plural,
+    masculine and feminine forms share a stem (tubo/tubi, lastra/lastre).
+    """
+    if len(word) < 4 or not word.isalpha():
+        return word
+    if word.endswith(("chi", "che", "ghi", "ghe")):
+        return word[:-2]
+    if word.endswith(("io", "ia", "ie", "ii")):
+        return word[:-2]
+    if word[-1] in "aeiou":
+        return word[:-1]
+    return word
+
+
+def analyze(text):
+    words = WORD_PATTERN.findall(fold(text))
+    return [stem(UNIT_TOKENS.get(w, w)) for w in words]
+
+
+class SortedTerms:
+    """
+    Vocabulary of a saved lexical index: its terms in sorted order, term ID i
+    being the i-th, looked up by bisection. The terms are memory-mapped
+    (corpus_store.Corpus), so workers share them like the arrays.
+    """
+    def __init__(self, terms):
+        self.terms = terms
+
+    def __len__(self):
+        return len(self.terms)
+
+    def get(self, token, default=None):
+        i = bisect.bisect_left(self.terms, token)
+        return i if i < len(self.terms) and self.terms[i] == token else default
+
+
+class LexicalIndex:
+    """
+    Token-ID arrays of every chunk (tokens[doc_offsets[i]:doc_offsets[i+1]])
+    and, per term, the chunks containing it with their term frequencies
+    (post_docs / post_tf[term_offsets[t]:term_offsets[t+1]]). Term IDs follow
+    the sorted order of the terms.
+    """
+    def __init__(self, vocab, tokens, doc_offsets, term_offsets, post_docs, post_tf):
+        self.vocab = vocab
+        self.tokens = tokens
+        self.doc_offsets = doc_offsets
+        self.term_offsets = term_offsets
+        self.post_docs = post_docs
+        self.post_tf = post_tf
+        n = len(doc_offsets) - 1
+        self.doc_len = np.diff(doc_offsets).astype(np.float32)
+        self.avgdl = float(self.doc_len.mean()) if n else 0.0
+        df = np.diff(term_offsets).astype(np.float64)
+        idf = np.log(n - df + 0.5) - np.log(df + 0.5)
+        # Terms in more than half of the chunks get a small positive weight, as in BM25Okapi
+        self.idf = np.where(idf < 0, EPSILON * idf.mean() if len(idf) else 0.0, idf)
+
+    @property
+    def n_chunks(self):
+        return len(self.doc_offsets) - 1
+
+    @classmethod
+    def build(cls, chunks):
+        vocab = {}
+        ids = []
+        doc_offsets = [0]
+        for chunk in chunks:
+            ids.extend(vocab.setdefault(token, len(vocab)) for token in analyze(chunk))
+            doc_offsets.append(len(ids))
+        # Renumbered in term order, so a saved vocabulary is just the sorted terms
+        terms = sorted(vocab)
+        renumber = np.empty(len(vocab), dtype=np.int32)
+        renumber[[vocab[term] for term in terms]] = np.arange(len(terms), dtype=np.int32)
+        vocab = {term: i for i, term in enumerate(terms)}
+        tokens = renumber[np.array(ids, dtype=np.int64)] if ids else np.array([], dtype=np.int32)
+        doc_offsets = np.array(doc_offsets, dtype=np.int64)
+        n = max(len(doc_offsets) - 1, 1)
+        # One (term, chunk) key per token; unique keys sort by term, then by chunk
+        docs = np.repeat(np.arange(len(doc_offsets) - 1, dtype=np.int64), np.diff(doc_offsets))
+        keys, tf = np.unique(tokens.astype(np.int64) * n + docs, return_counts=True)
+        term_offsets = np.concatenate([[0], np.cumsum(np.bincount(keys // n, minlength=len(vocab)))]).astype(np.int64)
+        return cls(vocab, tokens, doc_offsets, term_offsets, (keys % n).astype(np.int32), tf.astype(np.float32))
+
+    def query_ids(self, query):
+        # Terms missing from the corpus cannot score
+        return [term for term in (self.vocab.get(token) for token in analyze(query)) if term is not None]
+
+    def doc_ids(self, i):
+        return self.tokens[self.doc_offsets[i]:self.doc_offsets[i + 1]]
+
+    def scores(self, query, positions=None):
+        """
+        BM25 scores of the query against every chunk, or against the chunks at
+        `positions` (in that order).
+        """
+        scores = np.zeros(self.n_chunks, dtype=np.float64)
+        for term in self.query_ids(query):
+            start, end = self.term_offsets[term], self.term_offsets[term + 1]
+            docs, tf = self.post_docs[start:end], self.post_tf[start:end]
+            norm = K1 * (1 - B + B * self.doc_len[docs] / self.avgdl)
+            scores[docs] += self.idf[term] * tf * (K1 + 1) / (tf + norm)
+        return scores if positions is None else scores[np.asarray(positions, dtype=np.int64)]
+
+    def save(self, directory):
+        """
+        Writes the sorted terms as a blob and offsets and one .npy file per
+        array, so load can memory-map them all.
+        """
+        from corpus_store import write_corpus
+        write_corpus(os.path.join(directory, "vocab.blob"), os.path.join(directory, "vocab.offsets.npy"), self.vocab)
+        for name in ARRAYS:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory):
+        from corpus_store import Corpus
+        if os.path.exists(os.path.join(directory, "vocab.json")):
+            # Snapshots built before the mapped vocabulary
+            with open(os.path.join(directory, "vocab.json"), "r", encoding="utf-8") as f:
+                vocab = {token: i for i, token in enumerate(json.load(f))}
+        else:
+            vocab = SortedTerms(Corpus(os.path.join(directory, "vocab.blob"), os.path.join(directory, "vocab.offsets.npy")))
+        return cls(vocab, *(np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in ARRAYS))
+
@@ -0,0 +1,223 @@
+"""
+Index-time collapse of near-duplicate chunks.
+
+Prezziario items often differ only in a dimension or thickness, and split
+chunks repeat their category and description. The uploader computes a MinHash
+signature of every chunk's item texts (the titles or descriptions its parser
+extracts; word pairs of text_analysis.analyze, with numbers and codes masked)
+and looks up earlier chunks with a similar signature in LSH buckets. A chunk
+whose estimated Jaccard similarity with a representative is at least
+DEDUP_THRESHOLD joins its cluster; otherwise it becomes a representative
+itself. Only representatives are uploaded, with their member IDs in the
+metadata, so a search never returns several variants of one item to be
+scored separately; when the re-rank selects a representative, its members
+are returned with it.
+
+Members must have the same filterable metadata (unit, category, code
+prefixes) as their representative, so metadata filters match whole clusters. Signatures and
+clusters are saved next to the corpus (dedup_index_<source>.npz), with
+positions matching the chunk_<i> vector IDs, so incremental uploads join
+existing clusters.
+"""
+import os
+import json
+import zlib
+import numpy as np
+from metrics import get_logger, record_cache
+from text_analysis import analyze
+
+# Estimated Jaccard similarity from which a chunk joins a cluster; 0 uploads every chunk
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.9"))
+NUM_PERM = 64
+# LSH bands of NUM_PERM // BANDS rows: chunks sharing one band are compared
+BANDS = 16
+SHINGLE_SIZE = 2
+MERSENNE_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(1)
+PERM_A = _rng.randint(1, MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+PERM_B = _rng.randint(0, MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+EMPTY = np.iinfo(np.uint32).max
+
+
+def shingles(text):
+    # Numbers and codes are masked, so dimension variants differ only in their words
+    tokens = ["#" if any(c.isdigit() for c in token) else token for token in analyze(text)]
+    if len(tokens) < SHINGLE_SIZE:
+        return set(tokens)
+    return {" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text):
+    """
+    MinHash signature of the text's shingles; all EMPTY for a text without words.
+    """
+    values = shingles(text)
+    if not values:
+        return np.full(NUM_PERM, EMPTY, dtype=np.uint32)
+    x = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in values), dtype=np.uint64, count=len(values)) % MERSENNE_PRIME
+    return ((PERM_A[:, None] * x[None, :] + PERM_B[:, None]) % MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+
+def cluster_key(metadata):
+    # Filterable fields a member shares with its representative; code and price are what variants differ in
+    return json.dumps({k: v for k, v in metadata.items() if k not in ("code", "price")}, sort_keys=True)
+
+
+class DedupIndex:
+    """
+    Signature, cluster key and representative of every uploaded chunk, by
+    position; a representative is its own.
+    """
+
+    def __init__(self, source, signatures=None, keys=None, representatives=None):
+        self.source = source
+        self.signatures = signatures if signatures is not None else np.zeros((0, NUM_PERM), dtype=np.uint32)
+        self.keys = list(keys) if keys is not None else []
+        self.representatives = list(representatives) if representatives is not None else []
+        self.members = {}
+        self.buckets = {}
+        for pos, rep in enumerate(self.representatives):
+            if rep == pos:
+                self._bucket(pos)
+            else:
+                self.members.setdefault(rep, []).append(pos)
+
+    def _bands(self, pos):
+        rows = NUM_PERM // BANDS
+        signature = self.signatures[pos]
+        return [(band, self.keys[pos], signature[band * rows:(band + 1) * rows].tobytes()) for band in range(BANDS)]
+
+    def _bucket(self, pos):
+        if self.signatures[pos][0] != EMPTY:
+            for band in self._bands(pos):
+                self.buckets.setdefault(band, []).append(pos)
+
+    def add(self, texts, keys, start=0, threshold=DEDUP_THRESHOLD):
+        """
+        Clusters the chunks with these item texts at positions start,
+        start+1, ... (following the chunks already added) and returns their
+        representatives.
+        """
+        # Chunks uploaded before the index existed are their own representatives
+        missing = start - len(self.representatives)
+        if missing > 0:
+            self.signatures = np.vstack([self.signatures, np.full((missing, NUM_PERM), EMPTY, dtype=np.uint32)])
+            self.keys.extend([""] * missing)
+            self.representatives.extend(range(len(self.representatives), start))
+        self.signatures = np.vstack([self.signatures, np.stack([minhash(text) for text in texts])]) if texts else self.signatures
+        self.keys.extend(keys)
+        for pos in range(start, start + len(texts)):
+            best = pos
+            if self.signatures[pos][0] != EMPTY:
+                candidates = sorted({rep for band in self._bands(pos) for rep in self.buckets.get(band, [])})
+                if candidates:
+                    # Share of equal MinHash values estimates the Jaccard similarity; ties go to the earliest
+                    similarities = (self.signatures[candidates] == self.signatures[pos]).mean(axis=1)
+                    i = int(np.argmax(similarities))
+                    if similarities[i] >= threshold:
+                        best = candidates[i]
+            self.representatives.append(best)
+            if best == pos:
+                self._bucket(pos)
+            else:
+                self.members.setdefault(best, []).append(pos)
+        return self.representatives[start:]
+
+    def representatives_of(self, positions):
+        """
+        Representatives of the chunks at `positions`, in order, without repeats.
+        """
+        return list(dict.fromkeys(self.representatives[p] if p < len(self.representatives) else p for p in positions))
+
+    def expand(self, positions, selected):
+        """
+        `positions` with the `selected` representative followed by its members.
+        """
+        expanded = []
+        for pos in positions:
+            expanded.append(pos)
+            if pos == selected:
+                expanded.extend(self.members.get(pos, []))
+        return expanded
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, signatures=self.signatures, keys=np.array(self.keys, dtype=str),
+                     representatives=np.array(self.representatives, dtype=np.int64), source=np.array(self.source))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(str(data["source"]), data["signatures"], data["keys"].tolist(), data["representatives"].tolist())
+
+
+def update_dedup_index(path, texts, keys, source, start=0):
+    """
+    Clusters uploaded chunks, given by their item texts and cluster keys,
+    into the index file and returns the index. Uploads from position 0 start
+    a new index; later batches join the clusters of the existing file. With
+    DEDUP_THRESHOLD 0 the file is removed and None is returned.
+    """
+    if DEDUP_THRESHOLD <= 0:
+        if os.path.exists(path):
+            os.remove(path)
+        _loaded.pop(path, None)
+        return None
+    index = DedupIndex(source)
+    if start and os.path.exists(path):
+        # Chunks from `start` on are replaced
+        old = DedupIndex.load(path)
+        index = DedupIndex(source, old.signatures[:start], old.keys[:start], old.representatives[:start])
+    representatives = index.add(texts, keys, start)
+    index.save(path)
+    _loaded.pop(path, None)
+    kept = sum(rep == pos for pos, rep in enumerate(representatives, start=start))
+    get_logger(source).info(f"[Main] Dedup index: {len(texts)} chunks collapsed into {kept} representatives, written to {path}.")
+    return index
+
+
+def cluster_upload(index, dedup, start, count, metadatas, namespace="default", batch_size=1000):
+    """
+    Positions (from `start`) of the uploaded chunks that get a vector: the
+    representatives, with their member IDs added to `metadatas`. Earlier
+    representatives that gained members get the new list, and members are
+    deleted from the index, in case an earlier upload gave them a vector.
+    """
+    if dedup is None:
+        return list(range(count))
+    uploaded = []
+    for j in range(count):
+        pos = start + j
+        if dedup.representatives[pos] == pos:
+            uploaded.append(j)
+            if dedup.members.get(pos):
+                metadatas[j]["members"] = [f"chunk_{m}" for m in dedup.members[pos]]
+    grown = {dedup.representatives[start + j] for j in range(count)} - {start + j for j in uploaded}
+    for rep in sorted(grown):
+        index.update(id=f"chunk_{rep}", set_metadata={"members": [f"chunk_{m}" for m in dedup.members[rep]]}, namespace=namespace)
+    members = [f"chunk_{start + j}" for j in range(count) if dedup.representatives[start + j] != start + j]
+    for i in range(0, len(members), batch_size):
+        index.delete(ids=members[i:i+batch_size], namespace=namespace)
+    return uploaded
+
+
+_loaded = {}
+
+
+def load_dedup_index(path, source):
+    """
+    Loads the index written at upload time, cached until the file changes.
+    Returns None without a file (an index uploaded without deduplication) or
+    when DEDUP_THRESHOLD is 0.
+    """
+    if DEDUP_THRESHOLD <= 0 or not os.path.exists(path):
+        return None
+    stamp = os.path.getmtime(path)
+    cached = _loaded.get(path)
+    if cached and cached[0] == stamp:
+        record_cache(source, "dedup_index", hit=True)
+        return cached[1]
+    record_cache(source, "dedup_index", hit=False)
+    index = DedupIndex.load(path)
+    _loaded[path] = (stamp, index)
+    return index
@@ -0,0 +1,65 @@
+"""
+Fusion of the candidates retrieved for several synonym queries.
+
+Each synonym query returns its own ranking. Reciprocal rank fusion (RRF)
+merges them: a chunk scores 1 / (FUSION_RRF_K + rank) in every ranking it
+appears in, so chunks found by several synonyms come first, and raw scores
+of differently phrased queries are never compared. Near-duplicates (the same
+item codes, or in local search near-identical embeddings) are collapsed into
+their best-ranked one, and only the first RERANK_MAX_CANDIDATES go to the LLM
+re-rank, however many synonyms the refinement returned.
+"""
+import os
+import numpy as np
+from code_index import extract_codes
+
+RRF_K = int(os.getenv("FUSION_RRF_K", "60"))
+# Embeddings at least this similar are the same item (local search only)
+DUPLICATE_SIMILARITY = float(os.getenv("FUSION_DUPLICATE_SIMILARITY", "0.98"))
+# 0 re-ranks every fused candidate
+MAX_CANDIDATES = int(os.getenv("RERANK_MAX_CANDIDATES", "10")) or None
+
+
+def fuse(rankings, k=RRF_K):
+    """
+    Fuses rankings of (chunk ID, retrieval score) pairs, one per query, into
+    chunk IDs by RRF score; ties go to the best retrieval score.
+    """
+    fused = {}
+    best = {}
+    for ranking in rankings:
+        ranking = sorted(ranking, key=lambda pair: pair[1], reverse=True)
+        seen = set()
+        for rank, (chunk, score) in enumerate(ranking, start=1):
+            # A chunk counts once per ranking
+            if chunk in seen:
+                continue
+            seen.add(chunk)
+            fused[chunk] = fused.get(chunk, 0.0) + 1.0 / (k + rank)
+            best[chunk] = max(score, best.get(chunk, score))
+    return sorted(fused, key=lambda chunk: (fused[chunk], best[chunk]), reverse=True)
+
+
+def collapse(source, candidates, texts, embeddings=None, threshold=DUPLICATE_SIMILARITY):
+    """
+    Drops candidates that repeat the item codes of a better-ranked one or,
+    given `embeddings` (indexed by chunk ID), whose embedding is at least
+    `threshold` similar to one.
+    """
+    kept = []
+    codes_seen = set()
+    kept_embs = []
+    for chunk in candidates:
+        codes = tuple(extract_codes(texts[chunk], source))
+        if codes and codes in codes_seen:
+            continue
+        if embeddings is not None:
+            emb = np.asarray(embeddings[chunk], dtype=np.float32)
+            emb = emb / (np.linalg.norm(emb) + 1e-12)
+            if kept_embs and float(np.max(np.stack(kept_embs) @ emb)) >= threshold:
+                continue
+            kept_embs.append(emb)
+        if codes:
+            codes_seen.add(codes)
+        kept.append(chunk)
+    return kept
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import uuid
+import logging
+import contextvars
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, generate_latest
+
+# Pipeline stages are labelled by source server (pat, piemonte, dei, all) and
+# stage name: code_lookup, semantic_cache, expand, refine, encode, category, vector_query, chunk_store, bm25, fusion, rerank_llm, alt_phrasings, parse, site_visit.
+STAGE_SECONDS = Histogram(
+    "billquant_stage_seconds",
+    "Time spent in each search pipeline stage.",
+    ["source", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+RERANK_CALLS = Histogram(
+    "billquant_rerank_calls_per_request",
+    "Number of LLM re-rank calls made for a single search.",
+    ["source"],
+    buckets=(0, 1, 2, 5, 10, 15, 20, 30, 50, 100),
+)
+CACHE_REQUESTS = Counter(
+    "billquant_cache_requests_total",
+    "Cache lookups by cache name and result (hit or miss).",
+    ["source", "cache", "result"],
+)
+REQUESTS = Counter(
+    "billquant_requests_total",
+    "HTTP requests by endpoint and status code.",
+    ["source", "endpoint", "status"],
+)
+IN_FLIGHT = Gauge(
+    "billquant_in_flight_requests",
+    "HTTP requests currently being served.",
+    ["source", "endpoint"],
+    multiprocess_mode="livesum",
+)
+
+DEGRADED = Counter(
+    "billquant_degraded_responses_total",
+    "Searches that returned the best result so far to stay within their latency budget.",
+    ["source", "reason"],
+)
+SEMANTIC_AUDITS = Counter(
+    "billquant_semantic_cache_audits_total",
+    "Semantic cache hits searched again to check them, by whether the fresh result was the same or different.",
+    ["source", "result"],
+)
+
+LLM_TOKENS = Histogram(
+    "billquant_llm_tokens",
+    "Tokens per Mistral call as reported by the API, by task (refine, rerank, alternatives, site_visit) and kind (input or output).",
+    ["task", "kind"],
+    buckets=(10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000),
+)
+
+COALESCED_REQUESTS = Counter(
+    "billquant_coalesced_requests_total",
+    "Search requests answered by an identical request already in flight.",
+    ["source", "endpoint"],
+)
+SPECULATIONS = Counter(
+    "billquant_speculative_refinements_total",
+    "Refinements run next to a search of the raw query, by outcome (refined, cancelled by a confident raw hit, failed).",
+    ["source", "outcome"],
+)
+LLM_CALLS = Counter(
+    "billquant_llm_calls_total",
+    "Mistral calls by task and outcome (sent, coalesced, retried, rate_limited, queue_timeout, cancelled, error).",
+    ["task", "outcome"],
+)
+LLM_QUEUE_DEPTH = Gauge(
+    "billquant_llm_queue_depth",
+    "Mistral calls waiting for the rate limiter, by priority class.",
+    ["priority"],
+    multiprocess_mode="livesum",
+)
+LLM_QUEUE_SECONDS = Histogram(
+    "billquant_llm_queue_seconds",
+    "Time Mistral calls waited for the rate limiter, by task.",
+    ["task"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+
+@contextmanager
+def stage_timer(source, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(source=source, stage=stage).observe(time.perf_counter() - start)
+
+
+def record_cache(source, cache, hit):
+    CACHE_REQUESTS.labels(source=source, cache=cache, result="hit" if hit else "miss").inc()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": request_id_var.get(),
+            "message": record.getMessage(),
+        }
+        # Extra fields passed as logger.info(..., extra={"fields": {...}})
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def get_logger(name):
+    root = logging.getLogger("billquant")
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+        root.addHandler(handler)
+        root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+        root.propagate = False
+    return root.getChild(name)
+
+
+def install(app, source):
+    """
+    Adds the request-ID/metrics middleware and the /metrics endpoint to a FastAPI app.
+    """
+    from fastapi import Request, Response
+    from starlette.routing import Match
+
+    def route_template(scope):
+        # The route's path template (/jobs/{job_id}), not the path: labels must stay few
+        for route in app.router.routes:
+            if route.matches(scope)[0] == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    @app.middleware("http")
+    async def observe_request(request: Request, call_next):
+        request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+        endpoint = route_template(request.scope)
+        IN_FLIGHT.labels(source=source, endpoint=endpoint).inc()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            response.headers["X-Request-ID"] = request_id
+            return response
+        finally:
+            IN_FLIGHT.labels(source=source, endpoint=endpoint).dec()
+            REQUESTS.labels(source=source, endpoint=endpoint, status=str(status)).inc()
+            request_id_var.reset(token)
+
+    @app.get("/metrics")
+    def metrics():
+        # With several uvicorn/gunicorn workers, set PROMETHEUS_MULTIPROC_DIR so
+        # every worker writes its samples there and /metrics aggregates them.
+        if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+            from prometheus_client import multiprocess
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -6,20 +6,51 @@ def get_embedder():
         embedder_global = SentenceTransformer('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
     return embedder_global
 from sentence_transformers import util
-from rank_bm25 import BM25Okapi
-def hybrid_retrieve(query, all_chunks, chunk_embeddings, embedder=None, top_k=3, alpha=0.7):
+from text_analysis import LexicalIndex
+from index_snapshot import load_snapshot
+from query_expansion import expand_query, update_expansion_index
+from speculation import Speculation, similarity
+from fusion import fuse, collapse, MAX_CANDIDATES
+from metrics import get_logger, stage_timer, RERANK_CALLS
+from rerank import Deadline, order_candidates, resolve_texts, rerank
+from code_index import update_code_index, load_code_index, fetch_chunks, query_within, split_code_prefix, PREFIX_RESULTS
+from sparse_encoder import HYBRID_ALPHA, index_metric, update_sparse_encoder, save_sparse_encoder, load_sparse_encoder, hybrid_query, unit_rows
+from dedup import update_dedup_index, load_dedup_index, cluster_upload, cluster_key
+from chunk_store import get_chunk_store, stored_records, vector_position
+from corpus_store import load_corpus
+from chunk_metadata import compact_metadata, filter_candidates, LOCAL_FILTER_OVERFETCH
+
+SOURCE = "dei"
+logger = get_logger(SOURCE)
+CODE_INDEX_PATH = "code_index_dei.json"
+CHUNK_STORE_PATH = "chunk_store_dei.sqlite"
+EXPANSION_INDEX_PATH = "expansion_index_dei.npz"
+SPARSE_ENCODER_PATH = "sparse_encoder_dei.json"
+DEDUP_INDEX_PATH = "dedup_index_dei.npz"
+
+def hybrid_retrieve(query, all_chunks, chunk_embeddings, embedder=None, top_k=3, alpha=0.7, return_scores=False, positions=None, lexical_index=None):
+    """
+    Returns positions in all_chunks, like the chunk IDs of pinecone_retrieve;
+    only the chunks at `positions` are searched when given. BM25 uses
+    `lexical_index`, built from all_chunks when not given.
+    """
+    ids = range(len(all_chunks)) if positions is None else positions
+    if positions is not None:
+        chunk_embeddings = chunk_embeddings[positions]
     # Semantic search
     if embedder is None:
         embedder = get_embedder()
-    query_emb = embedder.encode(query, convert_to_tensor=True)
-    semantic_hits = util.semantic_search(query_emb, chunk_embeddings, top_k=len(all_chunks))[0]
+    with stage_timer(SOURCE, "encode"):
+        query_emb = embedder.encode(query, convert_to_tensor=True)
+    with stage_timer(SOURCE, "vector_query"):
+        semantic_hits = util.semantic_search(query_emb, chunk_embeddings, top_k=len(ids))[0]
     semantic_scores = {hit['corpus_id']: hit['score'] for hit in semantic_hits}
 
-    # BM25 keyword search
-    tokenized_chunks = [chunk.lower().split() for chunk in all_chunks]
-    bm25 = BM25Okapi(tokenized_chunks)
-    tokenized_query = query.lower().split()
-    bm25_scores = bm25.get_scores(tokenized_query)
+    # BM25 keyword search over the pre-tokenized corpus
+    if lexical_index is None:
+        lexical_index = LexicalIndex.build(all_chunks)
+    with stage_timer(SOURCE, "bm25"):
+        bm25_scores = lexical_index.scores(query, positions)
     import numpy as np
     # Normalize BM25 scores to [0,1]
     bm25_min = min(bm25_scores) if len(bm25_scores) > 0 else 0
@@ -27,7 +58,7 @@ def hybrid_retrieve(query, all_chunks, chunk_embeddings, embedder=None, top_k=3,
     bm25_scores_norm = [(score - bm25_min) / (bm25_max - bm25_min + 1e-8) for score in bm25_scores]
 
     # Normalize semantic scores to [0,1]
-    sem_scores_list = [semantic_scores.get(idx, 0) for idx in range(len(all_chunks))]
+    sem_scores_list = [semantic_scores.get(idx, 0) for idx in range(len(ids))]
     sem_min = min(sem_scores_list) if sem_scores_list else 0
     sem_max = max(sem_scores_list) if sem_scores_list else 1
     semantic_scores_norm = [(score - sem_min) / (sem_max - sem_min + 1e-8) for score in sem_scores_list]
@@ -38,14 +69,16 @@ def hybrid_retrieve(query, all_chunks, chunk_embeddings, embedder=None, top_k=3,
 
     # Combine scores
     combined_scores = {}
-    for idx in range(len(all_chunks)):
+    for idx in range(len(ids)):
         bm25_score = bm25_softmax[idx]
         sem_score = sem_softmax[idx]
         combined_scores[idx] = alpha * bm25_score + (1 - alpha) * sem_score
 
     # Get top_k indices
     top_indices = sorted(combined_scores, key=lambda i: combined_scores[i], reverse=True)[:top_k]
-    return [all_chunks[i] for i in top_indices]
+    if return_scores:
+        return [(ids[i], combined_scores[i]) for i in top_indices]
+    return [ids[i] for i in top_indices]
 import os
 import re
 import torch
@@ -72,176 +105,304 @@ def get_pinecone_index(index_name="dei-chunks", dimension=384, metric="cosine",
     return pc.Index(index_name)
 
 def upload_chunks_to_pinecone(chunks, chunk_embeddings, batch_size=70, index_name="dei-chunks", namespace="default", start_index=0):
-    print(f"[Main] Preparing to upload DEI chunks to Pinecone from chunk_{start_index} to chunk_{start_index + len(chunks) - 1}...")
+    logger.info(f"[Main] Preparing to upload DEI chunks to Pinecone from chunk_{start_index} to chunk_{start_index + len(chunks) - 1}...")
     ids = [f"chunk_{i}" for i in range(start_index, start_index + len(chunks))]
+    # Full text and parsed records go to the local chunk store, the index only gets small filterable fields
+    records = [parse_chunk(chunk) for chunk in chunks]
+    get_chunk_store(CHUNK_STORE_PATH, create=True).write(chunks, start=start_index, records=records)
     metadatas = [
-        {"chunk": chunk} for chunk in chunks
+        compact_metadata(chunk, SOURCE) for chunk in chunks
     ]
-    index = get_pinecone_index(index_name=index_name, dimension=chunk_embeddings.shape[1])
-    for i in range(0, len(chunks), batch_size):
-        batch_ids = ids[i:i+batch_size]
-        batch_embs = chunk_embeddings[i:i+batch_size]
-        batch_metas = metadatas[i:i+batch_size]
+    # Sparse values need a dotproduct index; unit-length dense vectors keep the dense score a cosine
+    index = get_pinecone_index(index_name=index_name, dimension=chunk_embeddings.shape[1], metric="dotproduct" if HYBRID_ALPHA > 0 else "cosine")
+    # An index created before hybrid search keeps its cosine metric, which rejects sparse values
+    hybrid = HYBRID_ALPHA > 0 and index_metric(index_name) == "dotproduct"
+    if HYBRID_ALPHA > 0 and not hybrid:
+        logger.warning(f"[Main] Pinecone index '{index_name}' does not use the dotproduct metric: uploading dense vectors only. Delete it and upload again for hybrid search.")
+    dense = unit_rows(chunk_embeddings)
+    encoder, sparse = update_sparse_encoder(SPARSE_ENCODER_PATH, chunks, SOURCE, start=start_index) if hybrid else (None, None)
+    # Near-duplicate items (by description) get one vector, the representative's
+    dedup = update_dedup_index(DEDUP_INDEX_PATH, [" ".join(item["description"] for activity in record for item in activity["resources"]) or chunk for chunk, record in zip(chunks, records)],
+                               [cluster_key(metadata) for metadata in metadatas], SOURCE, start=start_index)
+    uploaded = cluster_upload(index, dedup, start_index, len(chunks), metadatas, namespace=namespace)
+    for i in range(0, len(uploaded), batch_size):
         to_upsert = [
-            (batch_ids[j], batch_embs[j], batch_metas[j])
-            for j in range(len(batch_ids))
+            {"id": ids[j], "values": dense[j].tolist(), "metadata": metadatas[j]}
+            for j in uploaded[i:i+batch_size]
         ]
+        if sparse is not None:
+            for j, vector in zip(uploaded[i:i+batch_size], to_upsert):
+                vector["sparse_values"] = sparse[j]
         index.upsert(vectors=to_upsert, namespace=namespace)
-    print("[Main] DEI embeddings uploaded to Pinecone.")
+    # Only once the sparse vectors are in the index: queries send them as soon as the file exists
+    save_sparse_encoder(SPARSE_ENCODER_PATH, encoder, SOURCE)
+    logger.info(f"[Main] {len(uploaded)} DEI embeddings uploaded to Pinecone.")
+    update_code_index(CODE_INDEX_PATH, chunks, SOURCE, start=start_index)
+    # DEI items have no activity title: their descriptions are the labels
+    titles = [item["description"] for record in records for activity in record for item in activity["resources"]]
+    update_expansion_index(EXPANSION_INDEX_PATH, titles, get_embedder(), SOURCE, start=start_index)
 
-def pinecone_retrieve(query, top_k=5, index_name="dei-chunks", namespace="default"):
+def pinecone_retrieve(query, top_k=5, index_name="dei-chunks", namespace="default", return_scores=False, positions=None, prefix="", filter=None):
     embedder = get_embedder()
-    query_emb = embedder.encode(query, convert_to_numpy=True).tolist()
-    index = get_pinecone_index(index_name=index_name)
-    result = index.query(vector=query_emb, top_k=top_k, include_metadata=True, namespace=namespace)
-    hits = result.get('matches', [])
-    return [hit['metadata'].get('chunk', hit['id']) for hit in hits]
+    with stage_timer(SOURCE, "encode"):
+        query_emb = embedder.encode(query, convert_to_numpy=True)
+        # Dense and BM25 sparse vector in one query, when the index was uploaded with both
+        vectors = hybrid_query(query_emb, query, load_sparse_encoder(SPARSE_ENCODER_PATH, SOURCE))
+    # Returns chunk IDs: texts and records are looked up in the chunk store only for the candidates that need them
+    with stage_timer(SOURCE, "vector_query"):
+        index = get_pinecone_index(index_name=index_name)
+        dedup = load_dedup_index(DEDUP_INDEX_PATH, SOURCE)
+        if positions is not None and dedup is not None:
+            # Near-duplicates are searched through their representative
+            positions = dedup.representatives_of(positions)
+        if positions is not None:
+            # Only chunks under a code prefix
+            hits = query_within(index, vectors["vector"], positions, top_k=top_k, namespace=namespace, filter=filter, include_metadata=False,
+                                sparse_vector=vectors.get("sparse_vector"), prefix_filter=chapter_filter(prefix))
+        else:
+            hits = index.query(**vectors, top_k=top_k, include_metadata=False, namespace=namespace, filter=filter).get('matches', [])
+    if return_scores:
+        return [(vector_position(hit['id']), hit.get('score', 0)) for hit in hits]
+    return [vector_position(hit['id']) for hit in hits]
+
+# For DEI_chunks.txt format: Code: <code> Description: <desc> Unit: <unit> Price: <price>
+# Updated regex: allow for empty unit value (unit can be empty or any non-newline string)
+ITEM_PATTERN = re.compile(r"Code:\s*([^\s]+)\s+Description:\s*(.*?)\s+Unit:\s*([^\n]*)\s+Price:\s*([0-9]+\.[0-9]{2})")
+
+# Helper to parse a chunk into the required structure
+def parse_chunk(chunk):
+    results = []
+    matches = ITEM_PATTERN.findall(chunk)
+    resources = []
+    for code, desc, unit, price in matches:
+        resources.append({
+            "code": code,
+            "description": desc,
+            "unit": unit.strip(),
+            "price": price,
+            "total": "",
+            "formula": "",
+            "quantity": ""
+        })
+    # Each chunk is a flat resource list, so wrap in a single result object
+    if resources:
+        results.append({
+            "code": "",
+            "title": "",
+            "unit": "",
+            "quantity": "",
+            "resources": resources
+        })
+    return results
+
+def match_code(query, snapshot=None):
+    """
+    Looks a code-shaped query up in the code index of the Pinecone upload, or of
+    `snapshot` when searching locally. Returns (kind, positions, rest) as
+    CodeIndex.match, or (None, [], query) when there is no code index.
+    """
+    index = load_code_index(CODE_INDEX_PATH, SOURCE) if snapshot is None else snapshot.code_index
+    if index is None:
+        return None, [], query
+    return index.match(query)
+
+def chapter_filter(prefix):
+    # Pinecone filter on the code_prefix metadata of the chunks under a code prefix
+    index = load_code_index(CODE_INDEX_PATH, SOURCE) if prefix else None
+    return index.prefix_filter(prefix) if index is not None else None
 
-def embed_and_retrieve_dei(query, all_chunks_file="DEI_chunks.txt", top_k=3, embeddings_path="chunk_embeddings_dei.pt", use_pinecone=True):
+def chunks_at(positions, snapshot=None):
+    """
+    Chunk texts by ID, in order (None where missing): from `snapshot` when
+    searching locally, the chunk store, or the vector metadata of uploads made
+    before it existed.
+    """
+    if snapshot is not None:
+        return snapshot.corpus.get_many(positions)
+    store = get_chunk_store(CHUNK_STORE_PATH)
+    if store is None:
+        return fetch_chunks(get_pinecone_index(), positions)
+    return store.get_many(positions)
+
+def records_at(positions, snapshot=None):
+    """
+    Parsed resources of the chunks at `positions`, as written by the uploader
+    or the snapshot builder; chunks without a stored record (older uploads)
+    are parsed here.
+    """
+    store = get_chunk_store(CHUNK_STORE_PATH) if snapshot is None else snapshot.store
+    with stage_timer(SOURCE, "parse"):
+        records = stored_records(store, positions, parse_chunk, lambda missing: chunks_at(missing, snapshot))
+    return [activity for record in records for activity in record]
+
+def code_results(kind, positions, query, snapshot=None):
+    """
+    Parsed chunks for a code match; a chapter prefix lists its first chunks in code order.
+    """
+    positions = positions[:PREFIX_RESULTS]
+    logger.info(f"[RAG] Code {kind} match for '{query}': {len(positions)} chunk(s)")
+    return records_at(positions, snapshot)
+
+def embed_and_retrieve_dei(query, all_chunks_file="DEI_chunks.txt", top_k=3, embeddings_path="chunk_embeddings_dei.pt", use_pinecone=True, deadline=None, filter=None,
+                           version=None, refinement=None):
+    """
+    `refinement` is a Speculation of the caller's Mistral refinement of the
+    query: the raw query is searched while it runs, and its reply replaces the
+    query unless the raw query's best hit cancelled it.
+    """
     import re
+    if deadline is None:
+        deadline = Deadline()
+    # Pinecone holds one version of the price list: a pinned one is searched in its snapshot
+    if version is not None:
+        use_pinecone = False
     try:
         from mistral_utils import answer_question
     except ImportError:
-        def answer_question(q):
+        def answer_question(q, task=None, cancel=None):
             return q  # fallback: identity
-    with open(all_chunks_file, "r", encoding="utf-8") as f:
-        all_chunks = [c.strip() for c in f if c.strip()]
     embedder = get_embedder()
-    chunk_embeddings = None
+    snapshot = None
     if not use_pinecone:
-        # Only generate/load .pt file if using local retrieval
-        if os.path.exists(embeddings_path):
-            chunk_embeddings = torch.load(embeddings_path, map_location='cpu')
-            if len(chunk_embeddings) != len(all_chunks):
-                chunk_embeddings = embedder.encode(all_chunks, convert_to_tensor=True, show_progress_bar=True)
-                torch.save(chunk_embeddings, embeddings_path)
+        # Corpus, embeddings and indexes of one snapshot, memory-mapped and shared by every worker;
+        # this search keeps it even if another one is activated meanwhile
+        snapshot = load_snapshot(all_chunks_file, SOURCE, embedder, parse_chunk, embeddings_path, version)
+        all_chunks, chunk_embeddings, lexical_index = snapshot.corpus, snapshot.embeddings, snapshot.lexical_index
+
+    # A pasted code (or chapter) is answered from the code index, without Mistral or vector search
+    with stage_timer(SOURCE, "code_lookup"):
+        kind, positions, rest = match_code(query, snapshot)
+        if kind == "exact" or (kind == "prefix" and not rest):
+            return code_results(kind, positions, query, snapshot)
+    if kind == "prefix":
+        logger.info(f"[RAG] Searching {len(positions)} chunks under code prefix of '{query}'")
+        prefix = split_code_prefix(query)[0]
+        query = rest
+    else:
+        positions, prefix = None, ""
+
+    def retrieve(q, top_k):
+        if use_pinecone:
+            return pinecone_retrieve(q, top_k=top_k, return_scores=True, positions=positions, prefix=prefix, filter=filter)
+        # No metadata index locally: score more candidates, then filter them
+        candidates = hybrid_retrieve(q, all_chunks, chunk_embeddings, embedder, top_k=top_k * LOCAL_FILTER_OVERFETCH if filter else top_k, alpha=0.1,
+                                     return_scores=True, positions=positions, lexical_index=lexical_index)
+        return filter_candidates(candidates, all_chunks, SOURCE, filter, top_k)
+
+    def search_speculatively(q, speculation):
+        # Candidates of q, and whether its best hit was confident enough to cancel the refinement
+        logger.info(f"[RAG] Searching with raw query while refining: {q}")
+        candidates = retrieve(q, top_k=5)
+        if not candidates:
+            best = 0.0
+        elif use_pinecone:
+            best = max(score for _, score in candidates)
         else:
-            chunk_embeddings = embedder.encode(all_chunks, convert_to_tensor=True, show_progress_bar=True)
-            torch.save(chunk_embeddings, embeddings_path)
+            best = similarity(embedder, q, chunk_embeddings[candidates[0][0]])
+        return candidates, speculation.settle(best)
 
-    # Use Mistral to generate a list of strong synonym queries (activity categories) in Italian
-    try:
-        refined_query = answer_question(f"Define the construction activity category in italian that describes it best in Prezziario with one to max 10 words, exclude any other commentary, for: {query}")
-        # If the model returns a dict with error or rate limit, fallback
-        if isinstance(refined_query, dict) and ("error" in refined_query or "rate limit" in str(refined_query).lower()):
-            print("[RAG] Mistral failed or rate limit exceeded, using original query.")
+    # One ranking per searched query
+    rankings = []
+    searched = set()
+    confident = False
+    queries = None
+    if refinement is not None:
+        # The caller's refinement runs while the raw query is searched
+        candidates, confident = search_speculatively(query, refinement)
+        rankings.append(candidates)
+        searched.add(query)
+        if confident:
             queries = [query]
         else:
-            print(f"[RAG] Refined query/categories: {refined_query}")
-            if isinstance(refined_query, str):
-                queries = [q.strip() for q in re.split(r'[\n,;]+', refined_query) if q.strip()]
+            with stage_timer(SOURCE, "refine"):
+                refined_query = refinement.result()
+            if isinstance(refined_query, dict) and "error" in refined_query:
+                logger.warning("[RAG] Mistral failed or rate limit exceeded, using original query.")
+                queries = [query]
+            else:
+                query = refined_query
+    if queries is None:
+        # Synonym queries from the local expansion index; Mistral only when it is not confident
+        with stage_timer(SOURCE, "expand"):
+            queries = expand_query(query, EXPANSION_INDEX_PATH, SOURCE, get_embedder())
+    # Use Mistral to generate a list of strong synonym queries (activity categories) in Italian,
+    # while the query is searched; a confident hit cancels it
+    try:
+        if queries is None:
+            speculation = Speculation(SOURCE, lambda cancel, query=query: answer_question(f"Define the construction activity category in italian that describes it best in Prezziario with one to max 10 words, exclude any other commentary, for: {query}", task="refine", cancel=cancel))
+            if query not in searched:
+                candidates, confident = search_speculatively(query, speculation)
+                rankings.append(candidates)
+                searched.add(query)
+            if confident:
+                queries = [query]
             else:
-                queries = [str(refined_query)]
+                with stage_timer(SOURCE, "refine"):
+                    refined_query = speculation.result()
+                # If the model returns a dict with error or rate limit, fallback
+                if isinstance(refined_query, dict) and ("error" in refined_query or "rate limit" in str(refined_query).lower()):
+                    logger.warning("[RAG] Mistral failed or rate limit exceeded, using original query.")
+                    queries = [query]
+                else:
+                    logger.info(f"[RAG] Refined query/categories: {refined_query}")
+                    if isinstance(refined_query, str):
+                        queries = [q.strip() for q in re.split(r'[\n,;]+', refined_query) if q.strip()]
+                    else:
+                        queries = [str(refined_query)]
     except Exception as e:
-        print(f"[RAG] Mistral exception: {e}. Using original query.")
+        logger.warning(f"[RAG] Mistral exception: {e}. Using original query.")
         queries = [query]
     # Retrieve candidates for each synonym/category
-    all_candidates = []
     for q in queries:
-        print(f"[RAG] Searching with synonym/category: {q}")
-        if use_pinecone:
-            candidates = pinecone_retrieve(q, top_k=5)
-        else:
-            candidates = hybrid_retrieve(q, all_chunks, chunk_embeddings, embedder, top_k=5, alpha=0.1)
-        all_candidates.extend(candidates)
-    # Deduplicate
-    all_candidates = list(dict.fromkeys(all_candidates))
+        if q in searched:
+            continue
+        logger.info(f"[RAG] Searching with synonym/category: {q}")
+        rankings.append(retrieve(q, top_k=5))
+    # Chunks found by several synonyms first, so the re-rank can usually stop early
+    texts = {}
+    with stage_timer(SOURCE, "fusion"):
+        all_candidates = resolve_texts(SOURCE, fuse(rankings), texts, lambda ids: chunks_at(ids, snapshot))
+        all_candidates = collapse(SOURCE, all_candidates, texts, None if use_pinecone else chunk_embeddings)
     # Re-rank with Mistral
-    best_accuracy = 0
-    best_chunk = None
-    best_idx = 0
-    for i, chunk in enumerate(all_candidates):
-        title = chunk.split("\n")[0] if "\n" in chunk else chunk[:500]
-        prompt = f"Is the following construction activity relevant to the query '{query}'? Activity: '{title}'. Return number from 1 to 100 representing accuracy."
-        try:
-            acc_str = answer_question(prompt)
-            try:
-                accuracy = int(''.join(filter(str.isdigit, str(acc_str))))
-            except Exception:
-                accuracy = 0
-        except Exception:
-            accuracy = 0
-        print(f"Chunk {i+1} title: {title}\nAccuracy: {accuracy}")
-        if accuracy > best_accuracy:
-            best_accuracy = accuracy
-            best_chunk = chunk
-            best_idx = i
-    # If best accuracy < 90, try alternative phrasings, unless Mistral failed/rate limited
+    best_accuracy, best_chunk, best_idx, rerank_calls = rerank(query, all_candidates[:MAX_CANDIDATES], answer_question, SOURCE, 85, deadline, texts=texts)
+    # If best accuracy < 85, try alternative phrasings, unless Mistral failed/rate limited or time is short
     mistral_failed = False
-    if best_accuracy < 85 and queries != [query]:
-        try:
-            print(f"[RAG] Best accuracy only {best_accuracy}, generating alternative phrasings...")
-            alt_queries = answer_question(f"Give 5 alternative ways to describe the same construction activity as: {query}, in italian, each as a single line, no commentary.")
-            if isinstance(alt_queries, dict) and ("error" in alt_queries or "rate limit" in str(alt_queries).lower()):
-                print("[RAG] Mistral failed or rate limit exceeded for alternatives, skipping.")
+    if best_accuracy < 85 and (queries != [query] or confident) and deadline.near():
+        deadline.degrade(SOURCE, "skipped_alt_phrasings")
+    elif best_accuracy < 85 and (queries != [query] or confident):
+        with stage_timer(SOURCE, "alt_phrasings"):
+            try:
+                logger.info(f"[RAG] Best accuracy only {best_accuracy}, generating alternative phrasings...")
+                alt_queries = answer_question(f"Give 5 alternative ways to describe the same construction activity as: {query}, in italian, each as a single line, no commentary.", task="alternatives")
+                if isinstance(alt_queries, dict) and ("error" in alt_queries or "rate limit" in str(alt_queries).lower()):
+                    logger.warning("[RAG] Mistral failed or rate limit exceeded for alternatives, skipping.")
+                    mistral_failed = True
+                else:
+                    if isinstance(alt_queries, str):
+                        alt_queries = [q.strip() for q in re.split(r'[\n,;]+', alt_queries) if q.strip()]
+                    elif not isinstance(alt_queries, list):
+                        alt_queries = [str(alt_queries)]
+                    for alt in alt_queries:
+                        if best_accuracy >= 85:
+                            break
+                        if deadline.near():
+                            deadline.degrade(SOURCE, "skipped_alt_phrasings")
+                            break
+                        logger.info(f"[RAG] Trying alternative: {alt}")
+                        candidates = retrieve(alt, top_k=5)
+                        candidates = resolve_texts(SOURCE, order_candidates(candidates), texts, lambda ids: chunks_at(ids, snapshot))
+                        best_accuracy, best_chunk, best_idx, calls = rerank(query, candidates, answer_question, SOURCE, 85, deadline,
+                                                                            best=(best_accuracy, best_chunk, best_idx), label="[ALT] Chunk", texts=texts)
+                        rerank_calls += calls
+            except Exception as e:
+                logger.warning(f"[RAG] Mistral exception for alternatives: {e}. Skipping alternatives.")
                 mistral_failed = True
-            else:
-                if isinstance(alt_queries, str):
-                    alt_queries = [q.strip() for q in re.split(r'[\n,;]+', alt_queries) if q.strip()]
-                elif not isinstance(alt_queries, list):
-                    alt_queries = [str(alt_queries)]
-                for alt in alt_queries:
-                    print(f"[RAG] Trying alternative: {alt}")
-                    if use_pinecone:
-                        candidates = pinecone_retrieve(alt, top_k=5)
-                    else:
-                        candidates = hybrid_retrieve(alt, all_chunks, chunk_embeddings, embedder, top_k=5, alpha=0.1)
-                    for i, chunk in enumerate(candidates):
-                        title = chunk.split("\n")[0] if "\n" in chunk else chunk[:500]
-                        prompt = f"Is the following construction activity relevant to the query '{query}'? Activity: '{title}'. Return number from 1 to 100 representing accuracy."
-                        try:
-                            acc_str = answer_question(prompt)
-                            try:
-                                accuracy = int(''.join(filter(str.isdigit, str(acc_str))))
-                            except Exception:
-                                accuracy = 0
-                        except Exception:
-                            accuracy = 0
-                        print(f"[ALT] Chunk {i+1} title: {title}\nAccuracy: {accuracy}")
-                        if accuracy > best_accuracy:
-                            best_accuracy = accuracy
-                            best_chunk = chunk
-                            best_idx = i
-        except Exception as e:
-            print(f"[RAG] Mistral exception for alternatives: {e}. Skipping alternatives.")
-            mistral_failed = True
-    print(f"[RAG] Best accuracy: {best_accuracy} (chunk {best_idx+1})")
-    print("[RAG] Pipeline complete.")
-    # Helper to parse a chunk into the required structure
-    def parse_chunk(chunk):
-        # For DEI_chunks.txt format: Code: <code> Description: <desc> Unit: <unit> Price: <price>
-        import re
-        results = []
-        # Updated regex: allow for empty unit value (unit can be empty or any non-newline string)
-        pattern = r"Code:\s*([^\s]+)\s+Description:\s*(.*?)\s+Unit:\s*([^\n]*)\s+Price:\s*([0-9]+\.[0-9]{2})"
-        matches = re.findall(pattern, chunk)
-        resources = []
-        for code, desc, unit, price in matches:
-            resources.append({
-                "code": code,
-                "description": desc,
-                "unit": unit.strip(),
-                "price": price,
-                "total": "",
-                "formula": "",
-                "quantity": ""
-            })
-        # Each chunk is a flat resource list, so wrap in a single result object
-        if resources:
-            results.append({
-                "code": "",
-                "title": "",
-                "unit": "",
-                "quantity": "",
-                "resources": resources
-            })
-        return results
-
-    # Map all candidates using the parser and flatten the list
-    mapped = []
-    for chunk in all_candidates:
-        mapped.extend(parse_chunk(chunk))
-    return mapped
+    RERANK_CALLS.labels(source=SOURCE).observe(rerank_calls)
+    logger.info(f"[RAG] Best accuracy: {best_accuracy} (chunk {best_idx+1})", extra={"fields": {"best_accuracy": best_accuracy, "rerank_calls": rerank_calls, "degraded": deadline.degraded}})
+    logger.info("[RAG] Pipeline complete.")
+    # Parsed records of all candidates, flattened; a selected representative comes with its near-duplicates
+    dedup = load_dedup_index(DEDUP_INDEX_PATH, SOURCE) if use_pinecone else None
+    return records_at(all_candidates if dedup is None else dedup.expand(all_candidates, best_chunk), snapshot)
 
 if __name__ == "__main__":
     # Use pre-chunked file for upload, not re-chunking from raw source
@@ -249,27 +410,15 @@ if __name__ == "__main__":
     embeddings_path = "chunk_embeddings_dei.pt"
     if not os.path.exists(corpus_path):
         raise RuntimeError(f"Corpus file '{corpus_path}' not found. Please generate it before uploading.")
-    with open(corpus_path, "r", encoding="utf-8") as f:
-        all_chunks = [line.strip() for line in f if line.strip()]
-    # --- Check for oversized chunks and skip them ---
-    max_metadata_bytes = 40960
-    filtered_corpus = []
-    filtered_indices = []
-    for idx, chunk in enumerate(all_chunks):
-        meta = {"chunk": chunk}
-        meta_bytes = len(json.dumps(meta, ensure_ascii=False).encode("utf-8"))
-        if meta_bytes > max_metadata_bytes:
-            print(f"[Warning] Skipping chunk at index {idx} (ID chunk_{idx}) due to metadata size {meta_bytes} bytes > 40kB limit.")
-            continue
-        filtered_corpus.append(chunk)
-        filtered_indices.append(idx)
-    if not filtered_corpus:
-        raise RuntimeError("No valid chunks to upload after filtering oversized chunks.")
+    all_chunks = load_corpus(corpus_path, SOURCE)
+    if not len(all_chunks):
+        raise RuntimeError(f"Corpus file '{corpus_path}' is empty. Please generate or check your chunks.")
+    # Metadata is small, so no chunk is too large for Pinecone
     embedder_local = get_embedder()
-    print("[Main] Encoding chunks for retrieval...")
-    chunk_embeddings = embedder_local.encode(filtered_corpus, convert_to_numpy=True, show_progress_bar=True)
-    # --- Upload all valid chunks to Pinecone ---
-    upload_chunks_to_pinecone(filtered_corpus, chunk_embeddings, batch_size=70, index_name="dei-chunks", namespace="default", start_index=0)
+    logger.info("[Main] Encoding chunks for retrieval...")
+    chunk_embeddings = embedder_local.encode(all_chunks, convert_to_numpy=True, show_progress_bar=True)
+    # --- Upload all chunks to Pinecone ---
+    upload_chunks_to_pinecone(all_chunks, chunk_embeddings, batch_size=70, index_name="dei-chunks", namespace="default", start_index=0)
     # Retrieval example
     user_query = input("Enter your query: ")
     # To use local retrieval, set use_pinecone=False
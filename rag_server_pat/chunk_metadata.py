@@ -0,0 +1,76 @@
+"""
+Compact vector metadata: the small filterable fields uploaded with each chunk
+in place of its full text (kept in the chunk store).
+"""
+import os
+import re
+from code_index import extract_codes, code_prefixes
+from chunk_store import normalize_unit, matches_filter
+
+# Year of the price list the uploaded chunks come from
+SOURCE_YEAR = int(os.getenv("SOURCE_YEAR", "2025"))
+
+# Unit and price of each source's chunk format; for PAT the price is the Summary's application price
+UNIT_PATTERNS = {
+    "pat": re.compile(r"Unit:\s*([^,\s]*)"),
+    "piemonte": re.compile(r"U\.M\.:\s*([^,\n]*)"),
+    "dei": re.compile(r"Unit:\s*(.*?)\s+Price:"),
+}
+PRICE_PATTERNS = {
+    "pat": re.compile(r"'prezzo_applicazione':\s*([\d.]+)"),
+    "piemonte": re.compile(r"Euro:\s*([^,\n]*)"),
+    "dei": re.compile(r"Price:\s*([0-9]+\.[0-9]{2})"),
+}
+# Chapter of a code: "B.02.10" for PAT, "A13" for DEI; Piemonte uses its categories
+CHAPTER_PATTERNS = {
+    "pat": re.compile(r"^[A-Z]\.\d{2}\.\d{2}"),
+    "dei": re.compile(r"^[A-Z]+\d{2}"),
+}
+# Local searches filter after scoring, so they score this many times top_k candidates
+LOCAL_FILTER_OVERFETCH = 20
+
+
+def parse_price(value):
+    try:
+        return float(value.strip())
+    except ValueError:
+        return None
+
+
+def compact_metadata(chunk, source, category=None):
+    """
+    Metadata uploaded with a chunk: code, chapter-level code prefixes, unit,
+    price, category and source year. Code and price are the chunk's first;
+    missing fields are left out, since Pinecone rejects null values.
+    """
+    metadata = {"source_year": SOURCE_YEAR}
+    codes = extract_codes(chunk, source)
+    if codes:
+        metadata["code"] = codes[0]
+    # Prefixes of all the chunk's codes, so a chapter filter matches a chunk with any code under it
+    prefixes = sorted({prefix for code in codes for prefix in code_prefixes(code)})
+    if prefixes:
+        metadata["code_prefix"] = prefixes
+    # A Piemonte activity lists several Works, possibly in different units: a list matches any of them
+    units = [u for u in dict.fromkeys(normalize_unit(u) for u in UNIT_PATTERNS[source].findall(chunk)) if u]
+    if units:
+        metadata["unit"] = units[0] if len(units) == 1 else units
+    price = PRICE_PATTERNS[source].search(chunk)
+    if price and parse_price(price.group(1)) is not None:
+        metadata["price"] = parse_price(price.group(1))
+    if category is None and codes and source in CHAPTER_PATTERNS:
+        chapter = CHAPTER_PATTERNS[source].match(codes[0])
+        category = chapter.group(0) if chapter else None
+    if category:
+        metadata["category"] = category
+    return metadata
+
+
+def filter_candidates(scored, chunks, source, flt, top_k):
+    """
+    Keeps the (chunk ID, score) pairs of a local search whose compact metadata
+    (computed from `chunks[ID]`) matches a Pinecone-style filter.
+    """
+    if not flt:
+        return scored[:top_k]
+    return [(pos, score) for pos, score in scored if matches_filter(compact_metadata(chunks[pos], source), flt)][:top_k]
@@ -0,0 +1,274 @@
+"""
+Versioned, read-only index snapshots for local search, shared by every worker
+process of a server. The routes search them with LOCAL_SEARCH=1, and for
+requests pinned to a version; Pinecone searches never load one.
+
+A snapshot holds everything local search reads, built out of process into
+<name>.snapshots/<version>/: the corpus (blob and offsets, as in
+corpus_store), the chunk embeddings (embeddings.npy), the lexical index, the
+code index and the parsed records (records.sqlite). Arrays, and the sorted
+code and term lists the indexes bisect, are memory-mapped, so workers share
+their pages through the OS page cache and memory stays flat as workers are
+added; records are read from SQLite per request.
+
+The CURRENT file names the active version and is replaced atomically when
+another one is activated (--activate, or the /admin/snapshots endpoints).
+Workers read it at the start of every search: they switch on their next
+request, while searches in flight finish on the snapshot they started with.
+Older versions stay on disk, and searchable by name, until pruned.
+
+    python index_snapshot.py rag_training chunks.txt --version 2026 --embeddings chunk_embeddings_pat.pt --activate
+
+The first argument is the server's pipeline module, which provides SOURCE,
+get_embedder and parse_chunk. When nothing was published yet, the first
+worker that needs a snapshot builds and activates one, under a file lock so
+the others wait for it instead of building their own.
+"""
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import shutil
+import warnings
+import argparse
+import importlib
+from contextlib import contextmanager
+import numpy as np
+import torch
+from metrics import get_logger, record_cache
+from corpus_store import Corpus, corpus_paths, load_corpus
+from text_analysis import LexicalIndex
+from code_index import CodeIndex, MappedCodeIndex
+from chunk_store import ChunkStore
+
+# Versions kept on disk besides the active one (and any built but not yet activated)
+KEEP_SNAPSHOTS = int(os.getenv("SNAPSHOT_KEEP", "2"))
+VERSION_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.\-]*")
+
+
+def snapshot_root(corpus_path):
+    return os.path.splitext(os.path.abspath(corpus_path))[0] + ".snapshots"
+
+
+def corpus_stamp(corpus_path):
+    return [os.path.getmtime(corpus_path), os.path.getsize(corpus_path)]
+
+
+def check_version(version):
+    # Versions come from requests too: only plain names, never paths
+    if not VERSION_PATTERN.fullmatch(version or "") or version.endswith(".tmp"):
+        raise ValueError(f"Invalid snapshot version '{version}'.")
+    return version
+
+
+def current_version(root):
+    try:
+        with open(os.path.join(root, "CURRENT"), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def active_version(corpus_path):
+    return current_version(snapshot_root(corpus_path))
+
+
+def list_snapshots(root):
+    """
+    Manifests of the versions on disk, oldest first.
+    """
+    manifests = []
+    if os.path.isdir(root):
+        for name in os.listdir(root):
+            path = os.path.join(root, name, "manifest.json")
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    manifests.append(json.load(f))
+    return sorted(manifests, key=lambda m: m["created"])
+
+
+@contextmanager
+def build_lock(root):
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _saved_embeddings(embeddings_path, n_chunks):
+    # A chunk_embeddings_*.pt file written before snapshots, if it still matches the corpus
+    if not embeddings_path or not os.path.exists(embeddings_path):
+        return None
+    try:
+        embeddings = torch.load(embeddings_path, map_location="cpu")
+        embeddings = embeddings.cpu().numpy() if hasattr(embeddings, "cpu") else np.asarray(embeddings)
+    except Exception:
+        return None
+    return embeddings if len(embeddings) == n_chunks else None
+
+
+def publish_snapshot(corpus_path, source, embedder, parse, embeddings_path=None, version=None, activate=False):
+    """
+    Builds a snapshot of a corpus file under `version` (by default, the build
+    time) and returns the version. It only serves searches once activated.
+    """
+    root = snapshot_root(corpus_path)
+    version = check_version(version or time.strftime("%Y%m%d-%H%M%S"))
+    path = os.path.join(root, version)
+    if os.path.exists(path):
+        raise ValueError(f"Snapshot version '{version}' already exists.")
+    stamp = corpus_stamp(corpus_path)
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    # The compiled corpus is copied, so later edits of the corpus file do not change this version
+    load_corpus(corpus_path, source)
+    for src, name in zip(corpus_paths(corpus_path), ("corpus.blob", "corpus.offsets.npy")):
+        shutil.copyfile(src, os.path.join(tmp, name))
+    corpus = Corpus(os.path.join(tmp, "corpus.blob"), os.path.join(tmp, "corpus.offsets.npy"))
+    embeddings = _saved_embeddings(embeddings_path, len(corpus))
+    if embeddings is None:
+        embeddings = embedder.encode(list(corpus), convert_to_numpy=True, show_progress_bar=True)
+    np.save(os.path.join(tmp, "embeddings.npy"), np.asarray(embeddings, dtype=np.float32))
+    LexicalIndex.build(corpus).save(tmp)
+    CodeIndex.from_chunks(corpus, source).save_mapped(tmp)
+    ChunkStore(os.path.join(tmp, "records.sqlite")).write([], records=[parse(chunk) for chunk in corpus])
+    manifest = {"version": version, "source": source, "created": time.time(), "corpus": os.path.basename(corpus_path),
+                "corpus_stamp": stamp, "n_chunks": len(corpus)}
+    with open(os.path.join(tmp, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+    get_logger(source).info(f"[Main] Snapshot {version} of {len(corpus)} chunks built in {root}.")
+    if activate:
+        activate_snapshot(root, version, source)
+    prune(root)
+    return version
+
+
+def activate_snapshot(root, version, source):
+    """
+    Points CURRENT at `version`. The rename is atomic: a worker reads either
+    the previous version or this one.
+    """
+    if not os.path.exists(os.path.join(root, check_version(version), "manifest.json")):
+        raise ValueError(f"Snapshot version '{version}' not found.")
+    with open(os.path.join(root, "CURRENT.tmp"), "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(os.path.join(root, "CURRENT.tmp"), os.path.join(root, "CURRENT"))
+    get_logger(source).info(f"[Main] Snapshot {version} activated in {root}.")
+
+
+def prune(root):
+    # Only versions older than the active one; workers still mapping one keep reading it
+    current = current_version(root)
+    manifests = list_snapshots(root)
+    names = [m["version"] for m in manifests]
+    if current not in names:
+        return
+    older = names[:names.index(current)]
+    for version in older[:max(len(older) - KEEP_SNAPSHOTS, 0)]:
+        shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+
+
+class Snapshot:
+    """
+    A published snapshot: `corpus`, `embeddings` (a tensor over the mapped
+    array, row i is chunk i), `lexical_index`, `code_index` and `store` (the
+    parsed records, by chunk ID).
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json"), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.version = self.manifest["version"]
+        self.corpus = Corpus(os.path.join(path, "corpus.blob"), os.path.join(path, "corpus.offsets.npy"))
+        array = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        # torch warns that the mapping is read-only; search never writes to it
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            self.embeddings = torch.from_numpy(array)
+        self.lexical_index = LexicalIndex.load(path)
+        self.code_index = MappedCodeIndex.load(path)
+        self.store = ChunkStore(os.path.join(path, "records.sqlite"))
+
+
+_loaded = {}
+
+
+def load_snapshot(corpus_path, source, embedder, parse, embeddings_path=None, version=None):
+    """
+    The active snapshot of a corpus file, or the one named `version`; each is
+    opened once per process. Callers keep the returned snapshot for the whole
+    search. When nothing was published yet, one is built and activated.
+    """
+    root = snapshot_root(corpus_path)
+    current = current_version(root)
+    if current is None:
+        with build_lock(root):
+            # Another worker may have published one while this one waited
+            current = current_version(root)
+            if current is None:
+                current = publish_snapshot(corpus_path, source, embedder, parse, embeddings_path, activate=True)
+    version = check_version(version or current)
+    snapshot = _loaded.get((root, version))
+    record_cache(source, "snapshot", hit=snapshot is not None)
+    if snapshot is None:
+        if not os.path.exists(os.path.join(root, version, "manifest.json")):
+            raise ValueError(f"Snapshot version '{version}' not found.")
+        snapshot = Snapshot(os.path.join(root, version))
+        if version == current and os.path.exists(corpus_path) and snapshot.manifest["corpus_stamp"] != corpus_stamp(corpus_path):
+            get_logger(source).warning(f"[RAG] {corpus_path} changed since snapshot {version}; build and activate a new one to search it.")
+        # Versions pruned from disk are dropped here too
+        for key in [key for key in _loaded if key[0] == root and not os.path.isdir(os.path.join(root, key[1]))]:
+            del _loaded[key]
+        _loaded[(root, version)] = snapshot
+    return snapshot
+
+
+def install_admin(app, corpus_path, source):
+    """
+    Adds /admin/snapshots (list versions) and /admin/snapshots/activate to a
+    FastAPI app. Both require the X-Admin-Token header to match ADMIN_TOKEN
+    and are disabled when it is not set.
+    """
+    from fastapi import Form, Header, HTTPException
+
+    def authorize(token):
+        expected = os.getenv("ADMIN_TOKEN")
+        if not expected or token != expected:
+            raise HTTPException(status_code=403, detail="Admin token missing or invalid.")
+
+    @app.get("/admin/snapshots")
+    def snapshots(x_admin_token: str = Header(None)):
+        authorize(x_admin_token)
+        root = snapshot_root(corpus_path)
+        return {"current": current_version(root), "versions": list_snapshots(root)}
+
+    @app.post("/admin/snapshots/activate")
+    def activate(version: str = Form(...), x_admin_token: str = Header(None)):
+        authorize(x_admin_token)
+        try:
+            activate_snapshot(snapshot_root(corpus_path), version, source)
+        except ValueError as e:
+            return {"error": str(e)}
+        return {"current": version}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a local search snapshot of a corpus file.")
+    parser.add_argument("pipeline", help="the server's pipeline module (rag_training, rag_txt_chunk_pipeline, rag_txt_chunk_pipeline_dei)")
+    parser.add_argument("corpus", help="corpus file, one chunk per line")
+    parser.add_argument("--version", help="version name, e.g. the price list year (default: build time)")
+    parser.add_argument("--embeddings", help="existing .pt embeddings to reuse when they match the corpus")
+    parser.add_argument("--activate", action="store_true", help="make it the active snapshot once built")
+    args = parser.parse_args()
+    sys.path.insert(0, os.getcwd())
+    pipeline = importlib.import_module(args.pipeline)
+    with build_lock(snapshot_root(args.corpus)):
+        publish_snapshot(args.corpus, pipeline.SOURCE, pipeline.get_embedder(), pipeline.parse_chunk,
+                         args.embeddings, args.version, args.activate)
@@ -1,16 +1,22 @@
 import re
 import ast
 
+# Compiled once: the uploader parses every chunk, searches only the chunks without a stored record
+CODE_PATTERN = re.compile(r"[A-Z]\.\d{2}\.\d{2}\.\d{4}\.\d{3}")
+ACTIVITY_PATTERN = re.compile(r"([A-Z]\.\d{2}\.\d{2}\.\d{4}\.\d{3})\s+(.+?)\s+Unit: (.*?), Quantity: (.*?) ")
+TITLE_PATTERN = re.compile(r"([A-Z]\.\d{2}\.\d{2}\.\d{4}\.\d{3})\s+(.+)")
+RESOURCE_PATTERN = re.compile(r"([A-Z]\.\d{2}\.\d{2}\.\d{4}\.\d{3})\s+([\s\S]+?)\|")
+SUMMARY_PATTERN = re.compile(r"Summary:\s*(\{.*\})")
+
 def parse_activity_chunks(raw_results):
     """
     Accepts a list of raw activity chunk strings (as returned by /search endpoint),
     parses each into structured JSON with code, title, unit, quantity, resources, and summary.
     """
     parsed_activities = []
-    code_pattern = r"[A-Z]\.\d{2}\.\d{2}\.\d{4}\.\d{3}"
     for chunk_str in raw_results:
         # Find the first code and title
-        code_title_match = re.match(r"([A-Z]\.\d{2}\.\d{2}\.\d{4}\.\d{3})\s+(.+?)\s+Unit: (.*?), Quantity: (.*?) ", chunk_str)
+        code_title_match = ACTIVITY_PATTERN.match(chunk_str)
         if code_title_match:
             code = code_title_match.group(1)
             title = code_title_match.group(2)
@@ -18,7 +24,7 @@ def parse_activity_chunks(raw_results):
             quantity = code_title_match.group(4)
         else:
             # fallback: try to get code and title only
-            code_title_match = re.match(r"([A-Z]\.\d{2}\.\d{2}\.\d{4}\.\d{3})\s+(.+)", chunk_str)
+            code_title_match = TITLE_PATTERN.match(chunk_str)
             code = code_title_match.group(1) if code_title_match else ''
             title = code_title_match.group(2) if code_title_match else chunk_str
             unit = ''
@@ -26,7 +32,7 @@ def parse_activity_chunks(raw_results):
 
         # Find all resource blocks (start with code pattern, not the first one)
         resource_blocks = []
-        for m in re.finditer(code_pattern, chunk_str):
+        for m in CODE_PATTERN.finditer(chunk_str):
             if m.start() == 0:
                 continue  # skip the first code (main activity)
             resource_blocks.append(m.start())
@@ -39,7 +45,7 @@ def parse_activity_chunks(raw_results):
             for i in range(len(resource_blocks)-1):
                 res_str = chunk_str[resource_blocks[i]:resource_blocks[i+1]]
                 # Parse resource details
-                res_code_match = re.match(r"([A-Z]\.\d{2}\.\d{2}\.\d{4}\.\d{3})\s+([\s\S]+?)\|", res_str)
+                res_code_match = RESOURCE_PATTERN.match(res_str)
                 if res_code_match:
                     res_code = res_code_match.group(1)
                     res_desc = res_code_match.group(2).strip()
@@ -75,7 +81,7 @@ def parse_activity_chunks(raw_results):
 
         # Parse summary (look for 'Summary:' and parse dict)
         summary = {}
-        summary_match = re.search(r"Summary:\s*(\{.*\})", chunk_str)
+        summary_match = SUMMARY_PATTERN.search(chunk_str)
         if summary_match:
             try:
                 summary_dict = ast.literal_eval(summary_match.group(1))
@@ -7,10 +7,33 @@ import numpy as np
 from dotenv import load_dotenv
 from pinecone import Pinecone, ServerlessSpec
 from sentence_transformers import SentenceTransformer, util
-from rank_bm25 import BM25Okapi
+from metrics import get_logger, stage_timer, RERANK_CALLS
+from rerank import Deadline, order_candidates, resolve_texts, rerank
+from code_index import update_code_index, load_code_index, fetch_chunks, query_within, split_code_prefix, PREFIX_RESULTS
+from sparse_encoder import HYBRID_ALPHA, index_metric, update_sparse_encoder, save_sparse_encoder, load_sparse_encoder, hybrid_query, unit_rows
+from dedup import update_dedup_index, load_dedup_index, cluster_upload, cluster_key
+from chunk_store import get_chunk_store, stored_records, vector_position
+from corpus_store import load_corpus
+from index_snapshot import load_snapshot
+from query_expansion import expand_query, update_expansion_index
+from semantic_cache import get_semantic_cache, cache_context
+from speculation import Speculation, similarity
+from fusion import fuse, collapse, MAX_CANDIDATES
+from parse_activity_chunks import parse_activity_chunks
+from chunk_metadata import compact_metadata, filter_candidates, LOCAL_FILTER_OVERFETCH
 
 load_dotenv()
 
+SOURCE = "pat"
+logger = get_logger(SOURCE)
+CODE_INDEX_PATH = "code_index_pat.json"
+CHUNK_STORE_PATH = "chunk_store_pat.sqlite"
+CORPUS_PATH = "chunks.txt"
+EMBEDDINGS_PATH = "chunk_embeddings_pat.pt"
+EXPANSION_INDEX_PATH = "expansion_index_pat.npz"
+SPARSE_ENCODER_PATH = "sparse_encoder_pat.json"
+DEDUP_INDEX_PATH = "dedup_index_pat.npz"
+
 def get_pinecone_index(index_name="pat-chunks", dimension=384, metric="cosine", region=None):
     api_key = os.getenv("PINECONE_API_KEY")
     if not api_key:
@@ -31,58 +54,100 @@ def get_pinecone_index(index_name="pat-chunks", dimension=384, metric="cosine",
     return pc.Index(index_name)
 
 def upload_chunks_to_pinecone(chunks, chunk_embeddings, batch_size=70, index_name="pat-chunks", namespace="default", start_index=0):
-    print(f"[Main] Preparing to upload PAT chunks to Pinecone from chunk_{start_index} to chunk_{start_index + len(chunks) - 1}...")
+    logger.info(f"[Main] Preparing to upload PAT chunks to Pinecone from chunk_{start_index} to chunk_{start_index + len(chunks) - 1}...")
     ids = [f"chunk_{i}" for i in range(start_index, start_index + len(chunks))]
+    # Full text and parsed records go to the local chunk store, the index only gets small filterable fields
+    records = [parse_chunk(chunk) for chunk in chunks]
+    get_chunk_store(CHUNK_STORE_PATH, create=True).write(chunks, start=start_index, records=records)
     metadatas = [
-        {"chunk": chunk} for chunk in chunks
+        compact_metadata(chunk, SOURCE) for chunk in chunks
     ]
-    index = get_pinecone_index(index_name=index_name, dimension=chunk_embeddings.shape[1])
-    for i in range(0, len(chunks), batch_size):
-        batch_ids = ids[i:i+batch_size]
-        batch_embs = chunk_embeddings[i:i+batch_size]
-        batch_metas = metadatas[i:i+batch_size]
+    # Sparse values need a dotproduct index; unit-length dense vectors keep the dense score a cosine
+    index = get_pinecone_index(index_name=index_name, dimension=chunk_embeddings.shape[1], metric="dotproduct" if HYBRID_ALPHA > 0 else "cosine")
+    # An index created before hybrid search keeps its cosine metric, which rejects sparse values
+    hybrid = HYBRID_ALPHA > 0 and index_metric(index_name) == "dotproduct"
+    if HYBRID_ALPHA > 0 and not hybrid:
+        logger.warning(f"[Main] Pinecone index '{index_name}' does not use the dotproduct metric: uploading dense vectors only. Delete it and upload again for hybrid search.")
+    dense = unit_rows(chunk_embeddings)
+    encoder, sparse = update_sparse_encoder(SPARSE_ENCODER_PATH, chunks, SOURCE, start=start_index) if hybrid else (None, None)
+    # Near-duplicate analyses (by title) get one vector, the representative's
+    dedup = update_dedup_index(DEDUP_INDEX_PATH, [" ".join(activity["title"] for activity in record) or chunk for chunk, record in zip(chunks, records)],
+                               [cluster_key(metadata) for metadata in metadatas], SOURCE, start=start_index)
+    uploaded = cluster_upload(index, dedup, start_index, len(chunks), metadatas, namespace=namespace)
+    for i in range(0, len(uploaded), batch_size):
         to_upsert = [
-            (batch_ids[j], batch_embs[j], batch_metas[j])
-            for j in range(len(batch_ids))
+            {"id": ids[j], "values": dense[j].tolist(), "metadata": metadatas[j]}
+            for j in uploaded[i:i+batch_size]
         ]
+        if sparse is not None:
+            for j, vector in zip(uploaded[i:i+batch_size], to_upsert):
+                vector["sparse_values"] = sparse[j]
         index.upsert(vectors=to_upsert, namespace=namespace)
-    print("[Main] PAT embeddings uploaded to Pinecone.")
+    # Only once the sparse vectors are in the index: queries send them as soon as the file exists
+    save_sparse_encoder(SPARSE_ENCODER_PATH, encoder, SOURCE)
+    logger.info(f"[Main] {len(uploaded)} PAT embeddings uploaded to Pinecone.")
+    update_code_index(CODE_INDEX_PATH, chunks, SOURCE, start=start_index)
+    titles = [activity["title"] for record in records for activity in record]
+    update_expansion_index(EXPANSION_INDEX_PATH, titles, get_embedder(), SOURCE, start=start_index)
 
 
-def pinecone_retrieve(query, top_k=5, index_name="pat-chunks", namespace="default"):
+def pinecone_retrieve(query, top_k=5, index_name="pat-chunks", namespace="default", return_scores=False, positions=None, prefix="", filter=None):
     embedder = get_embedder()
-    query_emb = embedder.encode(query, convert_to_numpy=True).tolist()
-    index = get_pinecone_index(index_name=index_name)
-    result = index.query(vector=query_emb, top_k=top_k, include_metadata=True, namespace=namespace)
-    hits = result.get('matches', [])
-    return [hit['metadata'].get('chunk', hit['id']) for hit in hits]
-
-def hybrid_retrieve(query, top_k=3, alpha=0.7):
-    global embedder, chunk_embeddings, corpus
-    if embedder is None or chunk_embeddings is None or corpus is None:
-        load_embeddings.use_pinecone = False
-        load_embeddings()
-        load_embeddings.use_pinecone = True
+    with stage_timer(SOURCE, "encode"):
+        query_emb = embedder.encode(query, convert_to_numpy=True)
+        # Dense and BM25 sparse vector in one query, when the index was uploaded with both
+        vectors = hybrid_query(query_emb, query, load_sparse_encoder(SPARSE_ENCODER_PATH, SOURCE))
+    # Returns chunk IDs: texts and records are looked up in the chunk store only for the candidates that need them
+    with stage_timer(SOURCE, "vector_query"):
+        index = get_pinecone_index(index_name=index_name)
+        dedup = load_dedup_index(DEDUP_INDEX_PATH, SOURCE)
+        if positions is not None and dedup is not None:
+            # Near-duplicates are searched through their representative
+            positions = dedup.representatives_of(positions)
+        if positions is not None:
+            # Only chunks under a code prefix
+            hits = query_within(index, vectors["vector"], positions, top_k=top_k, namespace=namespace, filter=filter, include_metadata=False,
+                                sparse_vector=vectors.get("sparse_vector"), prefix_filter=chapter_filter(prefix))
+        else:
+            hits = index.query(**vectors, top_k=top_k, include_metadata=False, namespace=namespace, filter=filter).get('matches', [])
+    if return_scores:
+        return [(vector_position(hit['id']), hit.get('score', 0)) for hit in hits]
+    return [vector_position(hit['id']) for hit in hits]
+
+def local_snapshot(version=None):
+    """
+    The index snapshot local search reads: the active one, or `version`. A
+    search keeps the one it started with, even if another is activated meanwhile.
+    """
+    return load_snapshot(CORPUS_PATH, SOURCE, get_embedder(), parse_chunk, EMBEDDINGS_PATH, version)
+
+def hybrid_retrieve(query, snapshot, top_k=3, alpha=0.7, return_scores=False, positions=None):
+    # Returns positions in the snapshot's corpus, like the chunk IDs of pinecone_retrieve
+    # Only chunks under a code prefix, when given
+    ids = range(len(snapshot.corpus)) if positions is None else positions
+    doc_embeddings = snapshot.embeddings if positions is None else snapshot.embeddings[positions]
     # Semantic search
-    query_emb = embedder.encode(query, convert_to_tensor=True)
-    semantic_hits = util.semantic_search(query_emb, chunk_embeddings, top_k=len(corpus))[0]
+    with stage_timer(SOURCE, "encode"):
+        query_emb = get_embedder().encode(query, convert_to_tensor=True)
+    with stage_timer(SOURCE, "vector_query"):
+        semantic_hits = util.semantic_search(query_emb, doc_embeddings, top_k=len(ids))[0]
     semantic_scores = {hit['corpus_id']: hit['score'] for hit in semantic_hits}
-    # BM25 keyword search
-    tokenized_chunks = [chunk.lower().split() for chunk in corpus]
-    bm25 = BM25Okapi(tokenized_chunks)
-    tokenized_query = query.lower().split()
-    bm25_scores = bm25.get_scores(tokenized_query)
+    # BM25 keyword search over the pre-tokenized corpus
+    with stage_timer(SOURCE, "bm25"):
+        bm25_scores = snapshot.lexical_index.scores(query, positions)
     bm25_min, bm25_max = min(bm25_scores), max(bm25_scores)
     bm25_scores_norm = [(s - bm25_min) / (bm25_max - bm25_min + 1e-8) for s in bm25_scores]
-    sem_scores_list = [semantic_scores.get(idx, 0) for idx in range(len(corpus))]
+    sem_scores_list = [semantic_scores.get(idx, 0) for idx in range(len(ids))]
     sem_min, sem_max = min(sem_scores_list), max(sem_scores_list)
     semantic_scores_norm = [(s - sem_min) / (sem_max - sem_min + 1e-8) for s in sem_scores_list]
     import numpy as np
     bm25_softmax = list(np.exp(bm25_scores_norm) / np.sum(np.exp(bm25_scores_norm)))
     sem_softmax = list(np.exp(semantic_scores_norm) / np.sum(np.exp(semantic_scores_norm)))
-    combined_scores = {i: alpha * bm25_softmax[i] + (1 - alpha) * sem_softmax[i] for i in range(len(corpus))}
+    combined_scores = {i: alpha * bm25_softmax[i] + (1 - alpha) * sem_softmax[i] for i in range(len(ids))}
     top_indices = sorted(combined_scores, key=lambda i: combined_scores[i], reverse=True)[:top_k]
-    return [corpus[i] for i in top_indices]
+    if return_scores:
+        return [(ids[i], combined_scores[i]) for i in top_indices]
+    return [ids[i] for i in top_indices]
 
 def is_footer(line):
     footers = [
@@ -107,8 +172,6 @@ def is_footer(line):
 
 # Global variables for model and data
 embedder = None
-chunk_embeddings = None
-corpus = None
 
 def get_embedder():
     global embedder
@@ -117,41 +180,11 @@ def get_embedder():
         embedder = SentenceTransformer('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
     return embedder
 
-def load_embeddings(embeddings_path="chunk_embeddings_pat.pt", corpus_path="chunks.txt"):
-    global embedder, chunk_embeddings, corpus
-    if embedder is None:
-        embedder = SentenceTransformer('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
-    if os.path.exists(corpus_path):
-        with open(corpus_path, "r", encoding="utf-8") as f:
-            corpus = [line.strip() for line in f if line.strip()]
-        if not corpus:
-            raise RuntimeError(f"Corpus file '{corpus_path}' is empty. Please generate or check your chunks.")
-    else:
-        corpus = None
-        raise RuntimeError(f"Corpus file '{corpus_path}' not found. Please generate it before querying.")
-    # Only load/generate .pt file if not using Pinecone (handled in hybrid_retrieve)
-    if not getattr(load_embeddings, 'use_pinecone', True):
-        if os.path.exists(embeddings_path):
-            chunk_embeddings = torch.load(embeddings_path, map_location='cpu')
-            if len(chunk_embeddings) != len(corpus):
-                chunk_embeddings = embedder.encode(corpus, convert_to_tensor=True, show_progress_bar=True)
-                torch.save(chunk_embeddings, embeddings_path)
-        else:
-            chunk_embeddings = embedder.encode(corpus, convert_to_tensor=True, show_progress_bar=True)
-            torch.save(chunk_embeddings, embeddings_path)
-    else:
-        chunk_embeddings = None
-
-
 def bm25_keyword_search(query, chunks, top_k=3):
-    # Tokenize chunks and query
-    tokenized_chunks = [chunk.lower().split() for chunk in corpus]
-    bm25 = BM25Okapi(tokenized_chunks)
-    tokenized_query = query.lower().split()
-    scores = bm25.get_scores(tokenized_query)
-    # Get top_k chunk indices
-    top_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:top_k]
-    return [corpus[i] for i in top_indices]
+    # Chunks are tokenized once, when the lexical index is built
+    scores = local_snapshot().lexical_index.scores(query)
+    # Top_k chunk IDs; texts are read from the corpus by ID
+    return sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:top_k]
 
 def clean_number(num_str):
     # Remove all dots except the last one (decimal separator)
@@ -169,7 +202,7 @@ def clean_number(num_str):
         return None
 
 def load_txt_chunks(txt_path):
-    print("[Main] Loading TXT document...")
+    logger.info("[Main] Loading TXT document...")
     with open(txt_path, "r", encoding="utf-8") as f:
         txt_text = f.read()
     # Remove page breaks and irrelevant headers
@@ -351,94 +384,184 @@ def load_txt_chunks(txt_path):
             "quantity": quantity,
             "sub_items": sub_items
         })
-    print(f"[Main] Document chunked into {len(structured_chunks)} structured activity chunks.")
+    logger.info(f"[Main] Document chunked into {len(structured_chunks)} structured activity chunks.")
     return structured_chunks
 
 def retrieve(query, top_k=1):
-    print("[Retrieval] Encoding query and searching for relevant chunks...")
+    logger.info("[Retrieval] Encoding query and searching for relevant chunks...")
     embedder_local = get_embedder()
-    query_emb = embedder_local.encode(query, convert_to_tensor=True)
-    hits = util.semantic_search(query_emb, chunk_embeddings, top_k=top_k)[0]
-    print(f"[Retrieval] Top {top_k} chunks retrieved.")
-    return [corpus[hit['corpus_id']] for hit in hits]
+    with stage_timer(SOURCE, "encode"):
+        query_emb = embedder_local.encode(query, convert_to_tensor=True)
+    with stage_timer(SOURCE, "vector_query"):
+        hits = util.semantic_search(query_emb, local_snapshot().embeddings, top_k=top_k)[0]
+    logger.info(f"[Retrieval] Top {top_k} chunks retrieved.")
+    return [hit['corpus_id'] for hit in hits]
 
 
-def rag_query(query, use_pinecone=True):
-    print(f"[RAG] Processing query: {query}")
-    from mistral_utils import answer_question
-    # Use Mistral to generate a list of strong synonym queries (activity categories) in Italian
-    refined_query = answer_question(f"Define the construction activity category in italian that describes it best in Prezziario with one to max 10 words, exclude any other commentary, for: {query}")
-    if isinstance(refined_query, dict) and "error" in refined_query:
-        return refined_query
-    print(f"[RAG] Refined query/categories: {refined_query}")
-    if isinstance(refined_query, str):
-        queries = [q.strip() for q in re.split(r'[\n,;]+', refined_query) if q.strip()]
+def match_code(query, snapshot=None):
+    """
+    Looks a code-shaped query up in the code index of the Pinecone upload, or
+    of `snapshot` when searching locally: returns (kind, positions, rest) as
+    CodeIndex.match, or (None, [], query) when there is no code index.
+    """
+    index = load_code_index(CODE_INDEX_PATH, SOURCE) if snapshot is None else snapshot.code_index
+    if index is None:
+        return None, [], query
+    return index.match(query)
+
+def chapter_filter(prefix):
+    # Pinecone filter on the code_prefix metadata of the chunks under a code prefix
+    index = load_code_index(CODE_INDEX_PATH, SOURCE) if prefix else None
+    return index.prefix_filter(prefix) if index is not None else None
+
+def chunks_at(positions, snapshot=None):
+    """
+    Chunk texts by ID, in order (None where missing): from `snapshot` when
+    searching locally, the chunk store, or the vector metadata of uploads made
+    before it existed.
+    """
+    if snapshot is not None:
+        return snapshot.corpus.get_many(positions)
+    store = get_chunk_store(CHUNK_STORE_PATH)
+    if store is None:
+        return fetch_chunks(get_pinecone_index(), positions)
+    return store.get_many(positions)
+
+def parse_chunk(chunk):
+    return parse_activity_chunks([chunk])
+
+def records_at(positions, snapshot=None):
+    """
+    Parsed activities of the chunks at `positions`, as written by the uploader
+    or the snapshot builder; chunks without a stored record (older uploads)
+    are parsed here.
+    """
+    store = get_chunk_store(CHUNK_STORE_PATH) if snapshot is None else snapshot.store
+    with stage_timer(SOURCE, "parse"):
+        records = stored_records(store, positions, parse_chunk, lambda missing: chunks_at(missing, snapshot))
+    return [activity for record in records for activity in record]
+
+def rag_query(query, use_pinecone=True, deadline=None, filter=None, version=None):
+    if deadline is None:
+        deadline = Deadline()
+    # Pinecone holds one version of the price list: a pinned one is searched in its snapshot
+    if version is not None:
+        use_pinecone = False
+    logger.info(f"[RAG] Processing query: {query}")
+    snapshot = None if use_pinecone else local_snapshot(version)
+    # A pasted code (or chapter) is answered from the code index, without Mistral or vector search
+    with stage_timer(SOURCE, "code_lookup"):
+        kind, positions, rest = match_code(query, snapshot)
+        if kind == "exact" or (kind == "prefix" and not rest):
+            logger.info(f"[RAG] Code {kind} match for '{query}': {len(positions)} chunk(s)")
+            return records_at(positions[:PREFIX_RESULTS], snapshot)
+    # Near-duplicates of a recent query reuse its result, or at least its synonym queries
+    cache = get_semantic_cache(SOURCE)
+    lookup = None
+    if cache is not None:
+        with stage_timer(SOURCE, "semantic_cache"):
+            context = cache_context(filter=filter, local=not use_pinecone, version=snapshot.version if snapshot else None,
+                                    prefix=split_code_prefix(query)[0] if kind == "prefix" else "")
+            lookup = cache.lookup(get_embedder(), rest if kind == "prefix" else query, context)
+        if lookup.result is not None:
+            return lookup.result
+    if kind == "prefix":
+        logger.info(f"[RAG] Searching {len(positions)} chunks under code prefix of '{query}'")
+        prefix = split_code_prefix(query)[0]
+        query = rest
     else:
-        queries = [str(refined_query)]
-    all_candidates = []
-    for q in queries:
-        print(f"[RAG] Searching with synonym/category: {q}")
+        positions, prefix = None, ""
+
+    def retrieve(q, top_k):
         if use_pinecone:
-            candidates = pinecone_retrieve(q, top_k=5)
+            return pinecone_retrieve(q, top_k=top_k, return_scores=True, positions=positions, prefix=prefix, filter=filter)
+        # No metadata index locally: score more candidates, then filter them
+        candidates = hybrid_retrieve(q, snapshot, top_k=top_k * LOCAL_FILTER_OVERFETCH if filter else top_k, alpha=0.1, return_scores=True, positions=positions)
+        return filter_candidates(candidates, snapshot.corpus, SOURCE, filter, top_k)
+
+    from mistral_utils import answer_question
+    # Synonym queries from the local expansion index; Mistral only when it is not confident
+    queries = lookup.refinement if lookup is not None else None
+    if queries is None:
+        with stage_timer(SOURCE, "expand"):
+            queries = expand_query(query, EXPANSION_INDEX_PATH, SOURCE, get_embedder())
+    # One ranking per searched query
+    rankings = []
+    if queries is None:
+        # Use Mistral to generate a list of strong synonym queries (activity categories) in Italian,
+        # while the raw query is searched; a confident raw hit cancels it
+        speculation = Speculation(SOURCE, lambda cancel: answer_question(f"Define the construction activity category in italian that describes it best in Prezziario with one to max 10 words, exclude any other commentary, for: {query}", task="refine", cancel=cancel))
+        logger.info(f"[RAG] Searching with raw query while refining: {query}")
+        candidates = retrieve(query, top_k=5)
+        rankings.append(candidates)
+        if not candidates:
+            best = 0.0
+        elif use_pinecone:
+            best = max(score for _, score in candidates)
+        else:
+            best = similarity(get_embedder(), query, snapshot.embeddings[candidates[0][0]])
+        if speculation.settle(best):
+            queries = [query]
         else:
-            candidates = hybrid_retrieve(q, top_k=5, alpha=0.1)
-        all_candidates.extend(candidates)
-    all_candidates = list(dict.fromkeys(all_candidates))
-    best_accuracy = 0
-    best_chunk = None
-    best_idx = 0
-    for i, chunk in enumerate(all_candidates):
-        title = chunk.split("\n")[0] if "\n" in chunk else chunk[:500]
-        prompt = f"Is the following construction activity relevant to the query '{query}'? Activity: '{title}'. Return number from 1 to 100 representing accuracy."
-        try:
-            acc_str = answer_question(prompt)
-            try:
-                accuracy = int(''.join(filter(str.isdigit, str(acc_str))))
-            except Exception:
-                accuracy = 0
-        except Exception:
-            accuracy = 0
-        print(f"Chunk {i+1} title: {title}\nAccuracy: {accuracy}")
-        if accuracy > best_accuracy:
-            best_accuracy = accuracy
-            best_chunk = chunk
-            best_idx = i
-    if best_accuracy < 85:
-        print(f"[RAG] Best accuracy only {best_accuracy}, generating alternative phrasings...")
-        alt_queries = answer_question(f"Give 5 alternative ways to describe the same construction activity as: {query}, in italian, each as a single line, no commentary.")
-        if isinstance(alt_queries, str):
-            alt_queries = [q.strip() for q in re.split(r'[\n,;]+', alt_queries) if q.strip()]
-        elif not isinstance(alt_queries, list):
-            alt_queries = [str(alt_queries)]
-        for alt in alt_queries:
-            print(f"[RAG] Trying alternative: {alt}")
-            if use_pinecone:
-                candidates = pinecone_retrieve(alt, top_k=3)
+            with stage_timer(SOURCE, "refine"):
+                refined_query = speculation.result()
+            if isinstance(refined_query, dict) and "error" in refined_query:
+                return refined_query
+            logger.info(f"[RAG] Refined query/categories: {refined_query}")
+            if isinstance(refined_query, str):
+                queries = [q.strip() for q in re.split(r'[\n,;]+', refined_query) if q.strip()]
             else:
-                candidates = hybrid_retrieve(alt, top_k=3, alpha=0.1)
-            print(candidates)
-            for i, chunk in enumerate(candidates):
-                title = chunk.split("\n")[0] if "\n" in chunk else chunk[:500]
-                prompt = f"Is the following construction activity relevant to the query '{query}'? Activity: '{title}'. Return number from 1 to 100 representing accuracy."
-                try:
-                    acc_str = answer_question(prompt)
-                    try:
-                        accuracy = int(''.join(filter(str.isdigit, str(acc_str))))
-                    except Exception:
-                        accuracy = 0
-                except Exception:
-                    accuracy = 0
-                print(f"[ALT] Chunk {i+1} title: {title}\nAccuracy: {accuracy}")
-                if accuracy > best_accuracy:
-                    best_accuracy = accuracy
-                    best_chunk = chunk
-                    best_idx = i
-    print(f"[RAG] Best accuracy: {best_accuracy} (chunk {best_idx+1})")
-    print("[RAG] Pipeline complete.")
-    if best_chunk:
-        return [best_chunk]
+                queries = [str(refined_query)]
+        # The raw query was searched already
+        queries_to_search = [q for q in queries if q != query]
+    else:
+        queries_to_search = queries
+    for q in queries_to_search:
+        logger.info(f"[RAG] Searching with synonym/category: {q}")
+        rankings.append(retrieve(q, top_k=5))
+    # Chunks found by several synonyms first, so the re-rank can usually stop early
+    texts = {}
+    with stage_timer(SOURCE, "fusion"):
+        all_candidates = resolve_texts(SOURCE, fuse(rankings), texts, lambda ids: chunks_at(ids, snapshot))
+        all_candidates = collapse(SOURCE, all_candidates, texts, None if use_pinecone else snapshot.embeddings)
+    best_accuracy, best_chunk, best_idx, rerank_calls = rerank(query, all_candidates[:MAX_CANDIDATES], answer_question, SOURCE, 85, deadline, texts=texts)
+    if best_accuracy < 85 and deadline.near():
+        deadline.degrade(SOURCE, "skipped_alt_phrasings")
+    elif best_accuracy < 85:
+        logger.info(f"[RAG] Best accuracy only {best_accuracy}, generating alternative phrasings...")
+        with stage_timer(SOURCE, "alt_phrasings"):
+            alt_queries = answer_question(f"Give 5 alternative ways to describe the same construction activity as: {query}, in italian, each as a single line, no commentary.", task="alternatives")
+            if isinstance(alt_queries, str):
+                alt_queries = [q.strip() for q in re.split(r'[\n,;]+', alt_queries) if q.strip()]
+            elif not isinstance(alt_queries, list):
+                alt_queries = [str(alt_queries)]
+            for alt in alt_queries:
+                if best_accuracy >= 85:
+                    break
+                if deadline.near():
+                    deadline.degrade(SOURCE, "skipped_alt_phrasings")
+                    break
+                logger.info(f"[RAG] Trying alternative: {alt}")
+                candidates = retrieve(alt, top_k=3)
+                logger.debug(candidates)
+                candidates = resolve_texts(SOURCE, order_candidates(candidates), texts, lambda ids: chunks_at(ids, snapshot))
+                best_accuracy, best_chunk, best_idx, calls = rerank(query, candidates, answer_question, SOURCE, 85, deadline,
+                                                                    best=(best_accuracy, best_chunk, best_idx), label="[ALT] Chunk", texts=texts)
+                rerank_calls += calls
+    RERANK_CALLS.labels(source=SOURCE).observe(rerank_calls)
+    logger.info(f"[RAG] Best accuracy: {best_accuracy} (chunk {best_idx+1})", extra={"fields": {"best_accuracy": best_accuracy, "rerank_calls": rerank_calls, "degraded": deadline.degraded}})
+    logger.info("[RAG] Pipeline complete.")
+    # Chunk IDs; 0 is a valid one
+    if best_chunk is not None:
+        # A selected representative comes with its near-duplicates
+        dedup = load_dedup_index(DEDUP_INDEX_PATH, SOURCE) if use_pinecone else None
+        result = records_at([best_chunk] if dedup is None else dedup.expand([best_chunk], best_chunk), snapshot)
     else:
-        return all_candidates[:3]
+        result = records_at(all_candidates[:3], snapshot)
+    # A result cut short by the deadline is not worth reusing
+    if lookup is not None and not deadline.degraded:
+        cache.store(lookup, query, queries, result)
+    return result
 
 
 
@@ -459,32 +582,16 @@ if __name__ == "__main__":
     corpus_path = "chunks.txt"
     if not os.path.exists(corpus_path):
         raise RuntimeError(f"Corpus file '{corpus_path}' not found. Please generate it before uploading.")
-    with open(corpus_path, "r", encoding="utf-8") as f:
-        all_chunks = [line.strip() for line in f if line.strip()]
-    # Upload all chunks in chunks.txt
-    corpus = all_chunks
-    # --- Check for oversized chunks and skip them ---
-    # Pinecone metadata size limit is 40kB (40960 bytes)
-    max_metadata_bytes = 40960
-    filtered_corpus = []
-    filtered_indices = []
-    import json
-    for idx, chunk in enumerate(corpus):
-        meta = {"chunk": chunk}
-        meta_bytes = len(json.dumps(meta, ensure_ascii=False).encode("utf-8"))
-        if meta_bytes > max_metadata_bytes:
-            print(f"[Warning] Skipping chunk at index {idx} (ID chunk_{idx}) due to metadata size {meta_bytes} bytes > 40kB limit.")
-            continue
-        filtered_corpus.append(chunk)
-        filtered_indices.append(idx)
-    if not filtered_corpus:
-        raise RuntimeError("No valid chunks to upload after filtering oversized chunks.")
+    # Upload all chunks in chunks.txt; metadata is small, so no chunk is too large for Pinecone
+    corpus = load_corpus(corpus_path, SOURCE)
+    if not len(corpus):
+        raise RuntimeError(f"Corpus file '{corpus_path}' is empty. Please generate or check your chunks.")
     # --- Embedding Retriever ---
     embedder_local = get_embedder()
-    print("[Main] Encoding chunks for retrieval...")
-    chunk_embeddings = embedder_local.encode(filtered_corpus, convert_to_numpy=True, show_progress_bar=True)
-    # --- Upload all valid chunks to Pinecone ---
-    upload_chunks_to_pinecone(filtered_corpus, chunk_embeddings, batch_size=70, index_name="pat-chunks", namespace="default", start_index=0)
+    logger.info("[Main] Encoding chunks for retrieval...")
+    chunk_embeddings = embedder_local.encode(corpus, convert_to_numpy=True, show_progress_bar=True)
+    # --- Upload all chunks to Pinecone ---
+    upload_chunks_to_pinecone(corpus, chunk_embeddings, batch_size=70, index_name="pat-chunks", namespace="default", start_index=0)
     # --- Print ranked chunks for the query (optional, can be commented out) ---
     # To use local retrieval, set use_pinecone=False
     # user_query = "prezzo totale DEMOLIZIONE MANTI DI COPERTURA manto in lamiera"
@@ -2,8 +2,14 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-from rag_training import rag_query
+from rag_training import rag_query, SOURCE
+from rerank import Deadline
+from chunk_store import normalize_unit
 from fastapi import Form
+from coalesce import SingleFlight, normalize_query
+import metrics
+import index_snapshot
+import os
 
 load_dotenv()
 
@@ -18,25 +24,36 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request IDs, per-stage latency histograms and the /metrics endpoint
+metrics.install(app, SOURCE)
+# Concurrent identical searches run the pipeline once
+coalescer = SingleFlight(SOURCE, "/search_pat")
+# Listing and activating local search snapshots (ADMIN_TOKEN)
+index_snapshot.install_admin(app, "chunks.txt", SOURCE)
+# Searches read the active index snapshot instead of Pinecone; a pinned version is always read locally
+LOCAL_SEARCH = os.getenv("LOCAL_SEARCH", "0") == "1"
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
 
-@app.post("/search_pat")
-def search(query: str = Form(...)):
+def run_search(query, budget, unit, version):
+    # The latency budget (seconds) covers the whole request, including refinement
+    deadline = Deadline(budget)
+    # Optional unit of measure, matched against the index metadata (m2, mq and m² are the same unit)
+    filter = {"unit": normalize_unit(unit)} if unit else None
     # First, ask Mistral to redefine the construction activity category
     try:
-        results = rag_query(query)
+        results = rag_query(query, use_pinecone=not LOCAL_SEARCH, deadline=deadline, filter=filter, version=version or None)
     except Exception as e:
         return {"error": str(e)}
     # If results is an error dict, return it directly
     if isinstance(results, dict) and "error" in results:
         return results
-    # If results is a list of dicts, convert to strings and filter out None
-    if isinstance(results, list):
-        results = [r if isinstance(r, str) else str(r) for r in results if r is not None]
-    else:
-        results = [results] if results is not None else []
-    from parse_activity_chunks import parse_activity_chunks
-    parsed = parse_activity_chunks(results)
-    return {"results": parsed}
+    # Parsed activities, read from the chunk store by ID
+    return {"results": results, "degraded": deadline.degraded}
+
+@app.post("/search_pat")
+async def search(query: str = Form(...), budget: float = Form(None), unit: str = Form(None), version: str = Form(None)):
+    # Identical searches in flight share one pipeline run
+    return await coalescer.run((normalize_query(query), budget, normalize_unit(unit) if unit else None, version), run_search, query, budget, unit, version)
@@ -0,0 +1,137 @@
+"""
+Semantic query cache in front of the refinement and re-rank stages.
+
+Embeddings of recently served queries are kept in a fixed-size matrix; a new
+query is matched against it by cosine similarity (an exact scan, cheap at
+this size). Queries phrased slightly differently ("rifacimento manto
+copertura" / "rifacimento del manto di copertura") reuse the earlier result
+above SEMANTIC_CACHE_THRESHOLD, or only its refinement (synonym queries)
+above SEMANTIC_CACHE_REFINE_THRESHOLD. Entries are evicted least recently
+used first and expire after SEMANTIC_CACHE_TTL seconds.
+
+Entries only match queries with the same context (unit filter, code prefix,
+local or Pinecone search). A fraction SEMANTIC_CACHE_AUDIT_RATE of result
+hits still runs the full search and compares: differing results are counted
+as false reuse, for tuning the threshold.
+"""
+import os
+import json
+import time
+import random
+import threading
+from collections import OrderedDict
+import numpy as np
+from metrics import get_logger, record_cache, SEMANTIC_AUDITS
+
+CAPACITY = int(os.getenv("SEMANTIC_CACHE_SIZE", "512"))
+THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+REFINE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_REFINE_THRESHOLD", "0.9"))
+TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+AUDIT_RATE = float(os.getenv("SEMANTIC_CACHE_AUDIT_RATE", "0.05"))
+
+
+class CacheLookup:
+    """
+    Outcome of SemanticCache.lookup, passed back to SemanticCache.store.
+    """
+    def __init__(self, embedding, context, slot=None, entry=None, similarity=0.0, audit=False):
+        self.embedding = embedding
+        self.context = context
+        self.slot = slot
+        self.entry = entry
+        self.similarity = similarity
+        self.audit = audit
+
+    # Both are None while auditing, so the caller runs the full search
+    @property
+    def result(self):
+        if self.entry is None or self.audit or self.similarity < THRESHOLD:
+            return None
+        return self.entry["result"]
+
+    @property
+    def refinement(self):
+        if self.entry is None or self.audit or self.similarity < REFINE_THRESHOLD:
+            return None
+        return self.entry["refinement"]
+
+
+class SemanticCache:
+    def __init__(self, source, capacity=CAPACITY):
+        self.source = source
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.embeddings = None
+        self.contexts = [None] * capacity
+        # slot -> entry, least recently used first
+        self.entries = OrderedDict()
+
+    def lookup(self, embedder, query, context):
+        embedding = np.asarray(embedder.encode(query, convert_to_numpy=True), dtype=np.float32).reshape(-1)
+        embedding /= np.linalg.norm(embedding) + 1e-12
+        lookup = CacheLookup(embedding, context)
+        with self.lock:
+            if self.entries and self.embeddings is not None:
+                scores = self.embeddings @ embedding
+                now = time.monotonic()
+                for slot in list(self.entries):
+                    if now - self.entries[slot]["stored_at"] > TTL_SECONDS:
+                        del self.entries[slot]
+                slots = [slot for slot in self.entries if self.contexts[slot] == context]
+                if slots:
+                    slot = max(slots, key=lambda s: scores[s])
+                    if scores[slot] >= REFINE_THRESHOLD:
+                        self.entries.move_to_end(slot)
+                        lookup.slot, lookup.entry, lookup.similarity = slot, self.entries[slot], float(scores[slot])
+        hit = lookup.similarity >= THRESHOLD
+        lookup.audit = hit and random.random() < AUDIT_RATE
+        record_cache(self.source, "semantic_result", hit=hit)
+        if not hit:
+            record_cache(self.source, "semantic_refinement", hit=lookup.entry is not None)
+        if lookup.entry is not None:
+            get_logger(self.source).info(f"[RAG] Semantic cache {'result' if hit else 'refinement'} reuse "
+                                         f"(similarity {lookup.similarity:.3f}) of '{lookup.entry['query']}'")
+        return lookup
+
+    def store(self, lookup, query, refinement, result):
+        """
+        Stores a served query; for an audited hit, compares the fresh result
+        with the cached one and replaces it.
+        """
+        if lookup.audit:
+            same = json.dumps(result, sort_keys=True, default=str) == json.dumps(lookup.entry["result"], sort_keys=True, default=str)
+            SEMANTIC_AUDITS.labels(source=self.source, result="same" if same else "different").inc()
+        entry = {"query": query, "refinement": refinement, "result": result, "stored_at": time.monotonic()}
+        with self.lock:
+            if self.embeddings is None:
+                self.embeddings = np.zeros((self.capacity, len(lookup.embedding)), dtype=np.float32)
+            if lookup.audit and lookup.slot in self.entries:
+                slot = lookup.slot
+            elif len(self.entries) < self.capacity:
+                used = set(self.entries)
+                slot = next(s for s in range(self.capacity) if s not in used)
+            else:
+                slot, _ = self.entries.popitem(last=False)
+            self.embeddings[slot] = lookup.embedding
+            self.contexts[slot] = lookup.context
+            self.entries[slot] = entry
+            self.entries.move_to_end(slot)
+
+
+_caches = {}
+
+
+def get_semantic_cache(source):
+    """
+    The process's cache for a source, or None when SEMANTIC_CACHE_SIZE is 0.
+    """
+    if CAPACITY <= 0:
+        return None
+    if source not in _caches:
+        _caches[source] = SemanticCache(source)
+    return _caches[source]
+
+
+def cache_context(**fields):
+    # Queries only share entries when everything else about the search is the same
+    return json.dumps(fields, sort_keys=True, default=str)
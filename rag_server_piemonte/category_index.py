@@ -0,0 +1,121 @@
+"""
+Two-level index over Piemonte chunks: category centroids, then the activities
+inside the best categories.
+
+Every chunk belongs to one `Main Category / Category`, taken from the header
+load_and_chunk_rag_txt writes. A category's centroid is the normalized mean of
+its chunks' embeddings. At query time the query is scored against the
+centroids first and only the chunks of the top categories are searched.
+"""
+import os
+import re
+import json
+import numpy as np
+from metrics import record_cache
+
+# Categories searched per query, extended until they hold at least MIN_CHUNKS chunks
+TOP_CATEGORIES = int(os.getenv("PIEMONTE_TOP_CATEGORIES", "3"))
+MIN_CHUNKS = int(os.getenv("PIEMONTE_MIN_CATEGORY_CHUNKS", "50"))
+
+HEADER = re.compile(r"Main Category:\s*(.*?)\s+Description:.*?\sCategory:\s*(.*?)\s*(?=Activity:|Work:|$)", re.DOTALL)
+
+
+def chunk_categories(chunks):
+    """
+    Category name per chunk. Chunks split off a large activity (starting at
+    `Work:`) have no header and belong to the category of the chunk before them.
+    """
+    names = []
+    current = ""
+    for chunk in chunks:
+        match = HEADER.match(chunk)
+        if match:
+            current = f"{match.group(1).strip()} / {match.group(2).strip()}"
+        names.append(current)
+    return names
+
+
+def _normalize(matrix):
+    return matrix / (np.linalg.norm(matrix, axis=-1, keepdims=True) + 1e-12)
+
+
+class CategoryIndex:
+    def __init__(self, names, centroids, offsets, members):
+        self.names = names
+        self.centroids = centroids
+        # Chunk positions of category i are members[offsets[i]:offsets[i+1]]
+        self.offsets = offsets
+        self.members = members
+
+    @property
+    def n_chunks(self):
+        return len(self.members)
+
+    @classmethod
+    def build(cls, chunks, embeddings):
+        if hasattr(embeddings, "cpu"):
+            embeddings = embeddings.cpu().numpy()
+        embeddings = _normalize(np.asarray(embeddings, dtype=np.float32))
+        categories = chunk_categories(chunks)
+        names = list(dict.fromkeys(categories))
+        lookup = {name: i for i, name in enumerate(names)}
+        ids = np.array([lookup[c] for c in categories], dtype=np.int64)
+        sums = np.zeros((len(names), embeddings.shape[1]), dtype=np.float32)
+        np.add.at(sums, ids, embeddings)
+        order = np.argsort(ids, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(ids, minlength=len(names)))]).astype(np.int64)
+        return cls(names, _normalize(sums), offsets, order.astype(np.int64))
+
+    def top(self, query_emb, n=TOP_CATEGORIES, min_chunks=MIN_CHUNKS):
+        if hasattr(query_emb, "cpu"):
+            query_emb = query_emb.cpu().numpy()
+        scores = self.centroids @ _normalize(np.asarray(query_emb, dtype=np.float32).reshape(-1))
+        chosen = []
+        size = 0
+        for i in np.argsort(-scores):
+            if len(chosen) >= n and size >= min_chunks:
+                break
+            chosen.append(int(i))
+            size += self.offsets[i + 1] - self.offsets[i]
+        return chosen
+
+    def positions(self, categories):
+        return np.sort(np.concatenate([self.members[self.offsets[i]:self.offsets[i + 1]] for i in categories]))
+
+    def save(self, path):
+        np.savez(path, names=np.array(json.dumps(self.names, ensure_ascii=False)), centroids=self.centroids,
+                 offsets=self.offsets, members=self.members)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(json.loads(str(data["names"])), data["centroids"], data["offsets"], data["members"])
+
+
+_loaded = {}
+
+
+def load_category_index(path, source, chunks=None, embeddings=None):
+    """
+    Loads the persisted category index, cached until the file changes. With
+    `chunks` and `embeddings` a missing or stale index (different chunk count)
+    is rebuilt and saved; without them a missing index returns None.
+    """
+    if os.path.exists(path):
+        stamp = os.path.getmtime(path)
+        cached = _loaded.get(path)
+        if cached and cached[0] == stamp and (chunks is None or cached[1].n_chunks == len(chunks)):
+            record_cache(source, "category_index", hit=True)
+            return cached[1]
+        index = CategoryIndex.load(path)
+        if chunks is None or index.n_chunks == len(chunks):
+            record_cache(source, "category_index", hit=True)
+            _loaded[path] = (stamp, index)
+            return index
+    if chunks is None or embeddings is None:
+        return None
+    record_cache(source, "category_index", hit=False)
+    index = CategoryIndex.build(chunks, embeddings)
+    index.save(path)
+    _loaded[path] = (os.path.getmtime(path), index)
+    return index
@@ -0,0 +1,51 @@
+"""
+Single-flight coalescing of identical concurrent search requests.
+
+A request whose normalized parameters match one already being served (the
+same project opened by several estimators, frontend retries) waits for that
+result instead of running the pipeline, and its LLM and vector calls, again.
+Only requests in flight at the same time are merged, within one worker
+process; later repeats are the semantic cache's job.
+
+The shared run is a task of its own in the thread pool. A waiter that is
+cancelled (its client went away) only stops waiting: the run goes on for the
+others, and is not cancelled when the request that started it is.
+"""
+import asyncio
+from starlette.concurrency import run_in_threadpool
+from metrics import get_logger, COALESCED_REQUESTS
+
+
+def normalize_query(query):
+    return " ".join(query.split()).casefold()
+
+
+class SingleFlight:
+    def __init__(self, source, endpoint):
+        self.source = source
+        self.endpoint = endpoint
+        # key -> task of the run in flight; only touched from the event loop
+        self.in_flight = {}
+
+    async def run(self, key, fn, *args):
+        """
+        fn(*args) in the thread pool, or the result of the run in flight
+        under the same key.
+        """
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(run_in_threadpool(fn, *args))
+            self.in_flight[key] = task
+
+            def forget(done):
+                if self.in_flight.get(key) is done:
+                    del self.in_flight[key]
+                # Retrieved here, so a failure nobody waits for any more is not logged as unhandled
+                if not done.cancelled():
+                    done.exception()
+
+            task.add_done_callback(forget)
+        else:
+            COALESCED_REQUESTS.labels(source=self.source, endpoint=self.endpoint).inc()
+            get_logger(self.source).info(f"[RAG] Identical search already in flight, waiting for its result: {key}")
+        return await asyncio.shield(task)
@@ -0,0 +1,316 @@
+"""
+Exact and prefix lookup of Prezziario item codes.
+
+The uploader saves a code -> chunk position dictionary next to the corpus
+(code_index_<source>.json), with positions matching the chunk_<i> vector IDs.
+A query that is a code is answered from it without Mistral or vector search;
+a query starting with a code prefix (chapter) only searches the chunks under it.
+Vectors carry the chapter-level prefixes of their codes (code_prefix), so a
+large chapter is searched with a Pinecone metadata filter.
+"""
+import os
+import re
+import json
+import bisect
+import numpy as np
+from metrics import get_logger, record_cache
+from chunk_store import matches_filter
+from corpus_store import Corpus, write_corpus
+from text_analysis import WORD_PATTERN
+
+# Item codes as they appear in each source's chunks
+CODE_PATTERNS = {
+    # Analysis code at the start of the chunk; sub-item codes are shared resources
+    "pat": re.compile(r"^([A-Z]\.\d{2}\.\d{2}\.\d{4}\.\d{3})"),
+    "piemonte": re.compile(r"Codice:\s*([^,\n]*)"),
+    "dei": re.compile(r"Code:\s*(\S+)"),
+}
+CODE_SHAPE = re.compile(r"[A-Za-z0-9]+(?:[.\-][A-Za-z0-9]+)*\.?")
+# Chapter and item of a normalized code without dots (DEI A10112B: A10, A10112)
+UNDOTTED_PREFIXES = (re.compile(r"^[A-Z]+\d{2}"), re.compile(r"^[A-Z]+\d+(?=[A-Z]+$)"))
+# Chapters with at most this many chunks are scored locally from fetched vectors
+FETCH_LIMIT = 200
+# Otherwise the vector query over-fetches by this factor and drops chunks outside the chapter
+OVERFETCH = 20
+# A query that is only a chapter prefix returns its first chunks in code order
+PREFIX_RESULTS = 10
+
+
+def normalize_code(code):
+    return code.strip().rstrip(".").upper()
+
+
+def looks_like_code(token):
+    # Needs a digit and a letter or dot, so quantities like "12" or units like "m2" are not codes
+    return (len(token) >= 3 and CODE_SHAPE.fullmatch(token) is not None
+            and any(c.isdigit() for c in token) and (any(c.isalpha() for c in token) or "." in token))
+
+
+def split_code_prefix(query):
+    """
+    Splits a code-shaped first word off the query: ("B.02.10", "demolizione")
+    or ("", query) when the query does not start with a code. Words are split
+    on punctuation like the lexical index does, so "B.02.10, demolizione" and
+    quoted codes are recognized; the rest keeps the query's own spelling.
+    """
+    first = WORD_PATTERN.search(query)
+    if first is None or query[:first.start()].strip(" '\"") or not looks_like_code(first.group()):
+        return "", query
+    rest = query[first.end():].strip(" '\".,;:")
+    # A short first word (e.g. "C25 fondazioni") is more likely text than a chapter
+    if rest and "." not in first.group() and len(first.group()) < 4:
+        return "", query
+    return first.group(), rest
+
+
+def code_prefixes(code):
+    """
+    Chapter-level prefixes of a code, for the code_prefix metadata: every
+    prefix ending before a dot (B, B.02, B.02.10, B.02.10.0010), or for a code
+    without dots its chapter and item without the variant letter. Variants of
+    one item share them all.
+    """
+    if "." in code:
+        parts = code.split(".")
+        return [".".join(parts[:i]) for i in range(1, len(parts))]
+    prefixes = [m.group(0) for m in (p.match(code) for p in UNDOTTED_PREFIXES) if m and m.group(0) != code]
+    return list(dict.fromkeys(prefixes))
+
+
+def extract_codes(chunk, source):
+    codes = [normalize_code(c) for c in CODE_PATTERNS[source].findall(chunk)]
+    return [c for c in dict.fromkeys(codes) if c]
+
+
+class CodeIndex:
+    """
+    Code dictionary plus a sorted code list, which serves as a flattened
+    prefix trie: all codes under a prefix are one contiguous bisect range.
+    """
+
+    def __init__(self, source, codes=None):
+        self.source = source
+        self.codes = codes or {}
+        self.keys = sorted(self.codes)
+        self.filters = {}
+
+    def positions_at(self, i):
+        # Chunk positions of the i-th code in sorted order
+        return self.codes[self.keys[i]]
+
+    @classmethod
+    def from_chunks(cls, chunks, source, start=0):
+        index = cls(source)
+        index.add(chunks, start)
+        return index
+
+    def add(self, chunks, start=0):
+        for pos, chunk in enumerate(chunks, start):
+            for code in extract_codes(chunk, self.source):
+                positions = self.codes.setdefault(code, [])
+                if pos not in positions:
+                    positions.append(pos)
+        self.keys = sorted(self.codes)
+        self.filters = {}
+
+    def exact(self, code):
+        code = normalize_code(code)
+        i = bisect.bisect_left(self.keys, code)
+        return [int(pos) for pos in self.positions_at(i)] if i < len(self.keys) and self.keys[i] == code else []
+
+    def _under(self, prefix):
+        # Sorted positions of the codes starting with `prefix`
+        i = bisect.bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix):
+            yield i
+            i += 1
+
+    def prefix(self, prefix):
+        prefix = normalize_code(prefix)
+        return list(dict.fromkeys(int(pos) for i in self._under(prefix) for pos in self.positions_at(i)))
+
+    def prefix_filter(self, prefix):
+        """
+        Pinecone filter on the code_prefix metadata matching every chunk under
+        `prefix`: the longest chapter-level prefix its codes share, or None
+        when they share none (then only the chunk positions restrict).
+        """
+        prefix = normalize_code(prefix)
+        if prefix not in self.filters:
+            shared = None
+            for code in (self.keys[i] for i in self._under(prefix)):
+                shared = set(code_prefixes(code)) if shared is None else shared & set(code_prefixes(code))
+                if not shared:
+                    break
+            self.filters[prefix] = {"code_prefix": max(shared, key=len)} if shared else None
+        return self.filters[prefix]
+
+    def match(self, query):
+        """
+        Returns (kind, positions, rest): kind "exact" when the query is a known
+        code, "prefix" when the query is, or starts with, a code prefix (rest is
+        the remaining text), or None.
+        """
+        code, rest = split_code_prefix(query)
+        if not code:
+            return None, [], query
+        if not rest:
+            positions = self.exact(code)
+            if positions:
+                return "exact", positions, ""
+        positions = self.prefix(code)
+        if positions:
+            return "prefix", positions, rest
+        return None, [], query
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"source": self.source, "codes": self.codes}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["source"], data["codes"])
+
+    def save_mapped(self, directory):
+        """
+        Writes the sorted codes as a blob and offsets (code_keys.*) and their
+        chunk positions as one array with per-code offsets, for MappedCodeIndex.
+        """
+        write_corpus(os.path.join(directory, "code_keys.blob"), os.path.join(directory, "code_keys.offsets.npy"), self.keys)
+        counts = [len(self.codes[code]) for code in self.keys]
+        np.save(os.path.join(directory, "code_offsets.npy"), np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]).astype(np.int64))
+        np.save(os.path.join(directory, "code_positions.npy"), np.array([pos for code in self.keys for pos in self.codes[code]], dtype=np.int64))
+        with open(os.path.join(directory, "code_index.json"), "w", encoding="utf-8") as f:
+            json.dump({"source": self.source}, f)
+
+
+class MappedCodeIndex(CodeIndex):
+    """
+    Read-only code index of a snapshot: the sorted codes and their positions
+    are memory-mapped, so workers share them instead of each building the
+    dictionary.
+    """
+
+    def __init__(self, source, keys, offsets, positions):
+        self.source = source
+        self.keys = keys
+        self.offsets = offsets
+        self.positions = positions
+        self.filters = {}
+
+    def positions_at(self, i):
+        return self.positions[self.offsets[i]:self.offsets[i + 1]]
+
+    def add(self, chunks, start=0):
+        raise TypeError("A snapshot's code index is read-only.")
+
+    @classmethod
+    def load(cls, directory):
+        """
+        The index written by CodeIndex.save_mapped; snapshots built before it
+        have the code dictionary in code_index.json.
+        """
+        with open(os.path.join(directory, "code_index.json"), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if "codes" in data:
+            return CodeIndex(data["source"], data["codes"])
+        keys = Corpus(os.path.join(directory, "code_keys.blob"), os.path.join(directory, "code_keys.offsets.npy"))
+        return cls(data["source"], keys, np.load(os.path.join(directory, "code_offsets.npy"), mmap_mode="r"),
+                   np.load(os.path.join(directory, "code_positions.npy"), mmap_mode="r"))
+
+
+def update_code_index(path, chunks, source, start=0):
+    """
+    Adds uploaded chunks to the code index file. Uploads from position 0
+    start a new index; later batches are merged into the existing file.
+    """
+    index = CodeIndex.load(path) if start and os.path.exists(path) else CodeIndex(source)
+    index.add(chunks, start)
+    index.save(path)
+    _loaded.pop(path, None)
+    get_logger(source).info(f"[Main] Code index with {len(index.codes)} codes written to {path}.")
+    return index
+
+
+_loaded = {}
+
+
+def load_code_index(path, source):
+    """
+    Loads the code index written at upload time, cached until the file changes.
+    Returns None when there is no index file, so code lookups are skipped.
+    """
+    if not os.path.exists(path):
+        return None
+    stamp = os.path.getmtime(path)
+    cached = _loaded.get(path)
+    if cached and cached[0] == stamp:
+        record_cache(source, "code_index", hit=True)
+        return cached[1]
+    record_cache(source, "code_index", hit=False)
+    index = CodeIndex.load(path)
+    _loaded[path] = (stamp, index)
+    return index
+
+
+def _field(obj, name, default=None):
+    # The Pinecone client returns objects, the REST API and test doubles return dicts
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def fetch_vectors(index, positions, namespace="default", batch_size=100):
+    ids = [f"chunk_{i}" for i in positions]
+    vectors = {}
+    for i in range(0, len(ids), batch_size):
+        result = index.fetch(ids=ids[i:i+batch_size], namespace=namespace)
+        vectors.update(_field(result, "vectors", {}) or {})
+    # Keep the requested order
+    return [(vid, vectors[vid]) for vid in ids if vid in vectors]
+
+
+def fetch_chunks(index, positions, namespace="default"):
+    # Texts of vectors uploaded with the full chunk in metadata; None where missing
+    vectors = dict(fetch_vectors(index, positions, namespace))
+    return [(_field(vectors[f"chunk_{i}"], "metadata", {}) or {}).get("chunk") if f"chunk_{i}" in vectors else None for i in positions]
+
+
+def query_within(index, vector, positions, top_k=5, namespace="default", filter=None, include_metadata=True, sparse_vector=None, prefix_filter=None):
+    """
+    Vector search restricted to the given chunk positions. Small sets are
+    fetched and scored locally; larger ones are queried with `prefix_filter`
+    (CodeIndex.prefix_filter) added to `filter`, over-fetching for chunks
+    outside the positions. With a `sparse_vector` (sparse_encoder.hybrid_query)
+    the score is sparse-dense, like Pinecone's. Returns Pinecone-style matches
+    with id, score and metadata, only of the given positions: none when no
+    chunk of them matches.
+    """
+    if len(positions) <= FETCH_LIMIT:
+        fetched = fetch_vectors(index, positions, namespace)
+        if filter:
+            fetched = [(vid, vec) for vid, vec in fetched if matches_filter(_field(vec, "metadata", {}) or {}, filter)]
+        if not fetched:
+            return []
+        matrix = np.asarray([_field(vec, "values") for _, vec in fetched], dtype=np.float32)
+        # Query vectors are unit length, or weighted against the sparse part
+        scores = matrix @ np.asarray(vector, dtype=np.float32) / (np.linalg.norm(matrix, axis=1) + 1e-12)
+        if sparse_vector is not None:
+            query_weights = dict(zip(sparse_vector["indices"], sparse_vector["values"]))
+            for row, (_, vec) in enumerate(fetched):
+                sparse = _field(vec, "sparse_values") or {}
+                scores[row] += sum(query_weights.get(i, 0.0) * v for i, v in zip(_field(sparse, "indices", []), _field(sparse, "values", [])))
+        order = np.argsort(-scores)[:top_k]
+        return [{"id": fetched[i][0], "score": float(scores[i]), "metadata": _field(fetched[i][1], "metadata", {}) or {}} for i in order]
+    allowed = {f"chunk_{i}" for i in positions}
+    sparse = {"sparse_vector": sparse_vector} if sparse_vector is not None else {}
+    query = dict(vector=vector, top_k=min(top_k * OVERFETCH, 1000), include_metadata=include_metadata, namespace=namespace, **sparse)
+    matches = []
+    if prefix_filter:
+        matches = index.query(**query, filter={"$and": [filter, prefix_filter]} if filter else prefix_filter).get('matches', [])
+    if not matches:
+        # Vectors uploaded without code_prefix metadata: only the over-fetch narrows
+        matches = index.query(**query, filter=filter).get('matches', [])
+    return [hit for hit in matches if hit['id'] in allowed][:top_k]
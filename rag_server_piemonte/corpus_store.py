@@ -0,0 +1,116 @@
+"""
+Memory-mapped corpus of chunk texts, random-access by chunk ID.
+
+The line-per-chunk corpus file (chunks.txt, all_chunks.txt, DEI_chunks.txt)
+is compiled once into a UTF-8 blob (<name>.blob) and a uint64 offset array
+(<name>.offsets.npy): chunk i is blob[offsets[i]:offsets[i+1]], and i is the
+same position as the chunk_<i> vector ID. Both files are memory-mapped, so
+worker processes share the OS page cache instead of each holding a list of
+strings, and one chunk is read without scanning the file.
+"""
+import os
+import mmap
+import numpy as np
+from metrics import record_cache
+
+
+def corpus_paths(corpus_path):
+    root = os.path.splitext(corpus_path)[0]
+    return root + ".blob", root + ".offsets.npy"
+
+
+def build_corpus(corpus_path):
+    """
+    Compiles a corpus file. Chunks are its stripped, non-empty lines, as the
+    servers have always read them. Files are written under a temporary name
+    and renamed, so processes mapping the previous version keep reading it.
+    """
+    blob_path, offsets_path = corpus_paths(corpus_path)
+    offsets = [0]
+    with open(corpus_path, "r", encoding="utf-8") as src, open(blob_path + ".tmp", "wb") as out:
+        for line in src:
+            line = line.strip()
+            if line:
+                data = line.encode("utf-8")
+                out.write(data)
+                offsets.append(offsets[-1] + len(data))
+    with open(offsets_path + ".tmp", "wb") as f:
+        np.save(f, np.array(offsets, dtype=np.uint64))
+    os.replace(blob_path + ".tmp", blob_path)
+    os.replace(offsets_path + ".tmp", offsets_path)
+    return blob_path, offsets_path
+
+
+def write_corpus(blob_path, offsets_path, texts):
+    """
+    Writes a list of strings in the compiled corpus format, for other
+    read-only string lists that workers map with Corpus (the sorted keys of
+    the snapshot's code index and vocabulary).
+    """
+    offsets = [0]
+    with open(blob_path, "wb") as out:
+        for text in texts:
+            data = text.encode("utf-8")
+            out.write(data)
+            offsets.append(offsets[-1] + len(data))
+    with open(offsets_path, "wb") as f:
+        np.save(f, np.array(offsets, dtype=np.uint64))
+
+
+class Corpus:
+    """
+    Read-only sequence of chunk texts; supports len(), iteration and indexing
+    by position, like the list it replaces.
+    """
+    def __init__(self, blob_path, offsets_path):
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        # mmap cannot map an empty file
+        if os.path.getsize(blob_path):
+            with open(blob_path, "rb") as f:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.blob = b""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"chunk position {i} out of range")
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])].decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def get_many(self, positions):
+        return [self[i] for i in positions]
+
+
+_loaded = {}
+
+
+def load_corpus(corpus_path, source):
+    """
+    Corpus of a line-per-chunk file, compiled on first use and again whenever
+    the file changes; cached per process until then.
+    """
+    # Keyed by absolute path, so a different working directory gets its own corpus
+    key = os.path.abspath(corpus_path)
+    stamp = (os.path.getmtime(corpus_path), os.path.getsize(corpus_path))
+    cached = _loaded.get(key)
+    if cached and cached[0] == stamp:
+        record_cache(source, "corpus", hit=True)
+        return cached[1]
+    blob_path, offsets_path = corpus_paths(corpus_path)
+    compiled = all(os.path.exists(p) and os.path.getmtime(p) >= stamp[0] for p in (blob_path, offsets_path))
+    record_cache(source, "corpus", hit=compiled)
+    if not compiled:
+        build_corpus(corpus_path)
+    corpus = Corpus(blob_path, offsets_path)
+    _loaded[key] = (stamp, corpus)
+    return corpus
@@ -3,6 +3,8 @@ import json
 from langchain.prompts import ChatPromptTemplate
 from langchain_mistralai import ChatMistralAI
 from dotenv import load_dotenv
+from metrics import get_logger, LLM_TOKENS
+from llm_scheduler import LLMScheduler
 
 load_dotenv()
 # Mistral setup
@@ -19,20 +21,69 @@ llm = ChatMistralAI(
 with open(os.path.join(os.path.dirname(__file__), 'activity_keywords.txt'), 'r', encoding='utf-8') as f:
     activity_keywords = f.read().strip()
 
-messages = [
-    (
-        "system",
-        f"Based on the provided site visit notes, return only a valid JSON object as specified. Do not include any explanation, markdown, or commentary. Do not wrap the JSON in code blocks. Output only the JSON. Based on the book https://psu.pb.unizin.org/buildingconstructionmanagement/ and following standard: {activity_keywords}. Do site work planning in right order of construction timeline, you should prepare object in JSON format finding all site works from list of construction standard and return in the list with the key Works- you must list all the neccesary construction works for the site in the correct order according to the construction standard, add key Timeline which explains the reason of the work order, add keys for the reference to the Area, Subarea and Item it applies to, Unit, Quantity, and then add second object key Missing- describe what information is missing from provided details and describe what is needed for the quotation that has only high impact on costs only with key Missing, add key Severity High, Medium or Low, keys Area and Subarea it relates to, and Risks with explaining why plannning is affected and by how many days, costs or other risks associated, and key Suggestions what information to add to resove it. Add GeneralTimeline object with type of Activities in the right order of construction and two keys Starting and Finishing for each that represents number of days how much each activity will take and plan it in the same days when possible. The site visit information is following:",
-    ),
-    ("human", "{input}"),
-]
-prompt = ChatPromptTemplate.from_messages(messages)
-chain = prompt | llm
-
-def answer_question(query: str) -> str:
-    response = chain.invoke({
-        "input": query,
-    })
+# One system prompt per task. Only site-visit planning needs the construction
+# standard in activity_keywords.txt; the short search tasks (run several times
+# per search) get a one-line instruction and their human message says the rest.
+SYSTEM_PROMPTS = {
+    "refine": "You name construction activities with the wording of Italian price lists (Prezziario). Reply with the category only, no commentary.",
+    "rerank": "You rate how relevant a price list item is to a construction query. Reply with a single integer from 1 to 100 and nothing else.",
+    "alternatives": "You rephrase construction activities in Italian, with the wording of Italian price lists. Reply with one phrasing per line, no numbering or commentary.",
+    "site_visit": "Based on the provided site visit notes, return only a valid JSON object as specified. Do not include any explanation, markdown, or commentary. Do not wrap the JSON in code blocks. Output only the JSON. Based on the book https://psu.pb.unizin.org/buildingconstructionmanagement/ and following standard: {activity_keywords}. Do site work planning in right order of construction timeline, you should prepare object in JSON format finding all site works from list of construction standard and return in the list with the key Works- you must list all the neccesary construction works for the site in the correct order according to the construction standard, add key Timeline which explains the reason of the work order, add keys for the reference to the Area, Subarea and Item it applies to, Unit, Quantity, and then add second object key Missing- describe what information is missing from provided details and describe what is needed for the quotation that has only high impact on costs only with key Missing, add key Severity High, Medium or Low, keys Area and Subarea it relates to, and Risks with explaining why plannning is affected and by how many days, costs or other risks associated, and key Suggestions what information to add to resove it. Add GeneralTimeline object with type of Activities in the right order of construction and two keys Starting and Finishing for each that represents number of days how much each activity will take and plan it in the same days when possible. The site visit information is following:",
+}
+chains = {
+    # The keywords are passed as a value, so braces in the file are not read as template fields
+    task: ChatPromptTemplate.from_messages([("system", system), ("human", "{input}")]).partial(activity_keywords=activity_keywords) | llm
+    for task, system in SYSTEM_PROMPTS.items()
+}
+chain = chains["site_visit"]
+system_chars = {task: len(chains[task].first.format_messages(input="")[0].content) for task in chains}
+# Rough reply size, for the token estimate a call is admitted with
+REPLY_TOKENS = {"refine": 30, "rerank": 5, "alternatives": 80, "site_visit": 2000}
+
+# Every call of this process goes through the scheduler (see llm_scheduler.py)
+scheduler = LLMScheduler()
+# Rate-limit headers of every response, including successful ones
+llm.client.event_hooks["response"] = [lambda response: scheduler.observe(response.status_code, response.headers)]
+
+
+def record_tokens(task, response):
+    usage = getattr(response, "usage_metadata", None) or {}
+    if not usage:
+        token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+        usage = {"input_tokens": token_usage.get("prompt_tokens"), "output_tokens": token_usage.get("completion_tokens")}
+    for kind in ("input", "output"):
+        if usage.get(f"{kind}_tokens") is not None:
+            LLM_TOKENS.labels(task=task, kind=kind).observe(usage[f"{kind}_tokens"])
+    get_logger("mistral").debug(f"[RAG] {task} call used {usage.get('input_tokens')} input / {usage.get('output_tokens')} output tokens")
+    if usage.get("input_tokens") is None:
+        return None
+    return usage["input_tokens"] + (usage.get("output_tokens") or 0)
+
+
+def estimate_tokens(task, query):
+    # About 4 characters per token
+    return (system_chars[task] + len(query)) // 4 + REPLY_TOKENS.get(task, 100)
+
+
+def answer_question(query: str, task: str = "site_visit", priority: str = None, cancel=None) -> str:
+    """
+    Sends `query` with the system prompt of `task`: refine, rerank,
+    alternatives or site_visit (the default). The scheduler decides when;
+    `priority` (interactive, normal, batch) overrides the task's class, and a
+    set `cancel` event drops the call if it was not sent yet.
+    """
+    estimate = estimate_tokens(task, query)
+
+    def send():
+        response = chains[task].invoke({
+            "input": query,
+        })
+        used = record_tokens(task, response)
+        if used is not None:
+            scheduler.settle(used - estimate)
+        return response
+
+    response = scheduler.call(task, query, send, tokens=estimate, priority=priority, cancel=cancel)
         # Model loading logic can be added here if needed
     try:
         parsed_output = response.content
@@ -40,3 +91,9 @@ def answer_question(query: str) -> str:
     except Exception:
         return response.content.strip()
 
+
+if __name__ == "__main__":
+    # Rough size of each system prompt (about 4 characters per token); the
+    # billquant_llm_tokens histogram has the counts Mistral reports
+    for task in SYSTEM_PROMPTS:
+        print(f"{task:<13} ~{system_chars[task] // 4:>7} system prompt tokens")
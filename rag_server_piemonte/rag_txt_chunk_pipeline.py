@@ -9,23 +9,67 @@ import re
 from dotenv import load_dotenv
 from pinecone import Pinecone, ServerlessSpec
 from sentence_transformers import SentenceTransformer, util
-from rank_bm25 import BM25Okapi
+from text_analysis import LexicalIndex
+from index_snapshot import load_snapshot
+from query_expansion import expand_query, update_expansion_index
+from speculation import Speculation, similarity
+from fusion import fuse, collapse, MAX_CANDIDATES
+from metrics import get_logger, stage_timer, RERANK_CALLS
+from rerank import Deadline, order_candidates, resolve_texts, rerank
+from code_index import update_code_index, load_code_index, fetch_chunks, query_within, normalize_code, split_code_prefix, PREFIX_RESULTS
+from sparse_encoder import HYBRID_ALPHA, index_metric, update_sparse_encoder, save_sparse_encoder, load_sparse_encoder, hybrid_query, unit_rows
+from dedup import update_dedup_index, load_dedup_index, cluster_upload, cluster_key
+from category_index import CategoryIndex, chunk_categories, load_category_index, TOP_CATEGORIES
+from chunk_store import get_chunk_store, stored_records, vector_position
+from corpus_store import load_corpus
+from chunk_metadata import compact_metadata, filter_candidates, LOCAL_FILTER_OVERFETCH
 
 load_dotenv()
 
-def pinecone_retrieve(query, top_k=5, index_name="piemonte-chunks", namespace="default"):
+SOURCE = "piemonte"
+logger = get_logger(SOURCE)
+CODE_INDEX_PATH = "code_index_piemonte.json"
+CATEGORY_INDEX_PATH = "category_index_piemonte.npz"
+CHUNK_STORE_PATH = "chunk_store_piemonte.sqlite"
+EXPANSION_INDEX_PATH = "expansion_index_piemonte.npz"
+SPARSE_ENCODER_PATH = "sparse_encoder_piemonte.json"
+DEDUP_INDEX_PATH = "dedup_index_piemonte.npz"
+
+def pinecone_retrieve(query, top_k=5, index_name="piemonte-chunks", namespace="default", return_scores=False, positions=None, prefix="", category_index=None, filter=None):
     """
     Retrieve top_k most similar chunks from Pinecone using semantic search.
     """
     embedder = get_embedder()
-    query_emb = embedder.encode(query, convert_to_numpy=True).tolist()
-    index = get_pinecone_index(index_name=index_name)
-    # Query Pinecone
-    result = index.query(vector=query_emb, top_k=top_k, include_metadata=True, namespace=namespace)
-    # Extract chunk texts from metadata
-    hits = result.get('matches', [])
-    # If you store the full chunk text in metadata, return it; otherwise, return IDs or other fields
-    return [hit['metadata'].get('chunk', hit['id']) for hit in hits]
+    with stage_timer(SOURCE, "encode"):
+        query_emb = embedder.encode(query, convert_to_numpy=True)
+        # Dense and BM25 sparse vector in one query, when the index was uploaded with both
+        vectors = hybrid_query(query_emb, query, load_sparse_encoder(SPARSE_ENCODER_PATH, SOURCE))
+    # Returns chunk IDs: texts and records are looked up in the chunk store only for the candidates that need them
+    with stage_timer(SOURCE, "vector_query"):
+        index = get_pinecone_index(index_name=index_name)
+        dedup = load_dedup_index(DEDUP_INDEX_PATH, SOURCE)
+        if positions is not None and dedup is not None:
+            # Near-duplicates are searched through their representative
+            positions = dedup.representatives_of(positions)
+        # Query Pinecone, only over chunks under a code prefix when given
+        if positions is not None:
+            hits = query_within(index, vectors["vector"], positions, top_k=top_k, namespace=namespace, filter=filter, include_metadata=False,
+                                sparse_vector=vectors.get("sparse_vector"), prefix_filter=chapter_filter(prefix))
+        elif category_index is not None:
+            # Coarse: best categories by centroid; fine: only their activities
+            with stage_timer(SOURCE, "category"):
+                categories = [category_index.names[i] for i in category_index.top(query_emb)]
+            category_filter = {"category": {"$in": categories}}
+            hits = index.query(**vectors, top_k=top_k, include_metadata=False, namespace=namespace,
+                               filter={"$and": [filter, category_filter]} if filter else category_filter).get('matches', [])
+            if not hits:
+                # Vectors uploaded without category metadata
+                hits = index.query(**vectors, top_k=top_k, include_metadata=False, namespace=namespace, filter=filter).get('matches', [])
+        else:
+            hits = index.query(**vectors, top_k=top_k, include_metadata=False, namespace=namespace, filter=filter).get('matches', [])
+    if return_scores:
+        return [(vector_position(hit['id']), hit.get('score', 0)) for hit in hits]
+    return [vector_position(hit['id']) for hit in hits]
 
 def get_pinecone_index(index_name="piemonte-chunks", dimension=384, metric="cosine", region=None):
     api_key = os.getenv("PINECONE_API_KEY")
@@ -49,32 +93,48 @@ def upload_chunks_to_pinecone(chunks, batch_size=70, index_name="piemonte-chunks
     """
     Uploads all chunks to Pinecone in batches, with embeddings and metadata.
     """
-    print("[Main] Preparing to upload chunks to Pinecone...")
+    logger.info("[Main] Preparing to upload chunks to Pinecone...")
     corpus = [chunk for chunk in chunks]
-    # Troubleshoot: check metadata size for each chunk
-    for idx, chunk in enumerate(corpus):
-        meta_size = len(chunk.encode('utf-8'))
-        if meta_size > 40960:
-            print(f"[Warning] Chunk {idx} metadata size {meta_size} bytes exceeds Pinecone limit (40960 bytes). Preview: {chunk[:200]}...")
+    # Full text and parsed records go to the local chunk store, the index only gets small filterable fields
+    records = [parse_chunk(chunk) for chunk in corpus]
+    get_chunk_store(CHUNK_STORE_PATH, create=True).write(corpus, records=records)
     embedder = get_embedder()
-    print("[Main] Encoding chunks for retrieval...")
+    logger.info("[Main] Encoding chunks for retrieval...")
     chunk_embeddings = embedder.encode(corpus, convert_to_numpy=True, show_progress_bar=True)
-    index = get_pinecone_index(index_name=index_name, dimension=chunk_embeddings.shape[1])
+    # Sparse values need a dotproduct index; unit-length dense vectors keep the dense score a cosine
+    index = get_pinecone_index(index_name=index_name, dimension=chunk_embeddings.shape[1], metric="dotproduct" if HYBRID_ALPHA > 0 else "cosine")
+    # An index created before hybrid search keeps its cosine metric, which rejects sparse values
+    hybrid = HYBRID_ALPHA > 0 and index_metric(index_name) == "dotproduct"
+    if HYBRID_ALPHA > 0 and not hybrid:
+        logger.warning(f"[Main] Pinecone index '{index_name}' does not use the dotproduct metric: uploading dense vectors only. Delete it and upload again for hybrid search.")
+    dense = unit_rows(chunk_embeddings)
+    encoder, sparse = update_sparse_encoder(SPARSE_ENCODER_PATH, chunks, SOURCE) if hybrid else (None, None)
     ids = [f"chunk_{i}" for i in range(len(corpus))]
     metadatas = [
-        {"chunk": chunk} for chunk in chunks
+        compact_metadata(chunk, SOURCE, category) for chunk, category in zip(chunks, chunk_categories(corpus))
     ]
-    for i in range(0, len(corpus), batch_size):
-        batch_ids = ids[i:i+batch_size]
-        batch_embs = chunk_embeddings[i:i+batch_size]
-        batch_metas = metadatas[i:i+batch_size]
+    # Near-duplicate activities (by title) get one vector, the representative's
+    dedup = update_dedup_index(DEDUP_INDEX_PATH, [" ".join(activity["title"] for activity in record) or chunk for chunk, record in zip(corpus, records)],
+                               [cluster_key(metadata) for metadata in metadatas], SOURCE)
+    uploaded = cluster_upload(index, dedup, 0, len(corpus), metadatas, namespace=namespace)
+    for i in range(0, len(uploaded), batch_size):
         to_upsert = [
-            (batch_ids[j], batch_embs[j], batch_metas[j])
-            for j in range(len(batch_ids))
+            {"id": ids[j], "values": dense[j].tolist(), "metadata": metadatas[j]}
+            for j in uploaded[i:i+batch_size]
         ]
+        if sparse is not None:
+            for j, vector in zip(uploaded[i:i+batch_size], to_upsert):
+                vector["sparse_values"] = sparse[j]
         index.upsert(vectors=to_upsert, namespace=namespace)
-    print("[Main] Embeddings uploaded to Pinecone.")
-from rank_bm25 import BM25Okapi
+    # Only once the sparse vectors are in the index: queries send them as soon as the file exists
+    save_sparse_encoder(SPARSE_ENCODER_PATH, encoder, SOURCE)
+    logger.info(f"[Main] {len(uploaded)} embeddings uploaded to Pinecone.")
+    update_code_index(CODE_INDEX_PATH, chunks, SOURCE)
+    category_index = CategoryIndex.build(corpus, chunk_embeddings)
+    category_index.save(CATEGORY_INDEX_PATH)
+    logger.info(f"[Main] Category index with {len(category_index.names)} categories written to {CATEGORY_INDEX_PATH}.")
+    titles = [activity["title"] for record in records for activity in record]
+    update_expansion_index(EXPANSION_INDEX_PATH, category_index.names + titles, embedder, SOURCE)
 embedder_global = None
 def get_embedder():
     global embedder_global
@@ -83,19 +143,34 @@ def get_embedder():
         embedder_global = SentenceTransformer('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
     return embedder_global
 
-def hybrid_retrieve(query, all_chunks, chunk_embeddings, embedder=None, top_k=3, alpha=0.7):
+def hybrid_retrieve(query, all_chunks, chunk_embeddings, embedder=None, top_k=3, alpha=0.7, return_scores=False, category_index=None, positions=None,
+                    lexical_index=None):
+    """
+    Returns positions in all_chunks, like the chunk IDs of pinecone_retrieve;
+    only the chunks at `positions` are searched when given. BM25 uses
+    `lexical_index`, built from all_chunks when not given.
+    """
     # Semantic search
     if embedder is None:
         embedder = get_embedder()
-    query_emb = embedder.encode(query, convert_to_tensor=True)
-    semantic_hits = util.semantic_search(query_emb, chunk_embeddings, top_k=len(all_chunks))[0]
+    with stage_timer(SOURCE, "encode"):
+        query_emb = embedder.encode(query, convert_to_tensor=True)
+    if positions is None and category_index is not None:
+        # Coarse: best categories by centroid; fine: only their activities
+        with stage_timer(SOURCE, "category"):
+            positions = category_index.positions(category_index.top(query_emb)).tolist()
+    ids = range(len(all_chunks)) if positions is None else positions
+    if positions is not None:
+        chunk_embeddings = chunk_embeddings[positions]
+    with stage_timer(SOURCE, "vector_query"):
+        semantic_hits = util.semantic_search(query_emb, chunk_embeddings, top_k=len(ids))[0]
     semantic_scores = {hit['corpus_id']: hit['score'] for hit in semantic_hits}
 
-    # BM25 keyword search
-    tokenized_chunks = [chunk.lower().split() for chunk in all_chunks]
-    bm25 = BM25Okapi(tokenized_chunks)
-    tokenized_query = query.lower().split()
-    bm25_scores = bm25.get_scores(tokenized_query)
+    # BM25 keyword search over the pre-tokenized corpus
+    if lexical_index is None:
+        lexical_index = LexicalIndex.build(all_chunks)
+    with stage_timer(SOURCE, "bm25"):
+        bm25_scores = lexical_index.scores(query, positions)
     import numpy as np
     # Normalize BM25 scores to [0,1]
     bm25_min = min(bm25_scores) if len(bm25_scores) > 0 else 0
@@ -103,7 +178,7 @@ def hybrid_retrieve(query, all_chunks, chunk_embeddings, embedder=None, top_k=3,
     bm25_scores_norm = [(score - bm25_min) / (bm25_max - bm25_min + 1e-8) for score in bm25_scores]
 
     # Normalize semantic scores to [0,1]
-    sem_scores_list = [semantic_scores.get(idx, 0) for idx in range(len(all_chunks))]
+    sem_scores_list = [semantic_scores.get(idx, 0) for idx in range(len(ids))]
     sem_min = min(sem_scores_list) if sem_scores_list else 0
     sem_max = max(sem_scores_list) if sem_scores_list else 1
     semantic_scores_norm = [(score - sem_min) / (sem_max - sem_min + 1e-8) for score in sem_scores_list]
@@ -114,14 +189,16 @@ def hybrid_retrieve(query, all_chunks, chunk_embeddings, embedder=None, top_k=3,
 
     # Combine scores
     combined_scores = {}
-    for idx in range(len(all_chunks)):
+    for idx in range(len(ids)):
         bm25_score = bm25_softmax[idx]
         sem_score = sem_softmax[idx]
         combined_scores[idx] = alpha * bm25_score + (1 - alpha) * sem_score
 
     # Get top_k indices
     top_indices = sorted(combined_scores, key=lambda i: combined_scores[i], reverse=True)[:top_k]
-    return [all_chunks[i] for i in top_indices]
+    if return_scores:
+        return [(ids[i], combined_scores[i]) for i in top_indices]
+    return [ids[i] for i in top_indices]
 import os
 import re
 import torch
@@ -235,198 +312,304 @@ def load_and_chunk_rag_txt(rag_folder="rag", out_file="all_chunks.txt"):
     with open(out_file, "w", encoding="utf-8") as f:
         for chunk in chunks:
             f.write(chunk + "\n")
-    print(f"All chunks written to {out_file}")
+    logger.info(f"All chunks written to {out_file}")
+
+# Chunk parser patterns, compiled once
+ACTIVITY_PATTERN = re.compile(r"Activity:(.*?)(?=Activity:|$)", re.DOTALL)
+WORK_TITLE_PATTERN = re.compile(r"Work:(.*?)Codice:", re.DOTALL)
+WORK_SPLIT_PATTERN = re.compile(r"Work:")
+CODE_PATTERN = re.compile(r"Codice:\s*([^,\n]*)")
+UNIT_PATTERN = re.compile(r"U\.M\.:\s*([^,\n]*)")
+PRICE_PATTERN = re.compile(r"Euro:\s*([^,\n]*)")
+
+# Helper to parse a chunk into the required structure
+def parse_chunk(chunk):
+    # Find all Activity blocks
+    activities = ACTIVITY_PATTERN.findall(chunk)
+    results = []
+    for activity_block in activities:
+        # Title: from start to first Work
+        work_match = WORK_TITLE_PATTERN.search(activity_block)
+        title = ""
+        if work_match:
+            title = activity_block.split('Work:')[0].strip()
+        else:
+            title = activity_block.strip()
+        # Find all Work blocks
+        work_blocks = WORK_SPLIT_PATTERN.split(activity_block)
+        resources = []
+        for wb in work_blocks[1:]:
+            # Extract fields
+            desc = wb.split('Codice:')[0].strip() if 'Codice:' in wb else wb.strip()
+            code = ""
+            unit = ""
+            price = ""
+            # Extract code, unit, price
+            code_match = CODE_PATTERN.search(wb)
+            if code_match:
+                code = code_match.group(1).strip()
+            unit_match = UNIT_PATTERN.search(wb)
+            if unit_match:
+                unit = unit_match.group(1).strip()
+            price_match = PRICE_PATTERN.search(wb)
+            if price_match:
+                price = price_match.group(1).strip()
+            resources.append({
+                "description": desc,
+                "code": code,
+                "unit": unit,
+                "price": price,
+                "total": "",
+                "formula": "",
+                "quantity": ""
+            })
+        results.append({
+            "code": "",
+            "title": title,
+            "unit": "",
+            "quantity": "",
+            "resources": resources
+        })
+    return results
+
+def match_code(query, snapshot=None):
+    """
+    Looks a code-shaped query up in the code index of the Pinecone upload, or of
+    `snapshot` when searching locally. Returns (kind, positions, rest) as
+    CodeIndex.match, or (None, [], query) when there is no code index.
+    """
+    index = load_code_index(CODE_INDEX_PATH, SOURCE) if snapshot is None else snapshot.code_index
+    if index is None:
+        return None, [], query
+    return index.match(query)
+
+def chapter_filter(prefix):
+    # Pinecone filter on the code_prefix metadata of the chunks under a code prefix
+    index = load_code_index(CODE_INDEX_PATH, SOURCE) if prefix else None
+    return index.prefix_filter(prefix) if index is not None else None
+
+def chunks_at(positions, snapshot=None):
+    """
+    Chunk texts by ID, in order (None where missing): from `snapshot` when
+    searching locally, the chunk store, or the vector metadata of uploads made
+    before it existed.
+    """
+    if snapshot is not None:
+        return snapshot.corpus.get_many(positions)
+    store = get_chunk_store(CHUNK_STORE_PATH)
+    if store is None:
+        return fetch_chunks(get_pinecone_index(), positions)
+    return store.get_many(positions)
+
+def records_at(positions, snapshot=None):
+    """
+    Parsed activities of the chunks at `positions`, as written by the uploader
+    or the snapshot builder; chunks without a stored record (older uploads)
+    are parsed here.
+    """
+    store = get_chunk_store(CHUNK_STORE_PATH) if snapshot is None else snapshot.store
+    with stage_timer(SOURCE, "parse"):
+        records = stored_records(store, positions, parse_chunk, lambda missing: chunks_at(missing, snapshot))
+    return [activity for record in records for activity in record]
+
+def code_results(kind, positions, query, snapshot=None):
+    """
+    Parsed chunks for a code match. For an exact code only the Work with that
+    code is kept; a chapter prefix lists its first chunks in code order.
+    """
+    mapped = []
+    for activity in records_at(positions[:PREFIX_RESULTS], snapshot):
+        if kind == "exact":
+            activity["resources"] = [r for r in activity["resources"] if normalize_code(r["code"]) == normalize_code(query)]
+            if not activity["resources"]:
+                continue
+        mapped.append(activity)
+    logger.info(f"[RAG] Code {kind} match for '{query}': {len(mapped)} activities")
+    return mapped
 
-def embed_and_retrieve(query, all_chunks_file="all_chunks.txt", top_k=3, embeddings_path="chunk_embeddings_piemonte.pt", use_pinecone=True):
+def embed_and_retrieve(query, all_chunks_file="all_chunks.txt", top_k=3, embeddings_path="chunk_embeddings_piemonte.pt", use_pinecone=True, deadline=None, filter=None,
+                       version=None, refinement=None):
+    """
+    `refinement` is a Speculation of the caller's Mistral refinement of the
+    query: the raw query is searched while it runs, and its reply replaces the
+    query unless the raw query's best hit cancelled it.
+    """
     import re
+    if deadline is None:
+        deadline = Deadline()
+    # Pinecone holds one version of the price list: a pinned one is searched in its snapshot
+    if version is not None:
+        use_pinecone = False
     try:
         from mistral_utils import answer_question
     except ImportError:
-        def answer_question(q):
+        def answer_question(q, task=None, cancel=None):
             return q  # fallback: identity
 
     # Always get candidates, then run accuracy and parsing logic
     if use_pinecone:
-        print("[RAG] Using Pinecone for semantic search...")
-        retrieve_fn = pinecone_retrieve
+        logger.info("[RAG] Using Pinecone for semantic search...")
+        snapshot = None
+        category_index = load_category_index(CATEGORY_INDEX_PATH, SOURCE) if TOP_CATEGORIES > 0 else None
+        def retrieve_fn(q, top_k=5, return_scores=False, positions=None):
+            return pinecone_retrieve(q, top_k=top_k, return_scores=return_scores, positions=positions, prefix=prefix,
+                                     category_index=category_index if positions is None else None, filter=filter)
     else:
         # Local retrieval logic setup
-        with open(all_chunks_file, "r", encoding="utf-8") as f:
-            all_chunks = [c.strip() for c in f if c.strip()]
         embedder = get_embedder()
-        if os.path.exists(embeddings_path):
-            chunk_embeddings = torch.load(embeddings_path, map_location='cpu')
-            # Fix: If chunk_embeddings is a meta tensor, reload properly
-            try:
-                if hasattr(chunk_embeddings, 'is_meta') and chunk_embeddings.is_meta:
-                    print('[RAG] chunk_embeddings is meta tensor, re-encoding on CPU...')
-                    chunk_embeddings = embedder.encode(all_chunks, convert_to_tensor=True, show_progress_bar=True)
-                    torch.save(chunk_embeddings, embeddings_path)
-            except Exception:
-                # Fallback: if any error, re-encode
-                chunk_embeddings = embedder.encode(all_chunks, convert_to_tensor=True, show_progress_bar=True)
-                torch.save(chunk_embeddings, embeddings_path)
-            if len(chunk_embeddings) != len(all_chunks):
-                chunk_embeddings = embedder.encode(all_chunks, convert_to_tensor=True, show_progress_bar=True)
-                torch.save(chunk_embeddings, embeddings_path)
+        # Corpus, embeddings and indexes of one snapshot, memory-mapped and shared by every worker;
+        # this search keeps it even if another one is activated meanwhile
+        snapshot = load_snapshot(all_chunks_file, SOURCE, embedder, parse_chunk, embeddings_path, version)
+        all_chunks, chunk_embeddings, lexical_index = snapshot.corpus, snapshot.embeddings, snapshot.lexical_index
+        # Built by the first search of each snapshot and saved next to it
+        category_index = load_category_index(os.path.join(snapshot.path, CATEGORY_INDEX_PATH), SOURCE, all_chunks, chunk_embeddings) if TOP_CATEGORIES > 0 else None
+        def retrieve_fn(q, top_k=5, return_scores=False, positions=None):
+            # No metadata index locally: score more candidates, then filter them
+            fetch_k = top_k * LOCAL_FILTER_OVERFETCH if filter else top_k
+            # Only chunks under a code prefix when given, otherwise those of the best categories
+            candidates = hybrid_retrieve(q, all_chunks, chunk_embeddings, embedder, top_k=fetch_k, alpha=0.1, return_scores=True,
+                                         category_index=category_index, positions=positions, lexical_index=lexical_index)
+            candidates = filter_candidates(candidates, all_chunks, SOURCE, filter, top_k)
+            return candidates if return_scores else [pos for pos, _ in candidates]
+
+    # A pasted code (or chapter) is answered from the code index, without Mistral or vector search
+    with stage_timer(SOURCE, "code_lookup"):
+        kind, positions, rest = match_code(query, snapshot)
+        if kind == "exact" or (kind == "prefix" and not rest):
+            return code_results(kind, positions, query, snapshot)
+    if kind == "prefix":
+        logger.info(f"[RAG] Searching {len(positions)} chunks under code prefix of '{query}'")
+        prefix = split_code_prefix(query)[0]
+        query = rest
+    else:
+        positions, prefix = None, ""
+
+    def search_speculatively(q, speculation):
+        # Candidates of q, and whether its best hit was confident enough to cancel the refinement
+        logger.info(f"[RAG] Searching with raw query while refining: {q}")
+        candidates = retrieve_fn(q, top_k=5, return_scores=True, positions=positions)
+        if not candidates:
+            best = 0.0
+        elif use_pinecone:
+            best = max(score for _, score in candidates)
         else:
-            chunk_embeddings = embedder.encode(all_chunks, convert_to_tensor=True, show_progress_bar=True)
-            torch.save(chunk_embeddings, embeddings_path)
-        def retrieve_fn(q, top_k=5):
-            return hybrid_retrieve(q, all_chunks, chunk_embeddings, embedder, top_k=top_k, alpha=0.1)
+            best = similarity(embedder, q, chunk_embeddings[candidates[0][0]])
+        return candidates, speculation.settle(best)
 
-    # Use Mistral to generate a list of strong synonym queries (activity categories) in Italian
-    try:
-        refined_query = answer_question(f"Define the construction activity category in italian that describes it best in Prezziario with one to max 10 words, exclude any other commentary, for: {query}")
-        # If the model returns a dict with error or rate limit, fallback
-        if isinstance(refined_query, dict) and ("error" in refined_query or "rate limit" in str(refined_query).lower()):
-            print("[RAG] Mistral failed or rate limit exceeded, using original query.")
+    # One ranking per searched query
+    rankings = []
+    searched = set()
+    confident = False
+    queries = None
+    if refinement is not None:
+        # The caller's refinement runs while the raw query is searched
+        candidates, confident = search_speculatively(query, refinement)
+        rankings.append(candidates)
+        searched.add(query)
+        if confident:
             queries = [query]
         else:
-            print(f"[RAG] Refined query/categories: {refined_query}")
-            if isinstance(refined_query, str):
-                queries = [q.strip() for q in re.split(r'[\n,;]+', refined_query) if q.strip()]
+            with stage_timer(SOURCE, "refine"):
+                refined_query = refinement.result()
+            if isinstance(refined_query, dict) and "error" in refined_query:
+                logger.warning("[RAG] Mistral failed or rate limit exceeded, using original query.")
+                queries = [query]
+            else:
+                query = refined_query
+    if queries is None:
+        # Synonym queries from the local expansion index; Mistral only when it is not confident
+        with stage_timer(SOURCE, "expand"):
+            queries = expand_query(query, EXPANSION_INDEX_PATH, SOURCE, get_embedder())
+    # Use Mistral to generate a list of strong synonym queries (activity categories) in Italian,
+    # while the query is searched; a confident hit cancels it
+    try:
+        if queries is None:
+            speculation = Speculation(SOURCE, lambda cancel, query=query: answer_question(f"Define the construction activity category in italian that describes it best in Prezziario with one to max 10 words, exclude any other commentary, for: {query}", task="refine", cancel=cancel))
+            if query not in searched:
+                candidates, confident = search_speculatively(query, speculation)
+                rankings.append(candidates)
+                searched.add(query)
+            if confident:
+                queries = [query]
             else:
-                queries = [str(refined_query)]
+                with stage_timer(SOURCE, "refine"):
+                    refined_query = speculation.result()
+                # If the model returns a dict with error or rate limit, fallback
+                if isinstance(refined_query, dict) and ("error" in refined_query or "rate limit" in str(refined_query).lower()):
+                    logger.warning("[RAG] Mistral failed or rate limit exceeded, using original query.")
+                    queries = [query]
+                else:
+                    logger.info(f"[RAG] Refined query/categories: {refined_query}")
+                    if isinstance(refined_query, str):
+                        queries = [q.strip() for q in re.split(r'[\n,;]+', refined_query) if q.strip()]
+                    else:
+                        queries = [str(refined_query)]
     except Exception as e:
-        print(f"[RAG] Mistral exception: {e}. Using original query.")
+        logger.warning(f"[RAG] Mistral exception: {e}. Using original query.")
         queries = [query]
     # Retrieve candidates for each synonym/category
-    all_candidates = []
     for q in queries:
-        print(f"[RAG] Searching with synonym/category: {q}")
-        if use_pinecone:
-            candidates = pinecone_retrieve(q, top_k=5)
-            print(candidates)
-        else:
-            candidates = hybrid_retrieve(q, all_chunks, chunk_embeddings, embedder, top_k=5, alpha=0.1)
-        all_candidates.extend(candidates)
-    # Deduplicate
-    all_candidates = list(dict.fromkeys(all_candidates))
+        if q in searched:
+            continue
+        logger.info(f"[RAG] Searching with synonym/category: {q}")
+        candidates = retrieve_fn(q, top_k=5, return_scores=True, positions=positions)
+        logger.debug(candidates)
+        rankings.append(candidates)
+    # Chunks found by several synonyms first, so the re-rank can usually stop early
+    texts = {}
+    with stage_timer(SOURCE, "fusion"):
+        all_candidates = resolve_texts(SOURCE, fuse(rankings), texts, lambda ids: chunks_at(ids, snapshot))
+        all_candidates = collapse(SOURCE, all_candidates, texts, None if use_pinecone else chunk_embeddings)
     # Re-rank with Mistral
-    best_accuracy = 0
-    best_chunk = None
-    best_idx = 0
-    for i, chunk in enumerate(all_candidates):
-        title = chunk.split("\n")[0] if "\n" in chunk else chunk[:500]
-        prompt = f"Is the following construction activity relevant to the query '{query}'? Activity: '{title}'. Return number from 1 to 100 representing accuracy."
-        try:
-            acc_str = answer_question(prompt)
-            try:
-                accuracy = int(''.join(filter(str.isdigit, str(acc_str))))
-            except Exception:
-                accuracy = 0
-        except Exception:
-            accuracy = 0
-        print(f"Chunk {i+1} title: {title}\nAccuracy: {accuracy}")
-        if accuracy > best_accuracy:
-            best_accuracy = accuracy
-            best_chunk = chunk
-            best_idx = i
-    # If best accuracy < 90, try alternative phrasings, unless Mistral failed/rate limited
+    best_accuracy, best_chunk, best_idx, rerank_calls = rerank(query, all_candidates[:MAX_CANDIDATES], answer_question, SOURCE, 90, deadline, texts=texts)
+    # If best accuracy < 90, try alternative phrasings, unless Mistral failed/rate limited or time is short
     mistral_failed = False
-    if best_accuracy < 90 and queries != [query]:
-        try:
-            print(f"[RAG] Best accuracy only {best_accuracy}, generating alternative phrasings...")
-            alt_queries = answer_question(f"Give 5 alternative ways to describe the same construction activity as: {query}, in italian, each as a single line, no commentary.")
-            if isinstance(alt_queries, dict) and ("error" in alt_queries or "rate limit" in str(alt_queries).lower()):
-                print("[RAG] Mistral failed or rate limit exceeded for alternatives, skipping.")
+    if best_accuracy < 90 and (queries != [query] or confident) and deadline.near():
+        deadline.degrade(SOURCE, "skipped_alt_phrasings")
+    elif best_accuracy < 90 and (queries != [query] or confident):
+        with stage_timer(SOURCE, "alt_phrasings"):
+            try:
+                logger.info(f"[RAG] Best accuracy only {best_accuracy}, generating alternative phrasings...")
+                alt_queries = answer_question(f"Give 5 alternative ways to describe the same construction activity as: {query}, in italian, each as a single line, no commentary.", task="alternatives")
+                if isinstance(alt_queries, dict) and ("error" in alt_queries or "rate limit" in str(alt_queries).lower()):
+                    logger.warning("[RAG] Mistral failed or rate limit exceeded for alternatives, skipping.")
+                    mistral_failed = True
+                else:
+                    if isinstance(alt_queries, str):
+                        alt_queries = [q.strip() for q in re.split(r'[\n,;]+', alt_queries) if q.strip()]
+                    elif not isinstance(alt_queries, list):
+                        alt_queries = [str(alt_queries)]
+                    for alt in alt_queries:
+                        if best_accuracy >= 90:
+                            break
+                        if deadline.near():
+                            deadline.degrade(SOURCE, "skipped_alt_phrasings")
+                            break
+                        logger.info(f"[RAG] Trying alternative: {alt}")
+                        candidates = retrieve_fn(alt, top_k=5, return_scores=True, positions=positions)
+                        candidates = resolve_texts(SOURCE, order_candidates(candidates), texts, lambda ids: chunks_at(ids, snapshot))
+                        best_accuracy, best_chunk, best_idx, calls = rerank(query, candidates, answer_question, SOURCE, 90, deadline,
+                                                                            best=(best_accuracy, best_chunk, best_idx), label="[ALT] Chunk", texts=texts)
+                        rerank_calls += calls
+            except Exception as e:
+                logger.warning(f"[RAG] Mistral exception for alternatives: {e}. Skipping alternatives.")
                 mistral_failed = True
-            else:
-                if isinstance(alt_queries, str):
-                    alt_queries = [q.strip() for q in re.split(r'[\n,;]+', alt_queries) if q.strip()]
-                elif not isinstance(alt_queries, list):
-                    alt_queries = [str(alt_queries)]
-                for alt in alt_queries:
-                    print(f"[RAG] Trying alternative: {alt}")
-                    candidates = hybrid_retrieve(alt, all_chunks, chunk_embeddings, embedder, top_k=5, alpha=0.1)
-                    for i, chunk in enumerate(candidates):
-                        title = chunk.split("\n")[0] if "\n" in chunk else chunk[:500]
-                        prompt = f"Is the following construction activity relevant to the query '{query}'? Activity: '{title}'. Return number from 1 to 100 representing accuracy."
-                        try:
-                            acc_str = answer_question(prompt)
-                            try:
-                                accuracy = int(''.join(filter(str.isdigit, str(acc_str))))
-                            except Exception:
-                                accuracy = 0
-                        except Exception:
-                            accuracy = 0
-                        print(f"[ALT] Chunk {i+1} title: {title}\nAccuracy: {accuracy}")
-                        if accuracy > best_accuracy:
-                            best_accuracy = accuracy
-                            best_chunk = chunk
-                            best_idx = i
-        except Exception as e:
-            print(f"[RAG] Mistral exception for alternatives: {e}. Skipping alternatives.")
-            mistral_failed = True
-    print(f"[RAG] Best accuracy: {best_accuracy} (chunk {best_idx+1})")
-    print("[RAG] Pipeline complete.")
-    # Helper to parse a chunk into the required structure
-    def parse_chunk(chunk):
-        import re
-        # Find all Activity blocks
-        activity_pattern = r"Activity:(.*?)(?=Activity:|$)"
-        activities = re.findall(activity_pattern, chunk, re.DOTALL)
-        results = []
-        for activity_block in activities:
-            # Title: from start to first Work
-            work_match = re.search(r"Work:(.*?)Codice:", activity_block, re.DOTALL)
-            title = ""
-            if work_match:
-                title = activity_block.split('Work:')[0].strip()
-            else:
-                title = activity_block.strip()
-            # Find all Work blocks
-            work_blocks = re.split(r"Work:", activity_block)
-            resources = []
-            for wb in work_blocks[1:]:
-                # Extract fields
-                desc = wb.split('Codice:')[0].strip() if 'Codice:' in wb else wb.strip()
-                code = ""
-                unit = ""
-                price = ""
-                # Extract code, unit, price
-                code_match = re.search(r"Codice:\s*([^,\n]*)", wb)
-                if code_match:
-                    code = code_match.group(1).strip()
-                unit_match = re.search(r"U\.M\.:\s*([^,\n]*)", wb)
-                if unit_match:
-                    unit = unit_match.group(1).strip()
-                price_match = re.search(r"Euro:\s*([^,\n]*)", wb)
-                if price_match:
-                    price = price_match.group(1).strip()
-                resources.append({
-                    "description": desc,
-                    "code": code,
-                    "unit": unit,
-                    "price": price,
-                    "total": "",
-                    "formula": "",
-                    "quantity": ""
-                })
-            results.append({
-                "code": "",
-                "title": title,
-                "unit": "",
-                "quantity": "",
-                "resources": resources
-            })
-        return results
-
-    # Map all candidates using the parser and flatten the list
-    mapped = []
-    for chunk in all_candidates:
-        mapped.extend(parse_chunk(chunk))
-    return mapped
+    RERANK_CALLS.labels(source=SOURCE).observe(rerank_calls)
+    logger.info(f"[RAG] Best accuracy: {best_accuracy} (chunk {best_idx+1})", extra={"fields": {"best_accuracy": best_accuracy, "rerank_calls": rerank_calls, "degraded": deadline.degraded}})
+    logger.info("[RAG] Pipeline complete.")
+    # Parsed records of all candidates, flattened; a selected representative comes with its near-duplicates
+    dedup = load_dedup_index(DEDUP_INDEX_PATH, SOURCE) if use_pinecone else None
+    return records_at(all_candidates if dedup is None else dedup.expand(all_candidates, best_chunk), snapshot)
 
 if __name__ == "__main__":
     # Only upload to Pinecone if all_chunks.txt exists
     all_chunks_path = "all_chunks.txt"
     if not os.path.exists(all_chunks_path):
-        print(f"[Info] {all_chunks_path} not found. Generating it using load_and_chunk_rag_txt()...")
+        logger.info(f"[Info] {all_chunks_path} not found. Generating it using load_and_chunk_rag_txt()...")
         load_and_chunk_rag_txt(rag_folder="./rag", out_file=all_chunks_path)
-    with open(all_chunks_path, "r", encoding="utf-8") as f:
-        all_chunks = [c.strip() for c in f if c.strip()]
+    all_chunks = load_corpus(all_chunks_path, SOURCE)
+    if not len(all_chunks):
+        raise RuntimeError(f"Corpus file '{all_chunks_path}' is empty. Please generate or check your chunks.")
     # Upload all chunks to Pinecone (batching, with metadata)
     upload_chunks_to_pinecone(all_chunks)
     # Optionally, test retrieval (existing logic remains)
@@ -1,10 +1,18 @@
 # --- New endpoint for DOCX generation ---
-from rag_txt_chunk_pipeline import embed_and_retrieve
+from rag_txt_chunk_pipeline import embed_and_retrieve, match_code, code_results, get_embedder, parse_chunk, SOURCE
+from semantic_cache import get_semantic_cache, cache_context
+from rerank import Deadline
+from chunk_store import normalize_unit
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from mistral_utils import answer_question
+from speculation import Speculation
 from fastapi import Form
+from coalesce import SingleFlight, normalize_query
+import metrics
+import index_snapshot
+import os
 
 load_dotenv()
 
@@ -19,22 +27,67 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request IDs, per-stage latency histograms and the /metrics endpoint
+metrics.install(app, SOURCE)
+# Concurrent identical searches run the pipeline once
+coalescer = SingleFlight(SOURCE, "/search_piemonte")
+# Listing and activating local search snapshots (ADMIN_TOKEN)
+index_snapshot.install_admin(app, "all_chunks.txt", SOURCE)
+# Searches read the active index snapshot instead of Pinecone; a pinned version is always read locally
+LOCAL_SEARCH = os.getenv("LOCAL_SEARCH", "0") == "1"
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
 
 # Piemonte RAG search endpoint
-@app.post("/search_piemonte")
-def search_piemonte(query: str = Form(...)):
-    # First, ask Mistral to redefine the construction activity category
+def run_search(query, budget, unit, version):
+    # The latency budget (seconds) covers the whole request, including refinement
+    deadline = Deadline(budget)
+    # Optional unit of measure, matched against the index metadata (m2, mq and m² are the same unit)
+    filter = {"unit": normalize_unit(unit)} if unit else None
     try:
-        refined_query = answer_question(f"Define the construction activity category in italian that describes it best in Prezziario with one to max five words, first word must be the most accurate for: {query}")
-        if isinstance(refined_query, dict) and "error" in refined_query:
-            return refined_query
-        # Use the refined query for retrieval
-        results = embed_and_retrieve(refined_query, all_chunks_file="all_chunks.txt", top_k=3, embeddings_path="chunk_embeddings_piemonte.pt")
-        return {"results": results}
+        # The snapshot a local search reads from start to end, even if another one is activated meanwhile
+        snapshot = None
+        if LOCAL_SEARCH or version:
+            snapshot = index_snapshot.load_snapshot("all_chunks.txt", SOURCE, get_embedder(), parse_chunk, "chunk_embeddings_piemonte.pt", version)
+        # A pasted code (or chapter) is answered straight from the code index
+        with metrics.stage_timer(SOURCE, "code_lookup"):
+            kind, positions, rest = match_code(query, snapshot)
+            if kind == "exact" or (kind == "prefix" and not rest):
+                return {"results": code_results(kind, positions, query, snapshot), "degraded": False}
+        # A leading chapter prefix is kept out of the refinement, so the pipeline still narrows by it
+        prefix = query.split()[0] + " " if kind == "prefix" else ""
+        # Near-duplicates of a recent query reuse its results, or at least its refinement (of the same snapshot, when local)
+        cache = get_semantic_cache(SOURCE)
+        lookup = None
+        if cache is not None:
+            with metrics.stage_timer(SOURCE, "semantic_cache"):
+                lookup = cache.lookup(get_embedder(), rest, cache_context(filter=filter, prefix=prefix,
+                                                                     version=snapshot.version if snapshot else None))
+            if lookup.result is not None:
+                return {"results": lookup.result, "degraded": False}
+        refined_query = lookup.refinement if lookup is not None else None
+        refinement = None
+        if refined_query is None:
+            # Mistral redefines the construction activity category while the pipeline searches the raw query
+            refinement = Speculation(SOURCE, lambda cancel: answer_question(f"Define the construction activity category in italian that describes it best in Prezziario with one to max five words, first word must be the most accurate for: {rest}", task="refine", cancel=cancel))
+        results = embed_and_retrieve(prefix + (refined_query or rest), all_chunks_file="all_chunks.txt", top_k=3, embeddings_path="chunk_embeddings_piemonte.pt", deadline=deadline, filter=filter,
+                                     use_pinecone=snapshot is None, version=snapshot.version if snapshot else None,
+                                     refinement=refinement)
+        if refinement is not None:
+            # Not refined when the raw query was confident enough
+            refined_query = refinement.value if isinstance(refinement.value, str) else rest
+        # Results cut short by the deadline are not worth reusing
+        if lookup is not None and not deadline.degraded:
+            cache.store(lookup, rest, refined_query, results)
+        return {"results": results, "degraded": deadline.degraded}
     except Exception as e:
         return {"error": str(e)}
 
-    
\ No newline at end of file
+    
+
+@app.post("/search_piemonte")
+async def search_piemonte(query: str = Form(...), budget: float = Form(None), unit: str = Form(None), version: str = Form(None)):
+    # Identical searches in flight share one pipeline run
+    return await coalescer.run((normalize_query(query), budget, normalize_unit(unit) if unit else None, version), run_search, query, budget, unit, version)
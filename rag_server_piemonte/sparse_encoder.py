@@ -0,0 +1,180 @@
+"""
+BM25 sparse vectors for Pinecone hybrid (sparse-dense) search.
+
+The uploader encodes every chunk with the tokenizer of the local lexical
+index (text_analysis.analyze) and upserts the sparse vector next to the dense
+one, so a single query scores both: the dense part weighted by 1 - alpha,
+the lexical part by alpha, like the local hybrid_retrieve.
+
+Documents get BM25's saturated term frequencies, length-normalized with the
+average chunk length at upload time and divided by their bound K1 + 1, so
+every weight is below 1; queries get the IDF of their terms from the
+document frequencies of every uploaded chunk, saved next to the corpus
+(sparse_encoder_<source>.json), summing to 1. Their dot product is the
+chunk's BM25 score scaled into [0, 1], so the hybrid score stays on the
+scale of the cosine.
+Terms are hashed to their sparse index, so incremental uploads need no shared
+vocabulary. Sparse values need a dotproduct index: the uploader creates new
+indexes with that metric and uploads unit-length dense vectors, so the dense
+part is still the cosine.
+"""
+import os
+import json
+import zlib
+import numpy as np
+from metrics import get_logger, record_cache
+from text_analysis import analyze, K1, B
+
+# Weight of the lexical part of Pinecone queries; 0 uploads and queries dense vectors only
+HYBRID_ALPHA = float(os.getenv("HYBRID_ALPHA", "0.1"))
+# Pinecone's limit of non-zero values per sparse vector
+MAX_TERMS = 1000
+
+
+def term_index(token):
+    return zlib.crc32(token.encode("utf-8"))
+
+
+def to_sparse(weights):
+    indices = sorted(weights)
+    return {"indices": indices, "values": [float(weights[i]) for i in indices]}
+
+
+def unit_rows(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / (np.linalg.norm(embeddings, axis=-1, keepdims=True) + 1e-12)
+
+
+class SparseEncoder:
+    def __init__(self, source, df=None, n_docs=0, total_len=0):
+        self.source = source
+        self.df = df or {}
+        self.n_docs = n_docs
+        self.total_len = total_len
+
+    def fit(self, chunks):
+        """
+        Adds the chunks to the document frequencies and returns their tokens.
+        """
+        tokens = [analyze(chunk) for chunk in chunks]
+        for doc in tokens:
+            for token in set(doc):
+                self.df[token] = self.df.get(token, 0) + 1
+            self.total_len += len(doc)
+        self.n_docs += len(tokens)
+        return tokens
+
+    def encode_documents(self, tokens):
+        avgdl = self.total_len / self.n_docs if self.n_docs else 1.0
+        vectors = []
+        for doc in tokens:
+            tf = {}
+            for token in doc:
+                tf[token] = tf.get(token, 0) + 1
+            norm = K1 * (1 - B + B * len(doc) / avgdl)
+            weights = {}
+            for token, count in sorted(tf.items(), key=lambda item: item[1], reverse=True)[:MAX_TERMS]:
+                index = term_index(token)
+                # Saturated TF over its bound K1 + 1: below 1, so a query (weights summing to 1) scores at most 1;
+                # terms sharing a hash still add up to no more than 1
+                weights[index] = min(weights.get(index, 0.0) + count / (count + norm), 1.0)
+            vectors.append(to_sparse(weights))
+        return vectors
+
+    def encode_query(self, query):
+        """
+        IDF weights of the query's terms, summing to 1; None when no term
+        occurs in the uploaded chunks.
+        """
+        weights = {}
+        for token in set(analyze(query)):
+            df = self.df.get(token)
+            if df:
+                index = term_index(token)
+                weights[index] = weights.get(index, 0.0) + float(np.log(1 + (self.n_docs - df + 0.5) / (df + 0.5)))
+        total = sum(weights.values())
+        if not total:
+            return None
+        return to_sparse({i: w / total for i, w in weights.items()})
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"source": self.source, "n_docs": self.n_docs, "total_len": self.total_len, "df": self.df}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["source"], data["df"], data["n_docs"], data["total_len"])
+
+
+def index_metric(index_name):
+    # Sparse values need the dotproduct metric; indexes created before hybrid search use cosine
+    from pinecone import Pinecone
+    return Pinecone(api_key=os.getenv("PINECONE_API_KEY")).describe_index(index_name).metric
+
+
+def update_sparse_encoder(path, chunks, source, start=0):
+    """
+    Adds uploaded chunks to the encoder of the file and returns it with
+    their sparse vectors. Uploads from position 0 start a new encoder; later
+    batches are merged into the existing file. Nothing is written: see
+    save_sparse_encoder.
+    """
+    encoder = SparseEncoder.load(path) if start and os.path.exists(path) else SparseEncoder(source)
+    vectors = encoder.encode_documents(encoder.fit(chunks))
+    return encoder, vectors
+
+
+def save_sparse_encoder(path, encoder, source):
+    """
+    Writes the encoder once its sparse vectors are in the index, or removes
+    the file after a dense-only upload: queries send sparse vectors whenever
+    the file exists.
+    """
+    if encoder is None:
+        if os.path.exists(path):
+            os.remove(path)
+            get_logger(source).info(f"[Main] Dense-only upload: {path} removed.")
+    else:
+        encoder.save(path)
+        get_logger(source).info(f"[Main] Sparse encoder with {len(encoder.df)} terms over {encoder.n_docs} chunks written to {path}.")
+    _loaded.pop(path, None)
+
+
+_loaded = {}
+
+
+def load_sparse_encoder(path, source):
+    """
+    Loads the encoder written at upload time, cached until the file changes.
+    Returns None without a file (an index uploaded with dense vectors only)
+    or when HYBRID_ALPHA is 0.
+    """
+    if HYBRID_ALPHA <= 0 or not os.path.exists(path):
+        return None
+    stamp = os.path.getmtime(path)
+    cached = _loaded.get(path)
+    if cached and cached[0] == stamp:
+        record_cache(source, "sparse_encoder", hit=True)
+        return cached[1]
+    record_cache(source, "sparse_encoder", hit=False)
+    encoder = SparseEncoder.load(path)
+    _loaded[path] = (stamp, encoder)
+    return encoder
+
+
+def hybrid_query(query_emb, query, encoder, alpha=HYBRID_ALPHA):
+    """
+    Pinecone query arguments: the unit-length dense vector, weighted by
+    1 - alpha next to the sparse vector weighted by alpha when the index has
+    sparse vectors.
+    """
+    dense = unit_rows(query_emb)
+    sparse = encoder.encode_query(query) if encoder is not None else None
+    if sparse is None:
+        return {"vector": dense.tolist()}
+    return {
+        "vector": (dense * (1 - alpha)).tolist(),
+        "sparse_vector": {"indices": sparse["indices"], "values": [v * alpha for v in sparse["values"]]},
+    }
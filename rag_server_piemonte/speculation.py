@@ -0,0 +1,70 @@
+"""
+Speculative retrieval next to the LLM refinement.
+
+When the query has to be refined by Mistral, the call runs in the background
+while the raw query is encoded and searched. Its candidates are merged with
+those of the refined queries once the refinement arrives, so the raw query's
+retrieval no longer adds to the latency. If the raw query's best hit is
+already similar enough (cosine similarity of at least
+SPECULATIVE_MIN_SIMILARITY), the refinement is cancelled: dropped before it is
+sent if it is still waiting for the rate limiter, ignored otherwise.
+"""
+import os
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from metrics import get_logger, SPECULATIONS
+
+# Set above 1 to always wait for the refinement
+MIN_SIMILARITY = float(os.getenv("SPECULATIVE_MIN_SIMILARITY", "0.85"))
+_pool = ThreadPoolExecutor(max_workers=int(os.getenv("SPECULATIVE_THREADS", "16")), thread_name_prefix="refine")
+
+
+class Speculation:
+    """
+    A refinement running in the background: `refine(cancel)` is called with a
+    threading.Event that is set when the result is no longer needed.
+    """
+    def __init__(self, source, refine):
+        self.source = source
+        self.cancelled = threading.Event()
+        # copy_context keeps the request ID on the refinement's log lines
+        self.future = _pool.submit(contextvars.copy_context().run, refine, self.cancelled)
+        self.value = None
+
+    def settle(self, similarity):
+        """
+        Cancels the refinement if the raw query's best hit (`similarity`) is
+        confident enough; returns whether it did.
+        """
+        if similarity < MIN_SIMILARITY:
+            return False
+        self.cancelled.set()
+        self.future.cancel()
+        SPECULATIONS.labels(source=self.source, outcome="cancelled").inc()
+        get_logger(self.source).info(f"[RAG] Raw query hit with similarity {similarity:.3f}, refinement cancelled.")
+        return True
+
+    def result(self):
+        """
+        The refinement's reply; raises what it raised.
+        """
+        try:
+            self.value = self.future.result()
+        except Exception:
+            SPECULATIONS.labels(source=self.source, outcome="failed").inc()
+            raise
+        SPECULATIONS.labels(source=self.source, outcome="refined").inc()
+        return self.value
+
+
+def similarity(embedder, query, embedding):
+    """
+    Cosine similarity of a query and a chunk embedding. Local hybrid scores
+    are relative to the other candidates, so this is what is compared to
+    MIN_SIMILARITY in local search (Pinecone scores already are cosines).
+    """
+    query_emb = np.asarray(embedder.encode(query, convert_to_numpy=True), dtype=np.float32).reshape(-1)
+    embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    return float(query_emb @ embedding / (np.linalg.norm(query_emb) * np.linalg.norm(embedding) + 1e-12))